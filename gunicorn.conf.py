@@ -0,0 +1,26 @@
+import gc
+import multiprocessing
+import os
+
+# Gunicorn settings, read by default when gunicorn is started from this directory:
+#   gunicorn natural_history_project.wsgi:application
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+# Imports the application once in the master, so workers share its modules and warmed caches
+# copy-on-write instead of each importing and warming its own
+preload_app = True
+
+
+# Runs in the master after the application is loaded and before the first worker is forked
+def when_ready(server):
+    from django.conf import settings
+
+    if settings.WARMUP:
+        from specimen_catalog import warmup
+        for stage, seconds, detail in warmup.warm():
+            server.log.info('Warm-up %s: %s in %.2fs', stage, detail, seconds)
+
+    # Moves everything allocated so far out of the collector's reach: a collection in a worker
+    # would otherwise write to those objects' pages and un-share them
+    gc.freeze()
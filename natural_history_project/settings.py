@@ -43,12 +43,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'specimen_catalog.middleware.AdmissionControlMiddleware',
+    'specimen_catalog.middleware.ServerTimingMiddleware',
+    'specimen_catalog.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'specimen_catalog.middleware.ProfilingMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware', 
     'django.contrib.sessions.middleware.SessionMiddleware',
     "django.middleware.security.SecurityMiddleware",
@@ -78,13 +82,74 @@ WSGI_APPLICATION = 'natural_history_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Database performance profiles, selected with the DATABASE_PROFILE environment variable.
+# 'standard' is Django's stock SQLite setup. 'tuned' switches to WAL so readers no longer wait
+# for the writer, keeps connections open between requests and applies the PRAGMAS below
+# (see specimen_catalog/database.py) to every new connection.
+DATABASE_PROFILES = {
+    'standard': {},
+    'tuned': {
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,  # Seconds to wait for the write lock (busy timeout)
+        },
+        'PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -64000,  # 64 MB page cache per connection
+            'mmap_size': 268435456,  # 256 MB memory-mapped I/O
+            'temp_store': 'MEMORY',
+        },
+    },
+}
+
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'standard')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        **DATABASE_PROFILES[DATABASE_PROFILE],
     }
 }
 
+# Local read replicas, enabled with DATABASE_REPLICAS=<count>.
+# Replicas are SQLite copies of the primary refreshed by `manage.py replicate_databases`;
+# reads are spread over replicas refreshed within REPLICA_MAX_LAG seconds and sessions
+# that just wrote keep reading from the primary for REPLICA_STICKY_SECONDS.
+DATABASE_REPLICAS = int(os.environ.get('DATABASE_REPLICAS', '0'))
+DATABASE_REPLICA_ALIASES = [f'replica{number}' for number in range(1, DATABASE_REPLICAS + 1)]
+REPLICA_DIR = BASE_DIR / 'var' / 'replicas'
+REPLICA_MAX_LAG = 30
+REPLICA_STICKY_SECONDS = 30
+
+for alias in DATABASE_REPLICA_ALIASES:
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': REPLICA_DIR / f'{alias}.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    }
+
+if DATABASE_REPLICA_ALIASES:
+    DATABASE_ROUTERS = ['specimen_catalog.routers.PrimaryReplicaRouter']
+    MIDDLEWARE.append('specimen_catalog.middleware.ReplicaStickinessMiddleware')
+
+# Continent sharding, enabled with DATABASE_SHARDS=<count> (not combined with replicas).
+# Specimens and expeditions are partitioned by continent over the shard databases, taxonomy
+# is copied to every shard and everything else stays in default. SHARD_CONTINENTS pins
+# continents to shards; unlisted continents are spread by a stable hash.
+DATABASE_SHARDS = int(os.environ.get('DATABASE_SHARDS', '0'))
+DATABASE_SHARD_ALIASES = [f'shard{number}' for number in range(1, DATABASE_SHARDS + 1)]
+SHARD_DIR = BASE_DIR / 'var' / 'shards'
+SHARD_CONTINENTS = {}
+
+for alias in DATABASE_SHARD_ALIASES:
+    DATABASES[alias] = {**DATABASES['default'], 'NAME': SHARD_DIR / f'{alias}.sqlite3'}
+
+if DATABASE_SHARD_ALIASES:
+    DATABASE_ROUTERS = ['specimen_catalog.sharding.ShardRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -133,3 +198,171 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
 
+# Analytics snapshot
+# Directory holding the memory-mapped NumPy snapshots served by /api/analytics/
+
+ANALYTICS_SNAPSHOT_DIR = BASE_DIR / 'var' / 'snapshots'
+
+# Background jobs
+# Import jobs may only read files from JOB_IMPORT_DIR; export jobs write to JOB_EXPORT_DIR.
+# When run_jobs starts it fails running jobs whose worker process has exited, and those
+# running for longer than JOB_RUNNING_TIMEOUT seconds.
+
+JOB_IMPORT_DIR = BASE_DIR / 'var' / 'imports'
+JOB_EXPORT_DIR = BASE_DIR / 'var' / 'exports'
+JOB_RUNNING_TIMEOUT = 6 * 60 * 60
+
+# Write batching
+# With WRITE_BATCHING=1, specimen creates from the API and the new specimen page are
+# group-committed by one writer thread per process: writes arriving within
+# WRITE_BATCH_WINDOW seconds (up to WRITE_BATCH_MAX) share a single transaction.
+
+WRITE_BATCHING = os.environ.get('WRITE_BATCHING') == '1'
+WRITE_BATCH_WINDOW = 0.005
+WRITE_BATCH_MAX = 100
+WRITE_BATCH_TIMEOUT = 30
+
+# Request coalescing
+# Identical concurrent GETs of the views using SingleFlightMixin share one computation per
+# process. Set SINGLE_FLIGHT_LOCK_DIR to also serialise them across workers on lock files.
+
+SINGLE_FLIGHT = True
+SINGLE_FLIGHT_LOCK_DIR = os.environ.get('SINGLE_FLIGHT_LOCK_DIR') or None
+
+# Admission control
+# Concurrency limits per route group, counted over every worker process in ADMISSION_FILE,
+# a memory-mapped file updated under flock. Over the limit, requests queue for up to
+# queue_timeout seconds and then get a 503 with Retry-After; cheaper groups have a higher
+# priority, and lower priority groups shed at once while a higher priority group has
+# requests queued.
+# Routes are mapped to groups by URL name; unlisted routes are in ADMISSION_DEFAULT_GROUP.
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', '1') == '1'
+ADMISSION_GROUPS = {
+    'cheap': {'limit': 32, 'queue_timeout': 2.0, 'priority': 2, 'retry_after': 1},
+    'expensive': {'limit': 8, 'queue_timeout': 0.5, 'priority': 1, 'retry_after': 5},
+    'bulk': {'limit': 2, 'queue_timeout': 0.0, 'priority': 0, 'retry_after': 30},
+}
+ADMISSION_DEFAULT_GROUP = 'cheap'
+ADMISSION_FILE = BASE_DIR / 'var' / 'admission.mmap'
+ADMISSION_ROUTES = {
+    'all_specimens': 'expensive',
+    'specimen-list': 'expensive',
+    'expedition-list': 'expensive',
+    'taxonomy-list': 'expensive',
+    'async-specimen-list': 'expensive',
+    'async-expedition-list': 'expensive',
+    'async-taxonomy-list': 'expensive',
+    'analytics-counts': 'expensive',
+    'analytics-distinct': 'expensive',
+    'biodiversity': 'expensive',
+    'analytics-crosstab': 'bulk',
+    'biodiversity-report': 'bulk',
+    'change-feed': 'bulk',
+    'specimen-bulk': 'bulk',
+    'taxonomy-reclassify': 'bulk',
+}
+
+# Request instrumentation
+# With SERVER_TIMING=1, every response carries a Server-Timing header with its query count,
+# database, template and serialisation time. Requests slower than SERVER_TIMING_SLOW_MS or
+# running more than SERVER_TIMING_MAX_QUERIES queries are logged to
+# specimen_catalog.slow_requests with their SERVER_TIMING_LOGGED_QUERIES slowest statements.
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+SERVER_TIMING_SLOW_MS = 500
+SERVER_TIMING_MAX_QUERIES = 50
+SERVER_TIMING_LOGGED_QUERIES = 3
+
+# Metrics
+# With METRICS=1, request latency histograms, status classes, query counts and cache hit
+# ratios are recorded per URL name in METRICS_FILE, a memory-mapped file shared by all
+# workers, and served in the Prometheus text format at /metrics to METRICS_ALLOWED_IPS.
+
+METRICS = os.environ.get('METRICS') == '1'
+METRICS_FILE = BASE_DIR / 'var' / 'metrics.mmap'
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# On-demand profiling
+# With PROFILING=1, staff users can add ?_profile to any request to have it run under
+# cProfile. The PROFILING_TOP_FUNCTIONS hottest functions and the SQL trace are stored
+# as a ProfileCapture and shown in the admin, at most PROFILING_RATE_LIMIT captures
+# per PROFILING_RATE_WINDOW seconds.
+
+PROFILING = os.environ.get('PROFILING') == '1'
+PROFILING_PARAMETER = '_profile'
+PROFILING_RATE_LIMIT = 5
+PROFILING_RATE_WINDOW = 60
+PROFILING_TOP_FUNCTIONS = 100
+
+# Startup targets
+# A worker boot (django.setup, the WSGI application and the URLconf) should stay within
+# these limits, checked by `manage.py startup_report --check` and the test suite. numpy and
+# pycountry are imported lazily and must not be executed during a boot.
+
+STARTUP_TARGET_SECONDS = 1.5
+STARTUP_TARGET_RSS_MB = 80
+
+# Warm-up
+# With WARMUP=1 (the default), gunicorn.conf.py loads the application in the master and,
+# before forking workers, compiles the templates, loads the gazetteer, lookup tables and
+# analytics snapshot and requests WARMUP_REQUESTS plus the all-specimens page filtered by the
+# WARMUP_TOP_VALUES most common values of each WARMUP_TOP_FILTERS parameter. Workers inherit
+# the warm caches copy-on-write. `manage.py warm_caches` re-warms on demand.
+# Page counts of the all-specimens list are cached for COUNT_CACHE_TIMEOUT seconds per data version.
+
+WARMUP = os.environ.get('WARMUP', '1') == '1'
+WARMUP_REQUESTS = [
+    ('index', {}),
+    ('all_specimens', {}),
+    ('all_specimens', {'page': '2'}),
+    ('new_specimen', {}),
+    ('specimen-list', {'limit': '100'}),
+    ('expedition-list', {}),
+    ('taxonomy-list', {}),
+]
+WARMUP_TOP_FILTERS = {'expedition__continent': 'continent', 'taxonomy__kingdom': 'kingdom'}
+WARMUP_TOP_VALUES = 3
+COUNT_CACHE_TIMEOUT = 300
+
+# Reference data cache
+# Taxonomy and Expedition rows looked up by primary key are cached in two tiers: an LRU of
+# up to REFERENCE_CACHE_SIZE records per model in each process, in front of the Django cache
+# (REFERENCE_CACHE_TIMEOUT seconds). No CACHES are configured, so the Django cache is the
+# default local-memory one and both tiers are per process. Signals evict changed rows from
+# the writing process; the others notice the data version move, checked every
+# REFERENCE_CACHE_CHECK_INTERVAL seconds, drop their LRU and stop reading the Django cache
+# entries of the old version, whose keys carry the version.
+
+REFERENCE_CACHE_SIZE = 5000
+REFERENCE_CACHE_TIMEOUT = 3600
+REFERENCE_CACHE_CHECK_INTERVAL = 1.0
+
+# Related specimens
+# The specimen detail page and /api/specimens/<pk>/related/ show up to RELATED_SPECIMENS
+# specimens, closest taxonomic level first, from the groups precomputed in NeighbourGroup.
+# Run `manage.py rebuild_related_specimens` after changing it.
+
+RELATED_SPECIMENS = 8
+
+# Taxon name reconciliation
+# Names entered in TaxonomyForm or read from import files are matched against the existing
+# names of their rank through an in-memory trigram index per process, rebuilt when the data
+# version has moved (checked at most every TAXON_INDEX_CHECK_INTERVAL seconds). Matches scoring
+# at least TAXON_MATCH_THRESHOLD (0-1) are reported; TaxonomyForm asks for confirmation before
+# saving a name that scores TAXON_SUGGEST_THRESHOLD or more against a different existing name.
+
+TAXON_MATCH_THRESHOLD = 0.5
+TAXON_SUGGEST_THRESHOLD = 0.7
+TAXON_INDEX_CHECK_INTERVAL = 30.0
+
+# Bulk import validation
+# POST /api/specimens/bulk/ takes up to BULK_MAX_ROWS rows and checks all of them against the
+# form rules before writing any; a rejected batch reports its first BULK_MAX_ERRORS errors.
+# Valid batches of up to BULK_SYNC_MAX_ROWS rows are imported in the request (about 20 ms
+# per row); larger ones are queued as an import_csv job and answered with 202 and its id.
+# Import jobs run the same check when queued with {"validate": true}.
+
+BULK_MAX_ROWS = 100000
+BULK_SYNC_MAX_ROWS = 250
+BULK_MAX_ERRORS = 100
@@ -1,6 +1,13 @@
 # Imports the models 
 from django.contrib import admin
-from .models import Expedition, Taxonomy, Specimen
+from django.contrib import messages
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ChangeList
+from django.template.response import TemplateResponse
+from django.utils.html import format_html, format_html_join
+from .models import Expedition, Taxonomy, Specimen, SpecimenRecord, Change, Job, ProfileCapture
+from .forms import ReclassifyForm
+from . import reference_cache, reclassify
 
 # Register the Expedition model with the Django Admin interface
 @admin.register(Expedition)
@@ -12,8 +19,132 @@ class ExpeditionAdmin(admin.ModelAdmin):
 class TaxonomyAdmin(admin.ModelAdmin):
     list_display = ('taxonomy_id', 'kingdom', 'phylum','highest_biostratigraphic_zone', 
                     'class_name', 'family', 'genus', 'species')
+    list_filter = ('family',)
+    search_fields = ('family', 'genus', 'species')
+    actions = ['reclassify_taxonomies']
+
+    # Renames or moves the selected taxonomies in one go, e.g. every taxonomy of a genus after
+    # searching for it. An intermediate page asks for the new names and previews the affected
+    # taxonomies and specimens before they are applied.
+    @admin.action(description='Reclassify selected taxonomies')
+    def reclassify_taxonomies(self, request, queryset):
+        form = ReclassifyForm(request.POST if 'reclassify' in request.POST else None)
+        preview = None
+        if form.is_valid():
+            if request.POST['reclassify'] == 'apply':
+                result = reclassify.apply(queryset, form.new_values)
+                self.message_user(request, f"Reclassified {result['taxonomies']} taxonomies with {result['specimens']} specimens "
+                                           f"and merged {result['merged']} duplicates.", messages.SUCCESS)
+                return None
+            preview = reclassify.preview(queryset, form.new_values)
+
+        return TemplateResponse(request, 'admin/specimen_catalog/taxonomy/reclassify.html', {
+            **self.admin_site.each_context(request),
+            'title': 'Reclassify taxonomies',
+            'opts': self.model._meta,
+            'form': form,
+            'preview': preview,
+            'queryset': queryset,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        })
+
+# Specimen change list whose page resolves its taxonomies and expeditions through the
+# reference cache in one call per model, instead of joining both tables on every page
+class SpecimenChangeList(ChangeList):
+    def apply_select_related(self, qs):
+        return qs
+
+    def get_results(self, request):
+        super().get_results(request)
+        reference_cache.attach(self.result_list)
 
 # Register the Specimen model with the Django Admin interface
 @admin.register(Specimen)
 class SpecimenAdmin(admin.ModelAdmin):
     list_display = ('specimen_id', 'catalog_number', 'taxonomy', 'expedition')
+
+    def get_changelist(self, request, **kwargs):
+        return SpecimenChangeList
+
+# Register the read-only SpecimenRecord read model with the Django Admin interface
+@admin.register(SpecimenRecord)
+class SpecimenRecordAdmin(admin.ModelAdmin):
+    list_display = ('specimen_id', 'catalog_number', 'kingdom', 'family', 'genus', 'species', 'continent', 'country')
+    list_filter = ('continent',)
+    search_fields = ('catalog_number', 'genus', 'species')
+
+    # Records are maintained by signals and rebuild_specimen_records, never edited by hand
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+# Register the change feed with the Django Admin interface (read-only)
+@admin.register(Change)
+class ChangeAdmin(admin.ModelAdmin):
+    list_display = ('seq', 'model', 'object_id', 'action', 'created')
+    list_filter = ('model', 'action')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+# Register background jobs with the Django Admin interface
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'progress', 'throughput', 'worker', 'created', 'finished')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('status', 'processed', 'total', 'result', 'error', 'worker', 'created', 'started', 'finished')
+
+    # Shows progress as "processed / total"
+    @admin.display(description='Progress')
+    def progress(self, obj):
+        return f"{obj.processed} / {obj.total if obj.total is not None else '?'}"
+
+
+# Register request profiles with the Django Admin interface (read-only)
+@admin.register(ProfileCapture)
+class ProfileCaptureAdmin(admin.ModelAdmin):
+    list_display = ('id', 'method', 'path', 'status_code', 'duration_ms', 'query_count', 'user', 'created')
+    list_filter = ('method', 'status_code')
+    exclude = ('functions', 'queries')
+    readonly_fields = ('method', 'path', 'user', 'status_code', 'duration_ms', 'query_count', 'db_time_ms',
+                       'created', 'hot_functions', 'sql_trace')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description='Duration (ms)', ordering='duration')
+    def duration_ms(self, obj):
+        return f"{obj.duration * 1000:.1f}"
+
+    @admin.display(description='DB time (ms)')
+    def db_time_ms(self, obj):
+        return f"{obj.db_time * 1000:.1f}"
+
+    # Functions sorted by cumulative time, like pstats' "cumulative" ordering
+    @admin.display(description='Hot functions')
+    def hot_functions(self, obj):
+        rows = format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}:{}</td></tr>', (
+            (row['function'], row['calls'], row['primitive_calls'], f"{row['cumtime'] * 1000:.2f}", f"{row['tottime'] * 1000:.2f}",
+             row['file'], row['line'])
+            for row in obj.functions))
+        return format_html('<table><thead><tr><th>Function</th><th>Calls</th><th>Primitive calls</th>'
+                           '<th>Cumulative (ms)</th><th>Own (ms)</th><th>Location</th></tr></thead>'
+                           '<tbody>{}</tbody></table>', rows)
+
+    # Statements in the order they ran
+    @admin.display(description='SQL trace')
+    def sql_trace(self, obj):
+        rows = format_html_join('', '<tr><td>{}</td><td><code>{}</code></td></tr>', (
+            (f"{query['duration'] * 1000:.2f}", query['sql']) for query in obj.queries))
+        return format_html('<table><thead><tr><th>ms</th><th>SQL</th></tr></thead><tbody>{}</tbody></table>', rows)
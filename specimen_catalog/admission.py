@@ -0,0 +1,134 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from .metrics import process_alive
+
+# Route groups the file can hold; a group gets a row the first time any worker uses it
+GROUPS = 16
+
+# Worker slots in the file; every process counts its own requests in its slot
+SLOTS = 64
+
+# Counters kept per slot and group
+IN_FLIGHT, WAITING = 0, 1
+FIELDS = 2
+
+# Bytes of the layout signature and of each group name
+SIGNATURE_SIZE = 32
+NAME_SIZE = 32
+
+
+def admission_file():
+    return Path(getattr(settings, 'ADMISSION_FILE', settings.BASE_DIR / 'var' / 'admission.mmap'))
+
+
+# In-flight and queued requests per route group of every worker, in one memory-mapped file, so
+# the limits hold for the whole server and not per worker process. Each cell is an int64; a slot
+# starts with its worker's pid, followed by FIELDS counters per group row. Updates are made under
+# an exclusive flock on the file (and a thread lock, as flock does not exclude threads sharing
+# the descriptor). Slots of exited workers are cleared, releasing what they held.
+class AdmissionTable:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.pid = os.getpid()
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.width = 1 + GROUPS * FIELDS
+        names_offset = SIGNATURE_SIZE
+        cells_offset = names_offset + GROUPS * NAME_SIZE
+        size = cells_offset + SLOTS * self.width * 8
+        signature = hashlib.sha256(repr((GROUPS, SLOTS, FIELDS, NAME_SIZE)).encode()).digest()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.locked():
+            # Starts a fresh file when the layout changed since it was written
+            if os.fstat(self.descriptor).st_size != size or os.pread(self.descriptor, SIGNATURE_SIZE, 0) != signature:
+                os.ftruncate(self.descriptor, 0)
+                os.ftruncate(self.descriptor, size)
+                os.pwrite(self.descriptor, signature, 0)
+            self.mmap = mmap.mmap(self.descriptor, size)
+            self.names = memoryview(self.mmap)[names_offset:cells_offset]
+            self.cells = memoryview(self.mmap)[cells_offset:].cast('q')
+            self.slot = self.claim_slot()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            fcntl.flock(self.descriptor, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.descriptor, fcntl.LOCK_UN)
+
+    def pid_of(self, slot):
+        return self.cells[slot * self.width]
+
+    # Takes the slot of this pid, an unused one or one whose worker has exited
+    def claim_slot(self):
+        pids = [self.pid_of(slot) for slot in range(SLOTS)]
+        if self.pid in pids:
+            return pids.index(self.pid)
+        for slot, pid in enumerate(pids):
+            if pid == 0 or not process_alive(pid):
+                self.clear_slot(slot)
+                self.cells[slot * self.width] = self.pid
+                return slot
+        raise RuntimeError(f'All {SLOTS} admission slots are in use.')
+
+    def clear_slot(self, slot):
+        start = slot * self.width
+        self.cells[start:start + self.width] = memoryview(bytes(self.width * 8)).cast('q')
+
+    # Clears the slots of exited workers, e.g. one killed while requests were in flight.
+    # Must be called under locked().
+    def reap(self):
+        for slot in range(SLOTS):
+            pid = self.pid_of(slot)
+            if pid and pid != self.pid and not process_alive(pid):
+                self.clear_slot(slot)
+
+    # Row of a group, assigned on first use. Must be called under locked().
+    def row(self, name):
+        if name not in self.rows:
+            encoded = name.encode()[:NAME_SIZE].ljust(NAME_SIZE, b'\0')
+            for row in range(GROUPS):
+                stored = bytes(self.names[row * NAME_SIZE:(row + 1) * NAME_SIZE])
+                if stored == encoded or not stored.strip(b'\0'):
+                    self.names[row * NAME_SIZE:(row + 1) * NAME_SIZE] = encoded
+                    self.rows[name] = row
+                    break
+            else:
+                raise RuntimeError(f'All {GROUPS} admission groups are in use.')
+        return self.rows[name]
+
+    def cell(self, slot, name, field):
+        return slot * self.width + 1 + self.row(name) * FIELDS + field
+
+    # Count of a group over every worker. Must be called under locked().
+    def total(self, name, field):
+        return sum(self.cells[self.cell(slot, name, field)] for slot in range(SLOTS) if self.pid_of(slot))
+
+    # Adds to this worker's count of a group. Must be called under locked().
+    def add(self, name, field, amount):
+        self.cells[self.cell(self.slot, name, field)] += amount
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+# This process's table, opened on first use and again in a forked worker
+def get_table():
+    path = admission_file()
+    key = (str(path), os.getpid())
+    with _tables_lock:
+        if key not in _tables:
+            _tables[key] = AdmissionTable(path)
+        return _tables[key]
@@ -0,0 +1,344 @@
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Change, SpecimenRecord
+from . import changes, versioning
+from .lazy_imports import lazy_import
+
+# numpy is loaded on first use rather than when the URLconf imports this module
+np = lazy_import('numpy')
+
+# SpecimenRecord columns that are dictionary-encoded into the snapshot
+DIMENSIONS = ['kingdom', 'phylum', 'highest_biostratigraphic_zone', 'class_name',
+              'identification_description', 'family', 'genus', 'species',
+              'expedition_id', 'expedition_name', 'continent', 'country']
+
+# Dimensions holding ids; they are encoded as strings ('' for none) like the other dimensions
+ID_DIMENSIONS = {'expedition_id'}
+
+# Name of the file that points at the directory of the live snapshot
+CURRENT_FILE = 'CURRENT'
+
+# Above this many possible groups, counting switches from bincount to a sort-based count
+BINCOUNT_LIMIT = 1 << 22
+
+# Share of the rows a snapshot update may rewrite; past it the whole table is dumped again
+UPDATE_MAX_SHARE = 0.25
+
+# Specimen ids per query when reading changed records
+ID_BATCH_SIZE = 5000
+
+_lock = threading.Lock()
+_loaded = {}
+
+
+# Directory holding the versioned snapshot directories
+def snapshot_root():
+    return Path(getattr(settings, 'ANALYTICS_SNAPSHOT_DIR', settings.BASE_DIR / 'var' / 'snapshots'))
+
+
+# A read-only, memory-mapped view of one snapshot directory.
+# The arrays are opened with mmap_mode='r', so every process that loads the same
+# snapshot shares the same pages of the OS page cache instead of its own copy.
+class Snapshot:
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as meta_file:
+            meta = json.load(meta_file)
+
+        self.version = meta['version']
+        self.rows = meta['rows']
+        # Change feed position the snapshot includes; None for snapshots written before it was kept
+        self.seq = meta.get('seq')
+        self.dictionaries = meta['dictionaries']
+        self.specimen_ids = np.load(self.path / 'specimen_id.npy', mmap_mode='r')
+        self.codes = {dimension: np.load(self.path / f'{dimension}.npy', mmap_mode='r') for dimension in self.dictionaries}
+        self._positions = {}
+
+    # False for a snapshot written before a dimension was added; it is rebuilt on next use
+    @property
+    def complete(self):
+        return set(self.dictionaries) == set(DIMENSIONS)
+
+    # Returns the code of a value in a dimension, or None if it never occurs
+    def code_for(self, dimension, value):
+        if dimension not in self._positions:
+            self._positions[dimension] = {value: code for code, value in enumerate(self.dictionaries[dimension])}
+        return self._positions[dimension].get(value)
+
+
+# Reads the snapshot directory the CURRENT file points at (None if nothing was built yet)
+def current_snapshot_path(root=None):
+    root = Path(root or snapshot_root())
+    try:
+        name = (root / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+    return root / name
+
+
+# Encodes an array of strings against an existing dictionary, extending it with unseen values.
+# Codes of values that were already known do not change between snapshot versions.
+def encode_column(values, dictionary):
+    uniques, inverse = np.unique(values, return_inverse=True)
+    positions = {value: code for code, value in enumerate(dictionary)}
+
+    mapping = np.empty(len(uniques), dtype=np.int32)
+    for index, value in enumerate(uniques.tolist()):
+        if value not in positions:
+            positions[value] = len(dictionary)
+            dictionary.append(value)
+        mapping[index] = positions[value]
+
+    return mapping[inverse].astype(np.int32, copy=False)
+
+
+# Dictionaries of the previous snapshot, copied so they can be extended. Reusing them keeps
+# the codes of existing values stable.
+def previous_dictionaries(previous):
+    known = previous.dictionaries if previous is not None else {}
+    return {dimension: list(known.get(dimension, [])) for dimension in DIMENSIONS}
+
+
+# Encodes record rows (specimen_id, *DIMENSIONS) into an id array and {dimension: codes}
+def encode_rows(rows, dictionaries):
+    columns = list(zip(*rows)) if rows else [()] * (len(DIMENSIONS) + 1)
+    codes = {}
+    for dimension, values in zip(DIMENSIONS, columns[1:]):
+        if dimension in ID_DIMENSIONS:
+            values = ['' if value is None else str(value) for value in values]
+        codes[dimension] = (encode_column(np.asarray(values, dtype=object), dictionaries[dimension]) if rows
+                            else np.empty(0, dtype=np.int32))
+    return np.asarray(columns[0], dtype=np.int64), codes
+
+
+# Writes a snapshot directory for the given version and publishes it as CURRENT
+def write_snapshot(root, version, seq, specimen_ids, codes, dictionaries, previous_path):
+    target = root / f'v{version}'
+    staging = root / f'.v{version}.{os.getpid()}.{threading.get_ident()}'
+    staging.mkdir()
+
+    np.save(staging / 'specimen_id.npy', specimen_ids)
+    for dimension in DIMENSIONS:
+        np.save(staging / f'{dimension}.npy', codes[dimension])
+
+    with open(staging / 'meta.json', 'w') as meta_file:
+        json.dump({'version': version, 'seq': seq, 'rows': len(specimen_ids), 'dictionaries': dictionaries}, meta_file)
+
+    # Another worker may have published the same version first; its copy is identical unless
+    # it predates a dimension, in which case it is moved aside and replaced
+    if target.exists() and Snapshot(target).complete:
+        shutil.rmtree(staging)
+    else:
+        if target.exists():
+            os.rename(target, root / f'.{target.name}.old.{os.getpid()}.{threading.get_ident()}')
+        os.rename(staging, target)
+
+    # Swaps the CURRENT pointer atomically so readers never see a half-written snapshot
+    pointer = root / f'.{CURRENT_FILE}.{os.getpid()}.{threading.get_ident()}'
+    pointer.write_text(target.name)
+    os.replace(pointer, root / CURRENT_FILE)
+
+    # Keeps the previous version for readers that are still opening it and drops older ones.
+    # Processes that already mapped a removed file keep reading it until they let go.
+    keep = {target.name, previous_path.name if previous_path else None}
+    for path in [*root.glob('v*'), *root.glob(f'.{target.name}.old.*')]:
+        if path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return target
+
+
+# Dumps SpecimenRecord into dictionary-encoded .npy files for the given data version
+def build_snapshot(root=None, version=None):
+    root = Path(root or snapshot_root())
+    root.mkdir(parents=True, exist_ok=True)
+    version = versioning.current_version() if version is None else version
+
+    previous_path = current_snapshot_path(root)
+    previous = Snapshot(previous_path) if previous_path is not None and previous_path.exists() else None
+    dictionaries = previous_dictionaries(previous)
+
+    # The feed position and the rows are read in one transaction, so they agree
+    with transaction.atomic():
+        seq = changes.latest_seq()
+        rows = list(SpecimenRecord.objects.order_by('specimen_id').values_list('specimen_id', *DIMENSIONS))
+
+    specimen_ids, codes = encode_rows(rows, dictionaries)
+    return write_snapshot(root, version, seq, specimen_ids, codes, dictionaries, previous_path)
+
+
+# Ids of the specimens whose records may differ from the snapshot after the changes in
+# `entries` (model, object_id): the specimens written themselves and those of every written
+# taxonomy and expedition.
+def changed_specimens(entries):
+    ids = {'specimen': set(), 'taxonomy': set(), 'expedition': set()}
+    for model, object_id in entries:
+        if model in ids:
+            ids[model].add(object_id)
+
+    specimens = ids['specimen']
+    for field in ('taxonomy_id', 'expedition_id'):
+        related = sorted(ids[field.removesuffix('_id')])
+        for start in range(0, len(related), ID_BATCH_SIZE):
+            batch = related[start:start + ID_BATCH_SIZE]
+            specimens.update(SpecimenRecord.objects.filter(**{f'{field}__in': batch}).values_list('specimen_id', flat=True))
+    return specimens
+
+
+# Brings a snapshot up to the given version by rewriting only the rows the change feed names
+# since the snapshot's position, instead of dumping the table again. Returns the new snapshot
+# directory, or None when a full build is needed: the snapshot predates the feed position,
+# the changes touch too many rows, or the table no longer matches (writes that bypass the
+# feed, such as the synthetic generator, leave a different row count or highest id).
+def update_snapshot(previous, root=None, version=None):
+    if previous.seq is None or not previous.complete:
+        return None
+    root = Path(root or snapshot_root())
+    version = versioning.current_version() if version is None else version
+    limit = max(int(previous.rows * UPDATE_MAX_SHARE), ID_BATCH_SIZE)
+
+    with transaction.atomic():
+        seq = changes.latest_seq()
+        entries = list(Change.objects.filter(seq__gt=previous.seq, seq__lte=seq).order_by()
+                       .values_list('model', 'object_id').distinct()[:limit + 1])
+        if len(entries) > limit:
+            return None
+        ids = changed_specimens(entries)
+        if len(ids) > limit:
+            return None
+
+        ids = np.asarray(sorted(ids), dtype=np.int64)
+        rows = []
+        for start in range(0, len(ids), ID_BATCH_SIZE):
+            batch = ids[start:start + ID_BATCH_SIZE].tolist()
+            rows += SpecimenRecord.objects.filter(pk__in=batch).values_list('specimen_id', *DIMENSIONS)
+        count = SpecimenRecord.objects.count()
+        highest = SpecimenRecord.objects.order_by('-specimen_id').values_list('specimen_id', flat=True).first()
+
+    # Drops the old version of every changed row and merges in the current ones, in id order
+    kept = ~np.isin(previous.specimen_ids, ids)
+    dictionaries = previous_dictionaries(previous)
+    new_ids, new_codes = encode_rows(rows, dictionaries)
+    specimen_ids = np.concatenate([previous.specimen_ids[kept], new_ids])
+    if len(specimen_ids) != count or (count and specimen_ids.max() != highest):
+        return None
+
+    order = np.argsort(specimen_ids, kind='stable')
+    codes = {dimension: np.concatenate([previous.codes[dimension][kept], new_codes[dimension]])[order]
+             for dimension in DIMENSIONS}
+    return write_snapshot(root, version, seq, specimen_ids[order], codes, dictionaries, previous.path)
+
+
+# Returns the snapshot for the current data version. A stale one is brought up to date from
+# the change feed, or rebuilt when that is not possible.
+def get_snapshot(root=None, rebuild=True):
+    root = Path(root or snapshot_root())
+    version = versioning.current_version()
+
+    with _lock:
+        path = current_snapshot_path(root)
+        snapshot = _loaded.get(path)
+        if snapshot is None and path is not None and path.exists():
+            snapshot = _loaded[path] = Snapshot(path)
+
+        if rebuild and (snapshot is None or snapshot.version != version or not snapshot.complete):
+            path = (snapshot and update_snapshot(snapshot, root, version)) or build_snapshot(root, version)
+            snapshot = _loaded[path] = Snapshot(path)
+
+        # Forgets snapshots of older versions so their mappings can be released
+        for stale in [key for key in _loaded if key != path]:
+            del _loaded[stale]
+
+    return snapshot
+
+
+# Returns a boolean mask of the rows that match every {dimension: value} pair in where
+def row_mask(snapshot, where=None):
+    mask = np.ones(snapshot.rows, dtype=bool)
+    for dimension, value in (where or {}).items():
+        code = snapshot.code_for(dimension, value)
+        if code is None:
+            return np.zeros(snapshot.rows, dtype=bool)
+        mask &= snapshot.codes[dimension] == code
+    return mask
+
+
+# Combines several code columns into one int64 key per row (mixed-radix encoding)
+def combined_key(snapshot, dimensions, mask):
+    sizes = [max(len(snapshot.dictionaries[dimension]), 1) for dimension in dimensions]
+    key = np.zeros(int(mask.sum()), dtype=np.int64)
+    for dimension, size in zip(dimensions, sizes):
+        key = key * size + snapshot.codes[dimension][mask]
+    return key, sizes
+
+
+# Counts occurrences of each key, returning (keys, counts) for the keys that occur
+def count_keys(key, size):
+    if size <= BINCOUNT_LIMIT:
+        counts = np.bincount(key, minlength=size)
+        keys = np.flatnonzero(counts)
+        return keys, counts[keys]
+    return np.unique(key, return_counts=True)
+
+
+# Turns group keys back into {dimension: value} dictionaries
+def decode_keys(snapshot, dimensions, keys, sizes):
+    if not dimensions:
+        return [{} for _ in keys]
+
+    codes = np.unravel_index(keys, sizes)
+    labels = [np.asarray(snapshot.dictionaries[dimension], dtype=object)[column]
+              for dimension, column in zip(dimensions, codes)]
+    return [dict(zip(dimensions, values)) for values in zip(*labels)]
+
+
+# Number of specimens per group, e.g. grouped_counts(snapshot, ['continent', 'family'])
+def grouped_counts(snapshot, by, where=None):
+    mask = row_mask(snapshot, where)
+    key, sizes = combined_key(snapshot, by, mask)
+    keys, counts = count_keys(key, int(np.prod(sizes)))
+
+    order = np.argsort(-counts, kind='stable')
+    groups = decode_keys(snapshot, by, keys[order], sizes)
+    return [dict(group, count=int(count)) for group, count in zip(groups, counts[order])]
+
+
+# Number of distinct values of one dimension per group, e.g. species richness per country
+def distinct_counts(snapshot, value, by, where=None):
+    mask = row_mask(snapshot, where)
+    key, sizes = combined_key(snapshot, by, mask)
+    value_size = max(len(snapshot.dictionaries[value]), 1)
+
+    pairs = np.unique(key * value_size + snapshot.codes[value][mask])
+    keys, counts = count_keys(pairs // value_size, int(np.prod(sizes)))
+
+    order = np.argsort(-counts, kind='stable')
+    groups = decode_keys(snapshot, by, keys[order], sizes)
+    return [dict(group, distinct=int(count)) for group, count in zip(groups, counts[order])]
+
+
+# Two-way table of specimen counts, with empty rows and columns dropped
+def crosstab(snapshot, rows, columns, where=None):
+    mask = row_mask(snapshot, where)
+    key, (row_size, column_size) = combined_key(snapshot, [rows, columns], mask)
+    keys, counts = count_keys(key, row_size * column_size)
+
+    # Scatters the non-empty cells into a dense table of the rows and columns that occur
+    row_part, column_part = np.divmod(keys, column_size)
+    row_codes, row_index = np.unique(row_part, return_inverse=True)
+    column_codes, column_index = np.unique(column_part, return_inverse=True)
+    table = np.zeros((len(row_codes), len(column_codes)), dtype=np.int64)
+    table[row_index, column_index] = counts
+
+    return {
+        'rows': [snapshot.dictionaries[rows][code] for code in row_codes],
+        'columns': [snapshot.dictionaries[columns][code] for code in column_codes],
+        'counts': table.tolist(),
+    }
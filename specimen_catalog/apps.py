@@ -3,3 +3,8 @@ from django.apps import AppConfig
 class SpecimenCatalogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'specimen_catalog'
+
+    def ready(self):
+        # Connects the receivers that maintain the read model, configure database connections
+        # and keep shards consistent
+        from . import signals, database, sharding  # noqa: F401
@@ -0,0 +1,129 @@
+from django.core.cache import cache
+
+from . import analytics, instrumentation
+from .lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+
+# Expedition attributes that diversity can be grouped by, mapped to snapshot dimensions.
+# Expeditions are grouped by id, as different expeditions can share a name.
+GROUPS = {'expedition': 'expedition_id', 'continent': 'continent', 'country': 'country'}
+
+# Dimensions shown as the label of groups keyed by an id
+LABELS = {'expedition': 'expedition_name'}
+
+# Taxonomy ranks that diversity can be measured at
+RANKS = ['kingdom', 'phylum', 'highest_biostratigraphic_zone', 'class_name',
+         'identification_description', 'family', 'genus', 'species']
+
+# How long computed metrics stay cached; the data version in the key handles invalidation
+CACHE_TIMEOUT = 60 * 60
+
+
+# Builds the sparse group x taxon count matrix as parallel arrays (group code, taxon code, count).
+# Specimens without a value for the rank are left out, as they cannot be assigned a taxon.
+def count_matrix(snapshot, group_dimension, rank):
+    groups = snapshot.codes[group_dimension]
+    taxa = snapshot.codes[rank]
+
+    blank = snapshot.code_for(rank, '')
+    mask = taxa != blank if blank is not None else np.ones(snapshot.rows, dtype=bool)
+
+    taxon_size = max(len(snapshot.dictionaries[rank]), 1)
+    cells, counts = np.unique(groups[mask].astype(np.int64) * taxon_size + taxa[mask], return_counts=True)
+    group_codes, taxon_codes = np.divmod(cells, taxon_size)
+    return group_codes, taxon_codes, counts
+
+
+# Computes richness, Shannon and Simpson for every group at once from a sparse count matrix.
+# Shannon uses H = ln N - (sum n ln n) / N and Simpson is the Gini-Simpson index 1 - sum p^2.
+def diversity_metrics(group_codes, counts, size):
+    counts = counts.astype(np.float64)
+    richness = np.bincount(group_codes, minlength=size)
+    totals = np.bincount(group_codes, weights=counts, minlength=size)
+    n_log_n = np.bincount(group_codes, weights=counts * np.log(counts), minlength=size)
+    n_squared = np.bincount(group_codes, weights=counts * counts, minlength=size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shannon = np.where(totals > 0, np.log(totals) - n_log_n / totals, 0.0)
+        simpson = np.where(totals > 0, 1.0 - n_squared / (totals * totals), 0.0)
+
+    return richness, totals, shannon, simpson
+
+
+# Identifying fields of each group code: {group: value}, or for groups keyed by an id
+# {group: label, dimension: id}. Every row of a group has the same label, so any one gives it.
+def group_fields(snapshot, group, size):
+    group_dimension = GROUPS[group]
+    values = snapshot.dictionaries[group_dimension]
+    if group not in LABELS:
+        return lambda code: {group: values[code]}
+
+    labels = snapshot.dictionaries[LABELS[group]]
+    label_codes = np.zeros(size, dtype=np.int64)
+    label_codes[snapshot.codes[group_dimension]] = snapshot.codes[LABELS[group]]
+    return lambda code: {group: labels[label_codes[code]],
+                         group_dimension: int(values[code]) if values[code] else None}
+
+
+# Returns the diversity of each group value, e.g. grouped_diversity(snapshot, 'country', 'species')
+def grouped_diversity(snapshot, group, rank):
+    group_dimension = GROUPS[group]
+    group_codes, _, counts = count_matrix(snapshot, group_dimension, rank)
+    size = max(len(snapshot.dictionaries[group_dimension]), 1)
+    richness, totals, shannon, simpson = diversity_metrics(group_codes, counts, size)
+
+    fields = group_fields(snapshot, group, size)
+    return [
+        {
+            **fields(code),
+            'specimens': int(totals[code]),
+            'richness': int(richness[code]),
+            'shannon': round(float(shannon[code]), 6),
+            'simpson': round(float(simpson[code]), 6),
+        }
+        for code in np.flatnonzero(totals)
+    ]
+
+
+# Returns the diversity of the whole collection at one rank
+def collection_diversity(snapshot, rank):
+    taxa = snapshot.codes[rank]
+    blank = snapshot.code_for(rank, '')
+    counts = np.bincount(taxa, minlength=max(len(snapshot.dictionaries[rank]), 1))
+    if blank is not None:
+        counts[blank] = 0
+    counts = counts[counts > 0]
+
+    richness, totals, shannon, simpson = diversity_metrics(np.zeros(len(counts), dtype=np.int64), counts, 1)
+    return {
+        'specimens': int(totals[0]),
+        'richness': int(richness[0]),
+        'shannon': round(float(shannon[0]), 6),
+        'simpson': round(float(simpson[0]), 6),
+    }
+
+
+# Diversity per group value, cached per data version
+def cached_grouped_diversity(group, rank):
+    snapshot = analytics.get_snapshot()
+    key = f'biodiversity:{snapshot.version}:{group}:{rank}'
+    results = cache.get(key)
+    instrumentation.record_cache(results is not None)
+    if results is None:
+        results = grouped_diversity(snapshot, group, rank)
+        cache.set(key, results, CACHE_TIMEOUT)
+    return snapshot.version, results
+
+
+# Full-collection report at one rank: collection totals plus every grouping, cached per data version
+def cached_report(rank):
+    snapshot = analytics.get_snapshot()
+    key = f'biodiversity:{snapshot.version}:report:{rank}'
+    report = cache.get(key)
+    instrumentation.record_cache(report is not None)
+    if report is None:
+        report = {'rank': rank, 'collection': collection_diversity(snapshot, rank)}
+        report.update({group: grouped_diversity(snapshot, group, rank) for group in GROUPS})
+        cache.set(key, report, CACHE_TIMEOUT)
+    return snapshot.version, report
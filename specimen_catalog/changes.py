@@ -0,0 +1,44 @@
+from .models import Change
+
+# Default and maximum number of changes returned per page of the feed
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+# Returns the concrete field values of an instance, using ids for foreign keys
+def instance_data(instance):
+    return {field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields}
+
+
+# Appends a create or update entry for a saved instance
+def record_save(instance, created):
+    Change.objects.create(
+        model=instance._meta.model_name,
+        object_id=instance.pk,
+        action=Change.CREATE if created else Change.UPDATE,
+        data=instance_data(instance),
+    )
+
+
+# Appends update entries for instances written with QuerySet.update(), which sends no signals
+def record_updates(instances):
+    Change.objects.bulk_create([
+        Change(model=instance._meta.model_name, object_id=instance.pk, action=Change.UPDATE, data=instance_data(instance))
+        for instance in instances
+    ])
+
+
+# Appends a tombstone for a deleted instance
+def record_delete(instance):
+    Change.objects.create(model=instance._meta.model_name, object_id=instance.pk, action=Change.DELETE)
+
+
+# Returns up to limit changes after the given sequence number, oldest first.
+# Writes are serialised by SQLite, so sequence numbers become visible in commit order.
+def changes_since(since, limit=PAGE_SIZE):
+    return list(Change.objects.filter(seq__gt=since).order_by('seq')[:limit])
+
+
+# Returns the latest sequence number (0 before the first change)
+def latest_seq():
+    return Change.objects.order_by('-seq').values_list('seq', flat=True).first() or 0
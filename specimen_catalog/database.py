@@ -0,0 +1,32 @@
+import os
+import sqlite3
+from contextlib import closing
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# Applies {name: value} SQLite PRAGMAs through a DB-API cursor
+def apply_pragmas(cursor, pragmas):
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+# Applies the PRAGMAS of the selected database profile to every new SQLite connection
+@receiver(connection_created)
+def configure_sqlite_connection(sender, connection, **kwargs):
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if connection.vendor == 'sqlite' and pragmas:
+        with connection.cursor() as cursor:
+            apply_pragmas(cursor, pragmas)
+
+
+# Refreshes a SQLite replica from the primary with the online backup API.
+# The copy is written straight into the replica file, so readers with open connections
+# see the new data on their next query, and the source stays readable and writable throughout.
+def replicate_sqlite(source, target, pragmas=None):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with closing(sqlite3.connect(source)) as source_connection, \
+            closing(sqlite3.connect(target, timeout=30)) as target_connection:
+        source_connection.backup(target_connection)
+        if pragmas:
+            apply_pragmas(target_connection.cursor(), pragmas)
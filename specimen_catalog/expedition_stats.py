@@ -0,0 +1,150 @@
+from collections import Counter
+
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Count, F
+
+from .models import ExpeditionStats, ExpeditionTaxonCount, SpecimenRecord
+from . import sharding
+
+# Families kept in ExpeditionStats.top_taxa
+TOP_TAXA = 3
+
+# Listing orders; both are served by expedition_count_idx, forwards or backwards
+MOST_SPECIMENS = ['-specimen_count', '-expedition_id']
+FEWEST_SPECIMENS = ['specimen_count', 'expedition_id']
+
+# Recounts specimens per expedition and family from the read model
+POPULATE_TAXON_COUNTS_SQL = """
+    INSERT INTO specimen_catalog_expeditiontaxoncount (expedition_id, family, specimen_count)
+    SELECT r.expedition_id, r.family, COUNT(*)
+    FROM specimen_catalog_specimenrecord r
+    JOIN specimen_catalog_expedition e ON e.expedition_id = r.expedition_id
+    GROUP BY r.expedition_id, r.family
+"""
+
+# One stats row per expedition, including those without specimens
+POPULATE_STATS_SQL = """
+    INSERT INTO specimen_catalog_expeditionstats (expedition_id, specimen_count, top_taxa)
+    SELECT e.expedition_id, COALESCE(SUM(c.specimen_count), 0), '[]'
+    FROM specimen_catalog_expedition e
+    LEFT JOIN specimen_catalog_expeditiontaxoncount c ON c.expedition_id = e.expedition_id
+    GROUP BY e.expedition_id
+"""
+
+
+# Expedition statistics with their expedition, in listing order. Under sharding the shards'
+# pages are merged by specimen count.
+def listing(sort=None):
+    order = FEWEST_SPECIMENS if sort == 'fewest' else MOST_SPECIMENS
+    queryset = ExpeditionStats.objects.select_related('expedition').order_by(*order)
+    if sharding.enabled():
+        return sharding.ShardedQuerySet(queryset, order_field='specimen_count', descending=order is MOST_SPECIMENS)
+    return queryset
+
+
+# The TOP_TAXA most common named families of an expedition, from its taxon counts
+def top_taxa(expedition_id, using='default'):
+    rows = (ExpeditionTaxonCount.objects.using(using).filter(expedition_id=expedition_id).exclude(family='')
+            .order_by('-specimen_count', 'family').values_list('family', 'specimen_count')[:TOP_TAXA])
+    return [{'family': family, 'specimens': count} for family, count in rows]
+
+
+# Adds delta specimens of a family to an expedition's counters and refreshes its top taxa
+def adjust(expedition_id, family, delta, using='default'):
+    if expedition_id is None or not delta:
+        return
+
+    with transaction.atomic(using=using):
+        counts = ExpeditionTaxonCount.objects.using(using).filter(expedition_id=expedition_id, family=family)
+        if not counts.update(specimen_count=F('specimen_count') + delta) and delta > 0:
+            try:
+                with transaction.atomic(using=using):
+                    ExpeditionTaxonCount.objects.using(using).create(expedition_id=expedition_id, family=family, specimen_count=delta)
+            except IntegrityError:
+                # Created by a concurrent write in between
+                counts.update(specimen_count=F('specimen_count') + delta)
+        counts.filter(specimen_count__lte=0).delete()
+
+        stats = ExpeditionStats.objects.using(using).filter(expedition_id=expedition_id)
+        if not stats.update(specimen_count=F('specimen_count') + delta, top_taxa=top_taxa(expedition_id, using)):
+            ExpeditionStats.objects.using(using).get_or_create(expedition_id=expedition_id)
+            stats.update(specimen_count=F('specimen_count') + delta, top_taxa=top_taxa(expedition_id, using))
+
+
+# Moves a saved specimen's counts. The read model still holds the specimen as it was before
+# the save, so this must run before the record is refreshed.
+def specimen_saved(specimen, using='default'):
+    previous = SpecimenRecord.objects.using(using).filter(pk=specimen.pk).values_list('expedition_id', 'family').first()
+    current = (specimen.expedition_id, specimen.taxonomy.family if specimen.taxonomy_id is not None else '')
+    if previous == current:
+        return
+    if previous is not None:
+        adjust(*previous, -1, using=using)
+    adjust(*current, 1, using=using)
+
+
+# Removes a specimen that is about to be deleted from its expedition's counts
+def specimen_deleting(specimen, using='default'):
+    previous = SpecimenRecord.objects.using(using).filter(pk=specimen.pk).values_list('expedition_id', 'family').first()
+    if previous is not None:
+        adjust(*previous, -1, using=using)
+
+
+# Moves the counts of a taxonomy whose family changed, before its records are refreshed
+def taxonomy_saved(taxonomy, using='default'):
+    taxonomies_saved({taxonomy.pk: taxonomy}, using)
+
+
+# Same for several taxonomies, {pk: taxonomy}, e.g. after a bulk reclassification. The moves
+# are summed per expedition and family first, so each counter is adjusted once.
+def taxonomies_saved(taxonomies, using='default'):
+    moved = (SpecimenRecord.objects.using(using).filter(taxonomy_id__in=list(taxonomies), expedition_id__isnull=False)
+             .order_by().values_list('taxonomy_id', 'expedition_id', 'family').annotate(specimens=Count('pk')))
+    deltas = Counter()
+    for taxonomy_id, expedition_id, family, specimens in moved:
+        if family != taxonomies[taxonomy_id].family:
+            deltas[expedition_id, family] -= specimens
+            deltas[expedition_id, taxonomies[taxonomy_id].family] += specimens
+    for (expedition_id, family), delta in deltas.items():
+        adjust(expedition_id, family, delta, using=using)
+
+
+# Gives a new expedition its empty stats row so it shows up in the listing
+def expedition_created(expedition, using='default'):
+    ExpeditionStats.objects.using(using).get_or_create(expedition_id=expedition.pk)
+
+
+# Recomputes every counter of one database from the read model and returns how many
+# expeditions there are and how many had drifted from the recomputed values
+def reconcile(using='default'):
+    with transaction.atomic(using=using):
+        before = {pk: (count, taxa) for pk, count, taxa in
+                  ExpeditionStats.objects.using(using).values_list('expedition_id', 'specimen_count', 'top_taxa')}
+
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM specimen_catalog_expeditiontaxoncount')
+            cursor.execute(POPULATE_TAXON_COUNTS_SQL)
+            cursor.execute('DELETE FROM specimen_catalog_expeditionstats')
+            cursor.execute(POPULATE_STATS_SQL)
+
+        # Top taxa of every expedition from one ordered pass over the taxon counts
+        taxa = {}
+        rows = (ExpeditionTaxonCount.objects.using(using).exclude(family='')
+                .order_by('expedition_id', '-specimen_count', 'family').values_list('expedition_id', 'family', 'specimen_count'))
+        for expedition_id, family, count in rows.iterator():
+            families = taxa.setdefault(expedition_id, [])
+            if len(families) < TOP_TAXA:
+                families.append({'family': family, 'specimens': count})
+        stats = list(ExpeditionStats.objects.using(using).all())
+        for row in stats:
+            row.top_taxa = taxa.get(row.expedition_id, [])
+        ExpeditionStats.objects.using(using).bulk_update(stats, ['top_taxa'], batch_size=500)
+
+    drifted = sum(before.get(row.expedition_id) != (row.specimen_count, row.top_taxa) for row in stats)
+    return {'expeditions': len(stats), 'drifted': drifted + len(set(before) - {row.expedition_id for row in stats})}
+
+
+# Reconciles the default database, or every shard when sharding is enabled
+def reconcile_all():
+    aliases = sharding.shard_aliases() if sharding.enabled() else ['default']
+    return {alias: reconcile(alias) for alias in aliases}
@@ -1,5 +1,5 @@
 import django_filters
-from .models import Specimen
+from .models import Specimen, SpecimenRecord
 
 # Filter specimens table by the following
 class SpecimenFilter(django_filters.FilterSet):
@@ -20,4 +20,19 @@ class SpecimenFilter(django_filters.FilterSet):
                   'taxonomy__family', 
                   'taxonomy__genus', 
                   'taxonomy__species'
-                  ]
\ No newline at end of file
+                  ]
+
+# Same filters as SpecimenFilter, applied to the flat SpecimenRecord read table.
+# The query parameter names are unchanged so existing links and forms keep working.
+class SpecimenRecordFilter(django_filters.FilterSet):
+    taxonomy__kingdom = django_filters.CharFilter(field_name="kingdom", label="Kingdom", lookup_expr="icontains")
+    taxonomy__phylum = django_filters.CharFilter(field_name="phylum", label="Phylum", lookup_expr="icontains")
+    taxonomy__highest_biostratigraphic_zone = django_filters.CharFilter(field_name="highest_biostratigraphic_zone", label="Sub-Phylum", lookup_expr="icontains")
+    taxonomy__class_name = django_filters.CharFilter(field_name="class_name", label="Class", lookup_expr="icontains")
+    taxonomy__family = django_filters.CharFilter(field_name="family", label="Family", lookup_expr="icontains")
+    taxonomy__genus = django_filters.CharFilter(field_name="genus", label="Genus", lookup_expr="icontains")
+    taxonomy__species = django_filters.CharFilter(field_name="species", label="Species", lookup_expr="icontains")
+
+    class Meta:
+        model = SpecimenRecord
+        fields = []
@@ -1,7 +1,7 @@
-import pycountry    # For country validation
 from django import forms
-from django.core.exceptions import ValidationError
+from django.forms.models import ModelChoiceIterator
 from .models import Specimen, Taxonomy, Expedition
+from . import taxon_index, validation, reclassify, sharding
 
 class SpecimenForm(forms.ModelForm):
     class Meta:
@@ -13,33 +13,7 @@ class SpecimenForm(forms.ModelForm):
 
     # Cleans and validate the catalog_number field
     def clean_catalog_number(self):
-       
-        # Gets the catalog_number from the cleaned_data dictionary
-        catalog_number = self.cleaned_data['catalog_number']
-
-        # Validates catalog number format (four parts separated by dots)
-        parts = catalog_number.split('.')
-
-        if len(parts) != 4:
-            # Raises a ValidationError if the format is not correct
-            raise ValidationError('Invalid catalog number format. Should have 4 parts separated by dots.')
-
-        # Defines maximum lengths for each part
-        max_lengths = [4, 2, 2, 4]
-
-        for part, max_length in zip(parts, max_lengths):
-            try:
-                # Checks if each part is a non-negative integer and within the specified maximum length
-                value = int(part)
-                if value < 0 or len(part) > max_length:
-                    # Raises a ValueError if the part is not a valid integer or exceeds the maximum length
-                    raise ValueError
-            except ValueError:
-                # Raises a ValidationError if the part is not a valid integer
-                raise ValidationError(f'Invalid catalog number. Parts must be non-negative integers with a maximum length of {max_length}.')
-
-        # Returns the cleaned catalog_number if it passes validation
-        return catalog_number
+        return validation.check_catalog_number(self.cleaned_data['catalog_number'])
 
 # Form for Expedition model, includes expedition, continent, country, state_province, and term fields
 class ExpeditionForm(forms.ModelForm):
@@ -53,76 +27,35 @@ class ExpeditionForm(forms.ModelForm):
             'country': 'Country', 
         }
 
-    ALLOWED_CONTINENTS = ['Africa', 'Antarctica', 'Asia', 'Europe', 'North America', 'Oceania', 'South America']
+    ALLOWED_CONTINENTS = validation.ALLOWED_CONTINENTS
 
     def clean_expedition(self):
-        expedition = self.cleaned_data['expedition'].strip()
-
-        # Check if the field is not empty
-        if not expedition:
-            return expedition  # No further validation needed
-
-        # Check if "expedition" is contained anywhere in the string
-        if 'expedition' not in expedition.lower():
-            raise ValidationError('Invalid expedition format. Should contain "Expedition".')
-
-        # Validate the format if "expedition" is contained in the string
-        if not expedition.lower().startswith('expedition '):
-            raise ValidationError('Invalid expedition format. Should start with "Expedition" followed by a space and another word.')
-
-        return expedition
+        return validation.check_expedition(self.cleaned_data['expedition'])
 
     def clean_continent(self):
-        continent = self.cleaned_data['continent']
         # Validates that the continent is in the list of allowed continents (case-insensitive)
-        if continent.title() not in self.ALLOWED_CONTINENTS:
-            raise ValidationError('Invalid continent entered.')
-
-        return continent
+        return validation.check_continent(self.cleaned_data['continent'])
 
     def clean_country(self):
-        country = self.cleaned_data['country']
         # Validates that the country is a valid country code or name
-        try:
-            pycountry.countries.lookup(country)
-        except LookupError:
-            raise ValidationError('Invalid country entered.')
-
-        return country
+        return validation.check_country(self.cleaned_data['country'])
 
 # Form for Taxonomy model, includes all fields
 class TaxonomyForm(forms.ModelForm):
+    # Saves names that closely resemble existing ones without asking
+    keep_names = forms.BooleanField(required=False, label='Keep names that resemble existing ones')
+
     class Meta:
         model = Taxonomy
         fields = ['kingdom', 'phylum', 'highest_biostratigraphic_zone', 'class_name',
                   'identification_description', 'family', 'genus', 'species']
 
-        labels = {
-            'kingdom': 'Kingdom',
-            'phylum': 'Phylum',
-            'highest_biostratigraphic_zone': 'Sub-phylum',
-            'class_name': 'Class',
-            'identification_description': 'Order',
-            'family': 'Family',
-            'genus': 'Genus',
-            'species': 'Species',
-        }
+        labels = validation.TAXONOMY_LABELS
 
     # Custom validation to ensure the length of a field is at least min_length characters
+    # (after stray whitespace is removed)
     def clean_field_length(self, field_name, min_length):
-
-        # Gets the field_value from the cleaned_data dictionary
-        field_value = self.cleaned_data[field_name]
-        # Gets the label for the field from the form's fields
-        label = self.fields[field_name].label
-
-        # Ensures field_value is at least min_length characters long
-        if len(field_value) < min_length:
-            # Raises a ValidationError if the length is less than min_length
-            raise ValidationError(f'{label} must be at least {min_length} characters long.')
-
-        # Returns the field_value if it passes validation
-        return field_value
+        return validation.check_taxon_name(self.cleaned_data[field_name], self.fields[field_name].label, min_length)
 
     def clean_kingdom(self):
         # Cleans and validate the 'kingdom' field length
@@ -156,6 +89,47 @@ class TaxonomyForm(forms.ModelForm):
         # Cleans and validates the 'species' field length
         return self.clean_field_length('species', 3)
 
+    def clean(self):
+        cleaned_data = super().clean()
+
+        # Suggests the existing name instead of saving a near-duplicate such as "Ammonitida"
+        # next to "Ammonitidae", unless keep_names is ticked
+        self.suggestions = {}
+        if cleaned_data.get('keep_names'):
+            return cleaned_data
+        for field_name in self.Meta.fields:
+            value = cleaned_data.get(field_name)
+            match = taxon_index.near_duplicate(field_name, value) if value else None
+            if match:
+                self.suggestions[field_name] = match[0]
+                self.add_error(field_name, f'Close to the existing name "{match[0]}" ({match[1]:.0%} similar). '
+                                           f'Use that name, or tick "{self.fields["keep_names"].label}".')
+
+        return cleaned_data
+
+# Form for the reclassify admin action: the ranks to set on the selected taxonomies
+class ReclassifyForm(forms.Form):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # One optional field per rank, left blank to keep the current names
+        for rank, label in validation.TAXONOMY_LABELS.items():
+            self.fields[rank] = forms.CharField(required=False, max_length=50, label=f'New {label.lower()}')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # The ranks to set, checked like TaxonomyForm checks them
+        self.new_values = reclassify.clean_changes({rank: name for rank, name in cleaned_data.items() if name})
+        return cleaned_data
+
+# Choices of a ModelChoiceField over a sharding.ShardedQuerySet, which merges the rows of every
+# shard but has no iterator() for the default ModelChoiceIterator to use
+class ShardedChoiceIterator(ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for obj in self.queryset:
+            yield self.choice(obj)
+
 # Form for new specimen view
 class NewSpecimenForm(forms.ModelForm):
     class Meta:
@@ -167,6 +141,14 @@ class NewSpecimenForm(forms.ModelForm):
             'taxonomy': 'Taxonomy',
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Expeditions live on the shards when sharding is enabled, so the choices are read from
+        # every shard and the chosen pk is looked up on all of them
+        if sharding.enabled():
+            self.fields['expedition'].iterator = ShardedChoiceIterator
+            self.fields['expedition'].queryset = sharding.sharded(Expedition.objects.all())
+
     def clean(self):
         # Custom validation for the entire form
 
@@ -198,9 +180,8 @@ class NewSpecimenForm(forms.ModelForm):
         # Calls the parent class's save method with commit=False to get the unsaved instance
         instance = super().save(commit=False)
 
-        # Ensures that the Specimen model has the `specimen_id` field set as AutoField(primary_key=True)
-        # This should automatically handle incrementing the specimen_id.
-        instance.specimen_id = Specimen.objects.latest('specimen_id').specimen_id + 1
+        # The specimen_id is left to the database (AutoField), or to the global sequence
+        # when sharding is enabled, so concurrent saves cannot pick the same id.
 
         # Saves the instance if commit is True
         if commit:
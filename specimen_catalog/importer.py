@@ -0,0 +1,187 @@
+import csv
+from collections import Counter
+from itertools import islice, zip_longest
+from django.db import transaction
+from .models import Expedition, Taxonomy, Specimen, SpecimenRecord
+from . import sharding, taxon_index, validation
+
+# Column headers of the museum CSV export, in the order they are written by export_csv
+CSV_COLUMNS = ['_id', 'catalogNumber', 'expedition', 'continent', 'country', 'higherClassification', 'phylum',
+               'highestBiostratigraphicZone', 'class', 'identificationDescription', 'family', 'genus',
+               'determinationNames']
+
+# Taxonomy field filled from each taxon column of the CSV
+CSV_RANKS = {'higherClassification': 'kingdom', 'phylum': 'phylum',
+             'highestBiostratigraphicZone': 'highest_biostratigraphic_zone', 'class': 'class_name',
+             'identificationDescription': 'identification_description', 'family': 'family', 'genus': 'genus',
+             'determinationNames': 'species'}
+
+# CSV column validated for each form field
+FIELD_COLUMNS = {'catalog_number': 'catalogNumber', 'expedition': 'expedition', 'continent': 'continent',
+                 'country': 'country', **{field: column for column, field in CSV_RANKS.items()}}
+
+# Columns of the report written by reconcile_csv
+REPORT_COLUMNS = ['column', 'value', 'rows', 'status', 'match', 'score', 'alternatives']
+
+
+# Imports one CSV row, returning the specimen and whether it was created.
+# Values are stripped like validate_rows reads them; taxon names are then normalised and
+# replaced through corrections, {(field, name): existing name}, as built by corrections_from_report.
+def import_row(row, corrections=None):
+    row = {column: validation.clean_value(value) for column, value in row.items()}
+
+    # The following code retrieves or creates instances from the database
+    # and assigns each field from the CSV file to the model
+
+    # Expedition table (on the shard of its continent when sharding is enabled)
+    expedition, created = Expedition.objects.db_manager(sharding.database_for_continent(row['continent'])).get_or_create(
+        expedition=row['expedition'],
+        continent=row['continent'],
+        country=row['country'],
+    )
+
+    # Taxonomy table
+    names = {field: taxon_index.normalise(row[column]) for column, field in CSV_RANKS.items()}
+    if corrections:
+        names = {field: corrections.get((field, name), name) for field, name in names.items()}
+    taxonomy, created = Taxonomy.objects.get_or_create(**names)
+
+    # Specimen table (stored next to its expedition)
+    return Specimen.objects.db_manager(expedition._state.db).get_or_create(
+        specimen_id=row['_id'],  # Takes the CSV index column
+        defaults={
+            'catalog_number': row['catalogNumber'],
+            'expedition': expedition,
+            'taxonomy': taxonomy,
+        }
+    )
+
+
+# Imports rows (dicts keyed by CSV column) in one transaction and returns how many specimens were created
+def import_rows(rows, corrections=None):
+    created = 0
+    with transaction.atomic():
+        for row in rows:
+            created += import_row(row, corrections)[1]
+    return created
+
+
+# Writes rows (dicts keyed by CSV column) to a CSV file that import_csv can read
+def write_rows(data_file, rows):
+    with open(data_file, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# Checks rows (dicts keyed by CSV column) against the form rules and returns a validation.ErrorTable
+def validate_rows(rows):
+    return validation.validate_columns({field: [row.get(column) for row in rows] for field, column in FIELD_COLUMNS.items()})
+
+
+# Checks every row of a CSV file against the form rules without writing anything and returns a
+# validation.ErrorTable; its rows count data rows from 0. The file is read column-wise.
+def validate_csv(data_file):
+    with open(data_file, 'r', newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, [])
+        columns = dict(zip(header, zip_longest(*reader, fillvalue='')))
+
+    row_count = len(next(iter(columns.values()), ()))
+    return validation.validate_columns({field: columns.get(column, [''] * row_count)
+                                        for field, column in FIELD_COLUMNS.items()})
+
+
+# Imports every row of a CSV file and returns the number of rows.
+# Without batch_size the whole file is one transaction; otherwise a transaction is committed
+# every batch_size rows. on_row(count, row, created) is called after each row, e.g. to report progress.
+# With validate the whole file is checked first, and validation.BatchValidationError is raised
+# before anything is written if any row breaks the form rules.
+def import_csv(data_file, on_row=None, batch_size=None, corrections=None, validate=False):
+    if validate:
+        table = validate_csv(data_file)
+        if table:
+            raise validation.BatchValidationError(table)
+
+    with open(data_file, 'r') as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+
+        # Initializes a counter for tracking progress
+        count = 0
+
+        while True:
+            batch = list(islice(csv_reader, batch_size)) if batch_size else list(csv_reader)
+            if not batch:
+                break
+
+            # Starts a database transaction
+            with transaction.atomic():
+                # Iterates over each row
+                for row in batch:
+                    count += 1
+                    specimen, created = import_row(row, corrections)
+                    if on_row:
+                        on_row(count, row, created)
+
+            if not batch_size:
+                break
+
+    return count
+
+
+# Writes every specimen to a CSV file with the same columns import_csv reads and returns the row count.
+# Rows come from the flat SpecimenRecord table, so the export needs no joins.
+def export_csv(data_file, queryset=None, on_row=None):
+    queryset = SpecimenRecord.objects.order_by('specimen_id') if queryset is None else queryset
+    count = 0
+
+    with open(data_file, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_COLUMNS)
+        for record in queryset.iterator(chunk_size=2000):
+            count += 1
+            writer.writerow([
+                record.specimen_id, record.catalog_number, record.expedition_name, record.continent,
+                record.country, record.kingdom, record.phylum, record.highest_biostratigraphic_zone,
+                record.class_name, record.identification_description, record.family, record.genus,
+                record.species,
+            ])
+            if on_row:
+                on_row(count, record)
+
+    return count
+
+
+# Matches every distinct taxon name of a CSV file against the existing names of its rank and
+# returns one report row per column and name, also written to report_file when given. Each name
+# is matched once however many rows use it, in `workers` processes (see taxon_index.match_many).
+def reconcile_csv(data_file, report_file=None, threshold=None, workers=1):
+    occurrences = {column: Counter() for column in CSV_RANKS}
+    with open(data_file, 'r') as csv_file:
+        for row in csv.DictReader(csv_file):
+            for column in CSV_RANKS:
+                if row.get(column):
+                    occurrences[column][row[column]] += 1
+
+    results = taxon_index.match_many({CSV_RANKS[column]: list(names) for column, names in occurrences.items()},
+                                     threshold=threshold, workers=workers)
+    report = []
+    for column, names in occurrences.items():
+        for name, rows in names.most_common():
+            status, match, score, alternatives = results[CSV_RANKS[column]][name]
+            report.append({'column': column, 'value': name, 'rows': rows, 'status': status, 'match': match or '',
+                           'score': score if score is not None else '', 'alternatives': '; '.join(alternatives)})
+
+    if report_file:
+        with open(report_file, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(report)
+    return report
+
+
+# Corrections for import_csv from a reconcile_csv report: variants and fuzzy matches scoring
+# at least min_score are replaced by the existing name
+def corrections_from_report(report, min_score):
+    return {(CSV_RANKS[row['column']], taxon_index.normalise(row['value'])): row['match'] for row in report
+            if row['status'] in ('variant', 'fuzzy') and row['score'] >= min_score}
@@ -0,0 +1,119 @@
+import time
+from contextvars import ContextVar
+
+# Timings of the request being handled, or None outside an instrumented request
+_current = ContextVar('request_timings', default=None)
+
+_installed = False
+_query_timing_installed = False
+
+
+# What one request spent its time on
+class RequestTimings:
+    __slots__ = ('started', 'queries', 'db_time', 'template_time', 'serialize_time', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.serialize_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    # The slowest statements as (seconds, sql), slowest first
+    def slowest_queries(self, count):
+        return sorted(self.queries, key=lambda query: query[0], reverse=True)[:count]
+
+
+def start():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+# Wraps CursorWrapper._execute_with_wrappers, which every execute() and executemany() goes
+# through, so each statement of the current request is timed
+def _timed_statements(function):
+    def wrapper(self, sql, params, many, executor):
+        timings = _current.get()
+        if timings is None:
+            return function(self, sql, params, many, executor)
+
+        started = time.perf_counter()
+        try:
+            return function(self, sql, params, many, executor)
+        finally:
+            duration = time.perf_counter() - started
+            timings.db_time += duration
+            timings.queries.append((duration, sql))
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+# Times the SQL statements of instrumented requests. The cursor class is hooked rather than
+# each connection, as connections are per thread and under ASGI sync views query from threads
+# the middleware does not run in; the timings follow the request there in a ContextVar.
+def install_query_timing():
+    global _query_timing_installed
+    if _query_timing_installed:
+        return
+    _query_timing_installed = True
+
+    from django.db.backends.utils import CursorWrapper
+    CursorWrapper._execute_with_wrappers = _timed_statements(CursorWrapper._execute_with_wrappers)
+
+
+# Counts a cache lookup of the current request
+def record_cache(hit):
+    timings = _current.get()
+    if timings is not None:
+        if hit:
+            timings.cache_hits += 1
+        else:
+            timings.cache_misses += 1
+
+
+# Wraps a function so its duration is added to one RequestTimings field
+def _timed(function, field):
+    def wrapper(*args, **kwargs):
+        timings = _current.get()
+        if timings is None:
+            return function(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            setattr(timings, field, getattr(timings, field) + time.perf_counter() - started)
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+# Hooks SQL statements, template rendering and DRF serialisation. Called once at startup, only
+# when SERVER_TIMING is enabled, so a disabled deployment runs the unpatched code.
+def install():
+    global _installed
+    install_query_timing()
+    if _installed:
+        return
+    _installed = True
+
+    from django.template.backends.django import Template
+    from rest_framework import serializers
+
+    # The backend template is what render() and TemplateResponse call; nested includes are not counted twice
+    Template.render = _timed(Template.render, 'template_time')
+
+    # Serializer.data and ListSerializer.data are the top-level entry points of serialisation
+    for serializer_class in (serializers.Serializer, serializers.ListSerializer):
+        serializer_class.data = property(_timed(serializer_class.data.fget, 'serialize_time'))
@@ -0,0 +1,277 @@
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import Job, Specimen, SpecimenRecord
+from . import importer, read_model, analytics, expedition_stats, neighbours
+from .metrics import process_alive
+
+logger = logging.getLogger('specimen_catalog.jobs')
+
+# Minimum number of seconds between two progress writes of the same job
+PROGRESS_INTERVAL = 0.5
+
+# Number of specimens removed per DELETE by bulk_delete jobs
+DELETE_BATCH_SIZE = 500
+
+# Registered job handlers, keyed by Job.kind
+HANDLERS = {}
+
+
+# Registers a function as the handler of a job kind
+def handler(kind):
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+# Queues a job and returns it; a run_jobs worker picks it up
+def enqueue(kind, **params):
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    return Job.objects.create(kind=kind, params=params)
+
+
+# Directory where files read by import jobs must live
+def import_dir():
+    return Path(getattr(settings, 'JOB_IMPORT_DIR', settings.BASE_DIR / 'var' / 'imports'))
+
+
+# A file inside the import directory; paths leading outside it are refused
+def import_file(path):
+    base = import_dir().resolve()
+    data_file = (base / path).resolve()
+    if base not in data_file.parents:
+        raise ValueError(f'{path} is outside the import directory.')
+    return data_file
+
+
+# Writes rows to a new CSV file in the import directory and returns its path relative to it
+def write_import_file(rows, prefix='bulk'):
+    directory = import_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f'{prefix}-{uuid.uuid4().hex}.csv'
+    importer.write_rows(directory / name, rows)
+    return name
+
+
+# Directory where export jobs write their files
+def export_dir():
+    return Path(getattr(settings, 'JOB_EXPORT_DIR', settings.BASE_DIR / 'var' / 'exports'))
+
+
+# Handed to job handlers so they can report progress without writing on every row
+class JobContext:
+    def __init__(self, job):
+        self.job = job
+        self.processed = 0
+        self.total = None
+        self._last_write = 0.0
+
+    def set_total(self, total):
+        self.total = total
+        self.flush()
+
+    def advance(self, count=1):
+        self.processed += count
+        if time.monotonic() - self._last_write >= PROGRESS_INTERVAL:
+            self.flush()
+
+    # Writes the current progress to the job row
+    def flush(self):
+        Job.objects.filter(pk=self.job.pk).update(processed=self.processed, total=self.total)
+        self._last_write = time.monotonic()
+
+
+# Claims the oldest queued job for this worker, or returns None if the queue is empty.
+# The conditional UPDATE only succeeds for one worker, so a job never runs twice.
+def claim_next(worker):
+    for job_id in Job.objects.filter(status=Job.QUEUED).order_by('id').values_list('id', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=job_id, status=Job.QUEUED).update(
+            status=Job.RUNNING, worker=worker, started=timezone.now())
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+# Runs one claimed job and records its result or error
+def run_job(job):
+    context = JobContext(job)
+    try:
+        result = HANDLERS[job.kind](context, **job.params)
+    except Exception:
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.FAILED, error=traceback.format_exc(), processed=context.processed,
+            total=context.total, finished=timezone.now())
+    else:
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.DONE, result=result, processed=context.processed,
+            total=context.total, finished=timezone.now())
+    job.refresh_from_db()
+    return job
+
+
+# Runs queued jobs until the queue is empty and returns how many were run
+def run_pending(worker=None):
+    worker = worker or default_worker_name()
+    count = 0
+    while True:
+        job = claim_next(worker)
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
+
+
+# Keeps running jobs until stop is set, sleeping between polls of an empty queue. An error
+# outside a job (a locked database, a dropped connection) is logged and the worker carries on
+# after a poll interval with a new connection, instead of the thread ending.
+def work(worker, stop, poll_interval=1.0):
+    try:
+        while not stop.is_set():
+            try:
+                ran = run_pending(worker)
+            except Exception:
+                logger.exception('Job worker %s failed to poll the queue', worker)
+                connection.close()
+                ran = 0
+            if not ran:
+                stop.wait(poll_interval)
+    finally:
+        connection.close()
+
+
+# Fails running jobs that no worker will finish: those claimed by a worker process of this host
+# that has exited, and those started more than JOB_RUNNING_TIMEOUT seconds ago. They are not
+# requeued, as an import may have committed part of its rows. Returns how many were failed.
+def fail_abandoned():
+    host = socket.gethostname()
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'JOB_RUNNING_TIMEOUT', 6 * 60 * 60))
+    abandoned = []
+    for job_id, worker, started in Job.objects.filter(status=Job.RUNNING).values_list('id', 'worker', 'started'):
+        worker_host, _, rest = worker.partition(':')
+        pid = rest.partition(':')[0]
+        if worker_host == host and pid.isdigit() and not process_alive(int(pid)):
+            abandoned.append((job_id, f'Worker {worker} exited while the job was running.'))
+        elif started is not None and started < cutoff:
+            abandoned.append((job_id, f'Job did not finish within JOB_RUNNING_TIMEOUT on worker {worker}.'))
+
+    failed = 0
+    for job_id, error in abandoned:
+        failed += Job.objects.filter(pk=job_id, status=Job.RUNNING).update(
+            status=Job.FAILED, error=error, finished=timezone.now())
+    return failed
+
+
+# Identifies a worker thread in Job.worker
+def default_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+
+
+# Job handlers
+
+@handler('import_csv')
+def import_csv_job(context, path, batch_size=1000, reconcile_above=None, validate=False, remove=False):
+    data_file = import_file(path)
+
+    with open(data_file) as csv_file:
+        context.set_total(max(sum(1 for _ in csv_file) - 1, 0))
+
+    # Optionally maps near-duplicate taxon names onto the existing ones first
+    corrections = None
+    if reconcile_above is not None:
+        corrections = importer.corrections_from_report(importer.reconcile_csv(data_file), reconcile_above)
+
+    created = 0
+
+    def on_row(count, row, was_created):
+        nonlocal created
+        created += was_created
+        context.advance()
+
+    # Commits in batches so progress and imported rows become visible while the job runs.
+    # With validate the job fails before the first batch if any row breaks the form rules.
+    rows = importer.import_csv(data_file, on_row=on_row, batch_size=batch_size, corrections=corrections,
+                               validate=validate)
+    # Files written for the job by the bulk API are removed once imported
+    if remove:
+        data_file.unlink()
+    return {'rows': rows, 'created': created, 'corrected': len(corrections or {})}
+
+
+@handler('reconcile_taxa')
+def reconcile_taxa_job(context, path, workers=1, threshold=None):
+    data_file = import_file(path)
+    directory = export_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    report_file = directory / f'reconcile-{context.job.pk}.csv'
+
+    report = importer.reconcile_csv(data_file, report_file, threshold=threshold, workers=workers)
+    context.advance(len(report))
+    return {'names': len(report), 'report': str(report_file),
+            'statuses': dict(Counter(row['status'] for row in report))}
+
+
+@handler('export_csv')
+def export_csv_job(context, filename=None):
+    directory = export_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    data_file = directory / os.path.basename(filename or f'specimens-{context.job.pk}.csv')
+
+    context.set_total(SpecimenRecord.objects.count())
+    rows = importer.export_csv(data_file, on_row=lambda count, record: context.advance())
+    return {'rows': rows, 'file': str(data_file)}
+
+
+@handler('rebuild_records')
+def rebuild_records_job(context):
+    context.set_total(Specimen.objects.count())
+    rows = read_model.rebuild()
+    context.advance(rows)
+    return {'rows': rows}
+
+
+@handler('build_snapshot')
+def build_snapshot_job(context):
+    path = analytics.build_snapshot()
+    rows = analytics.Snapshot(path).rows
+    context.advance(rows)
+    return {'rows': rows, 'snapshot': path.name}
+
+
+@handler('reconcile_expedition_stats')
+def reconcile_expedition_stats_job(context):
+    results = expedition_stats.reconcile_all()
+    context.advance(sum(result['expeditions'] for result in results.values()))
+    return results
+
+
+@handler('rebuild_related_specimens')
+def rebuild_related_specimens_job(context):
+    results = neighbours.rebuild_all()
+    context.advance(sum(results.values()))
+    return {'groups': results}
+
+
+@handler('bulk_delete')
+def bulk_delete_job(context, specimen_ids):
+    # Deletes in batches through the ORM so the read model and change feed stay in step
+    context.set_total(len(specimen_ids))
+    deleted = 0
+    for start in range(0, len(specimen_ids), DELETE_BATCH_SIZE):
+        batch = specimen_ids[start:start + DELETE_BATCH_SIZE]
+        deleted += Specimen.objects.filter(pk__in=batch).delete()[1].get('specimen_catalog.Specimen', 0)
+        context.advance(len(batch))
+    return {'deleted': deleted}
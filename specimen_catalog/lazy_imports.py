@@ -0,0 +1,26 @@
+import importlib.util
+import sys
+
+
+# Returns a module that is only executed on first attribute access, so importing a module that
+# needs a heavy dependency (numpy, pycountry) for a few code paths does not pay for it at boot.
+# The placeholder is registered in sys.modules, so later plain imports share the same module.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# True once a module has really been executed, not just registered by lazy_import
+def is_loaded(name):
+    module = sys.modules.get(name)
+    return module is not None and not isinstance(module, importlib.util._LazyModule)
@@ -0,0 +1,157 @@
+import json
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from specimen_catalog.database import apply_pragmas
+
+# Page of the all specimens listing, as AllSpecimensView queried it before the read model
+READ_SQL = """
+    SELECT s.specimen_id, s.catalog_number, t.kingdom, t.family, t.genus, t.species, e.continent, e.country
+    FROM specimen_catalog_specimen s
+    LEFT JOIN specimen_catalog_taxonomy t ON t.taxonomy_id = s.taxonomy_id
+    LEFT JOIN specimen_catalog_expedition e ON e.expedition_id = s.expedition_id
+    ORDER BY s.specimen_id DESC LIMIT 20 OFFSET ?
+"""
+COUNT_SQL = "SELECT COUNT(*) FROM specimen_catalog_specimen"
+WRITE_SQL = "UPDATE specimen_catalog_specimen SET catalog_number = ? WHERE specimen_id = ?"
+
+
+# Opens SQLite connections the way Django does for one database profile
+class ProfileConnections:
+    def __init__(self, path, profile):
+        self.path = path
+        self.timeout = profile.get('OPTIONS', {}).get('timeout', 5)
+        self.pragmas = profile.get('PRAGMAS', {})
+        self.persistent = bool(profile.get('CONN_MAX_AGE'))
+        self.local = threading.local()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection.cursor(), self.pragmas)
+        return connection
+
+    # Runs fn(connection), reusing a per-thread connection only when the profile keeps them open
+    def run(self, fn):
+        if self.persistent:
+            if getattr(self.local, 'connection', None) is None:
+                self.local.connection = self.connect()
+            return fn(self.local.connection)
+
+        connection = self.connect()
+        try:
+            return fn(connection)
+        finally:
+            connection.close()
+
+
+# Compares mixed read/write throughput of the database profiles in settings.DATABASE_PROFILES
+class Command(BaseCommand):
+    help = 'Benchmarks mixed read/write throughput of the SQLite database profiles on a copy of the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', default=','.join(settings.DATABASE_PROFILES),
+                            help='Comma-separated profiles to compare.')
+        parser.add_argument('--seconds', type=float, default=5.0, help='Duration of each run.')
+        parser.add_argument('--readers', type=int, default=4, help='Number of concurrent reader threads.')
+        parser.add_argument('--writers', type=int, default=1, help='Number of concurrent writer threads.')
+        parser.add_argument('--source', default=str(settings.DATABASES['default']['NAME']),
+                            help='SQLite file to copy for the benchmark (never modified).')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        profiles = [name for name in options['profiles'].split(',') if name]
+        unknown = [name for name in profiles if name not in settings.DATABASE_PROFILES]
+        if unknown:
+            raise CommandError(f"Unknown profile(s): {', '.join(unknown)}")
+
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            for name in profiles:
+                path = str(Path(directory) / f'{name}.sqlite3')
+                self.copy_database(options['source'], path)
+                results.append(self.run_profile(name, path, options))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'profile':<10} {'reads/s':>10} {'writes/s':>10} {'read p95 ms':>12} {'write p95 ms':>13} {'locked':>7}")
+        for result in results:
+            self.stdout.write(
+                f"{result['profile']:<10} {result['reads_per_second']:>10.1f} {result['writes_per_second']:>10.1f} "
+                f"{result['read_p95_ms']:>12.2f} {result['write_p95_ms']:>13.2f} {result['locked_errors']:>7}")
+
+    # Copies the source database with the online backup API and resets it to rollback-journal mode
+    def copy_database(self, source, path):
+        with sqlite3.connect(source) as source_connection, sqlite3.connect(path) as target_connection:
+            source_connection.backup(target_connection)
+            target_connection.execute('PRAGMA journal_mode = DELETE')
+
+    def run_profile(self, name, path, options):
+        connections = ProfileConnections(path, settings.DATABASE_PROFILES[name])
+        specimen_ids = connections.run(
+            lambda connection: [row[0] for row in connection.execute('SELECT specimen_id FROM specimen_catalog_specimen')])
+        if not specimen_ids:
+            raise CommandError('The source database has no specimens to benchmark with.')
+
+        stop = threading.Event()
+        lock = threading.Lock()
+        timings = {'read': [], 'write': []}
+        errors = {'locked': 0}
+
+        def read(connection):
+            connection.execute(COUNT_SQL).fetchone()
+            connection.execute(READ_SQL, (random.randrange(0, max(len(specimen_ids) - 20, 1)),)).fetchall()
+
+        def write(connection):
+            connection.execute(WRITE_SQL, (f'{random.randrange(10000):04d}.01.01.0001', random.choice(specimen_ids)))
+
+        def loop(kind, operation):
+            local_timings = []
+            local_errors = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    connections.run(operation)
+                except sqlite3.OperationalError as error:
+                    if 'locked' not in str(error):
+                        raise
+                    local_errors += 1
+                    continue
+                local_timings.append(time.perf_counter() - started)
+            with lock:
+                timings[kind].extend(local_timings)
+                errors['locked'] += local_errors
+
+        threads = [threading.Thread(target=loop, args=('read', read)) for _ in range(options['readers'])]
+        threads += [threading.Thread(target=loop, args=('write', write)) for _ in range(options['writers'])]
+        for thread in threads:
+            thread.start()
+        time.sleep(options['seconds'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        return {
+            'profile': name,
+            'reads_per_second': len(timings['read']) / options['seconds'],
+            'writes_per_second': len(timings['write']) / options['seconds'],
+            'read_p95_ms': percentile(timings['read'], 95) * 1000,
+            'write_p95_ms': percentile(timings['write'], 95) * 1000,
+            'locked_errors': errors['locked'],
+        }
+
+
+# Returns the given percentile of a list of durations (0 when empty)
+def percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[percent - 1]
@@ -0,0 +1,255 @@
+import json
+import platform
+import re
+import time
+import tracemalloc
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import reverse
+
+from specimen_catalog.models import (Expedition, ExpeditionStats, ExpeditionTaxonCount, NeighbourGroup, Taxonomy, Specimen,
+                                     SpecimenRecord, Change, DataVersion)
+from specimen_catalog.management.commands.benchmark_database import percentile
+from specimen_catalog import synthetic
+
+# Endpoint and filter combinations measured at every scale. Detail cases are filled in with
+# a specimen from the middle of the dataset, 'frequent' filters with the field's most common
+# value (they are left out against a server); admin cases run as a superuser.
+CASES = [
+    {'name': 'all_specimens', 'url_name': 'all_specimens'},
+    {'name': 'all_specimens_deep_page', 'url_name': 'all_specimens', 'params': {'page': 'middle'}},
+    {'name': 'all_specimens_continent', 'url_name': 'all_specimens', 'params': {'expedition__continent': 'Asia'}},
+    {'name': 'all_specimens_family', 'url_name': 'all_specimens', 'params': {'taxonomy__family': 'frequent'}},
+    {'name': 'all_specimens_combined', 'url_name': 'all_specimens',
+     'params': {'expedition__continent': 'Europe', 'taxonomy__kingdom': 'Animalia', 'taxonomy__genus': 'frequent'}},
+    {'name': 'specimen_detail', 'url_name': 'specimen_detail', 'detail': True},
+    {'name': 'api_specimen_page', 'url_name': 'specimen-list', 'params': {'limit': '100'}},
+    {'name': 'api_specimen_detail', 'url_name': 'specimen-detail', 'detail': True},
+    {'name': 'api_expedition_list', 'url_name': 'expedition-list'},
+    {'name': 'api_taxonomy_list', 'url_name': 'taxonomy-list'},
+    {'name': 'admin_specimen_changelist', 'url_name': 'admin:specimen_catalog_specimen_changelist', 'admin': True},
+    {'name': 'admin_specimen_search', 'url_name': 'admin:specimen_catalog_specimen_changelist', 'admin': True,
+     'params': {'q': '.42'}},
+]
+
+# Fills the catalogue with a reproducible synthetic dataset of the given number of specimens
+def build_dataset(scale, seed=0):
+    synthetic.generate(scale, taxa=max(scale // 20, 10), expeditions=max(scale // 100, 6), seed=seed)
+
+
+# The most common value of a specimen field, so filter cases hit the head of the Zipf skew
+def frequent_value(field):
+    row = Specimen.objects.values(field).annotate(specimens=Count('pk')).order_by('-specimens').first()
+    return row[field] if row else None
+
+
+def clear_dataset():
+    for model in (SpecimenRecord, NeighbourGroup, ExpeditionTaxonCount, ExpeditionStats, Specimen, Expedition, Taxonomy,
+                  Change, DataVersion):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {model._meta.db_table}')
+    cache.clear()
+
+
+# Measures latency percentiles, query count and peak Python memory of endpoints, either through
+# the Django test client on generated datasets of several sizes, or against a running server
+class Command(BaseCommand):
+    help = 'Benchmarks the main pages and API endpoints at several dataset scales and compares against a baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1000,10000,100000', help='Comma-separated specimen counts.')
+        parser.add_argument('--cases', default='', help='Comma-separated case names (default: all).')
+        parser.add_argument('--iterations', type=int, default=20, help='Timed requests per case.')
+        parser.add_argument('--warmup', type=int, default=2, help='Untimed requests per case before timing.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic datasets.')
+        parser.add_argument('--server', default='',
+                            help='Base URL of a running server to benchmark instead of the test client '
+                                 '(uses its data; query counts come from Server-Timing when enabled).')
+        parser.add_argument('--output', default=str(settings.BASE_DIR / 'var' / 'benchmarks' / 'latest.json'),
+                            help='Where to write the machine-readable results.')
+        parser.add_argument('--baseline', default=str(settings.BASE_DIR / 'benchmarks' / 'baseline.json'),
+                            help='Baseline results to compare against.')
+        parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative p95 increase over the baseline before flagging a regression.')
+        parser.add_argument('--fail-on-regression', action='store_true', help='Exit with an error on regressions.')
+
+    def handle(self, *args, **options):
+        cases = CASES
+        if options['cases']:
+            names = options['cases'].split(',')
+            cases = [case for case in CASES if case['name'] in names]
+            if len(cases) != len(names):
+                raise CommandError(f"Unknown case(s): {', '.join(set(names) - {case['name'] for case in CASES})}")
+
+        if options['server']:
+            results = self.run_server(options['server'].rstrip('/'), cases, options)
+        else:
+            results = self.run_test_client([int(scale) for scale in options['scales'].split(',') if scale], cases, options)
+
+        report = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'iterations': options['iterations'],
+            'results': results,
+        }
+        regressions = self.compare(results, Path(options['baseline']), options['tolerance'])
+        report['regressions'] = regressions
+
+        output = Path(options['output'])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        self.print_results(results)
+        self.stdout.write(f'Results written to {output}')
+
+        # The baseline keeps this run's measurements only, not their comparison with the previous one
+        if options['save_baseline']:
+            baseline = {**report, 'results': [{key: value for key, value in result.items() if key != 'baseline_p95_ms'}
+                                              for result in results]}
+            del baseline['regressions']
+            Path(options['baseline']).parent.mkdir(parents=True, exist_ok=True)
+            Path(options['baseline']).write_text(json.dumps(baseline, indent=2))
+            self.stdout.write(f"Baseline saved to {options['baseline']}")
+
+        if regressions:
+            for regression in regressions:
+                self.stdout.write(self.style.WARNING(f'Regression: {regression}'))
+            if options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regression(s) against the baseline.')
+
+    # Builds each dataset in a throwaway test database and measures every case through the test client
+    def run_test_client(self, scales, cases, options):
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            results = []
+            for scale in scales:
+                clear_dataset()
+                started = time.perf_counter()
+                build_dataset(scale, options['seed'])
+                self.stderr.write(f'Built {scale} specimens in {time.perf_counter() - started:.1f}s')
+
+                client = Client()
+                admin_client = Client()
+                admin_client.force_login(User.objects.get_or_create(
+                    username='benchmark', defaults={'is_staff': True, 'is_superuser': True})[0])
+
+                middle = scale // 2 or 1
+                frequent = {field: frequent_value(field) for case in cases
+                            for field, value in case.get('params', {}).items() if value == 'frequent'}
+                for case in cases:
+                    path = self.case_path(case, middle, pages=max(scale // 20, 1), frequent=frequent)
+                    result = self.measure_client(admin_client if case.get('admin') else client, path, options)
+                    results.append({'scale': scale, 'case': case['name'], 'path': path, **result})
+            return results
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+    def case_path(self, case, detail_pk, pages=1, frequent=None):
+        path = reverse(case['url_name'], kwargs={'pk': detail_pk} if case.get('detail') else None)
+        values = {'middle': str(pages // 2 or 1)}
+        params = {name: (values[value] if value in values else frequent.get(name) if value == 'frequent' else value)
+                  for name, value in case.get('params', {}).items() if value != 'frequent' or frequent}
+        if params:
+            path += '?' + '&'.join(f'{name}={value}' for name, value in params.items())
+        return path
+
+    def measure_client(self, client, path, options):
+        for _ in range(options['warmup']):
+            client.get(path)
+
+        # Counts statements with an execute wrapper, as the query log is reset at every request start
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            response = client.get(path)
+        if response.status_code != 200:
+            raise CommandError(f'{path} returned {response.status_code}.')
+
+        tracemalloc.start()
+        client.get(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        latencies = []
+        for _ in range(options['iterations']):
+            started = time.perf_counter()
+            client.get(path)
+            latencies.append(time.perf_counter() - started)
+
+        return {**latency_summary(latencies), 'queries': len(queries), 'peak_memory_kb': peak // 1024}
+
+    # Measures the cases over HTTP against a running server and whatever data it serves
+    def run_server(self, base_url, cases, options):
+        with urllib.request.urlopen(f"{base_url}{reverse('specimen-list')}?limit=1") as response:
+            rows = json.load(response)
+        if not rows:
+            raise CommandError('The server has no specimens to benchmark with.')
+
+        results = []
+        for case in cases:
+            if case.get('admin'):
+                continue
+            path = self.case_path(case, rows[0]['specimen_id'])
+            for _ in range(options['warmup']):
+                urllib.request.urlopen(base_url + path).read()
+
+            latencies = []
+            queries = None
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                with urllib.request.urlopen(base_url + path) as response:
+                    response.read()
+                    timing = re.search(r'db;desc="(\d+) queries"', response.headers.get('Server-Timing', ''))
+                latencies.append(time.perf_counter() - started)
+                queries = int(timing.group(1)) if timing else None
+
+            results.append({'scale': 'server', 'case': case['name'], 'path': path, **latency_summary(latencies),
+                            'queries': queries, 'peak_memory_kb': None})
+        return results
+
+    # Flags cases whose p95 grew beyond the tolerance (and by at least 2 ms) or that run more queries
+    def compare(self, results, baseline_path, tolerance):
+        if not baseline_path.exists():
+            return []
+        baseline = {(str(result['scale']), result['case']): result
+                    for result in json.loads(baseline_path.read_text())['results']}
+
+        regressions = []
+        for result in results:
+            base = baseline.get((str(result['scale']), result['case']))
+            if base is None:
+                continue
+            result['baseline_p95_ms'] = base['p95_ms']
+            if result['p95_ms'] > base['p95_ms'] * (1 + tolerance) and result['p95_ms'] - base['p95_ms'] >= 2:
+                regressions.append(f"{result['case']} at {result['scale']}: p95 {base['p95_ms']:.1f} -> {result['p95_ms']:.1f} ms")
+            if result['queries'] is not None and base['queries'] is not None and result['queries'] > base['queries']:
+                regressions.append(f"{result['case']} at {result['scale']}: {base['queries']} -> {result['queries']} queries")
+        return regressions
+
+    def print_results(self, results):
+        self.stdout.write(f"{'scale':>8} {'case':<28} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'peak KB':>8} {'base p95':>9}")
+        for result in results:
+            base = f"{result['baseline_p95_ms']:.1f}" if 'baseline_p95_ms' in result else '-'
+            self.stdout.write(
+                f"{result['scale']:>8} {result['case']:<28} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+                f"{result['p99_ms']:>8.1f} {str(result['queries']):>8} {str(result['peak_memory_kb']):>8} {base:>9}")
+
+
+def latency_summary(latencies):
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from specimen_catalog.models import Specimen
+from specimen_catalog.management.commands.benchmark_database import percentile
+
+# How each deployment is started; {workers} and {bind} are filled in per run
+SERVERS = {
+    'wsgi': ['-m', 'gunicorn', 'natural_history_project.wsgi:application',
+             '--workers', '{workers}', '--bind', '{bind}'],
+    'asgi': ['-m', 'gunicorn', 'natural_history_project.asgi:application',
+             '--workers', '{workers}', '--bind', '{bind}', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+
+# Endpoints that have both a DRF view and an async view named async-<name>
+ENDPOINTS = ['specimen-list', 'specimen-detail', 'expedition-list', 'expedition-detail',
+             'taxonomy-list', 'taxonomy-detail']
+
+
+# Returns a free local TCP port
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Sends one GET request over a new connection and returns the response status.
+# A slow client trickles its request over slow_delay seconds, like a client on a bad network.
+async def fetch(port, host, path, slow_delay=0.0):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        request = f'GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n'.encode()
+        if slow_delay:
+            writer.write(request[:10])
+            await writer.drain()
+            await asyncio.sleep(slow_delay)
+        writer.write(request[10:] if slow_delay else request)
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+# Compares how many concurrent connections the WSGI (sync workers) and ASGI (uvicorn workers)
+# deployments sustain, and their p99 latency, on the sync and async variants of one endpoint
+class Command(BaseCommand):
+    help = 'Load-tests the WSGI deployment against the ASGI deployment at increasing concurrency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', default='specimen-detail', choices=ENDPOINTS,
+                            help='Endpoint to load; the ASGI run uses its async variant.')
+        parser.add_argument('--servers', default='wsgi,asgi', help='Comma-separated deployments to compare.')
+        parser.add_argument('--workers', type=int, default=2, help='Worker processes per server.')
+        parser.add_argument('--levels', default='10,50,100,200', help='Comma-separated concurrent connection counts.')
+        parser.add_argument('--seconds', type=float, default=5.0, help='Duration of each concurrency level.')
+        parser.add_argument('--slow-clients', type=int, default=0,
+                            help='Extra connections that trickle their requests in, to hold server workers.')
+        parser.add_argument('--slow-delay', type=float, default=1.0, help='Seconds a slow client takes to send a request.')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Seconds before a request counts as failed.')
+        parser.add_argument('--p99-limit', type=float, default=1000.0,
+                            help='p99 latency (ms) a level must stay under to count towards capacity.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        servers = [name for name in options['servers'].split(',') if name]
+        unknown = [name for name in servers if name not in SERVERS]
+        if unknown:
+            raise CommandError(f"Unknown server(s): {', '.join(unknown)}")
+        levels = [int(level) for level in options['levels'].split(',') if level]
+
+        kwargs = {}
+        if options['endpoint'].endswith('-detail'):
+            specimen = Specimen.objects.exclude(expedition=None).exclude(taxonomy=None).first()
+            if specimen is None:
+                raise CommandError('The database has no specimen with an expedition and taxonomy to benchmark with.')
+            kwargs = {'pk': {'specimen-detail': specimen.pk, 'expedition-detail': specimen.expedition_id,
+                             'taxonomy-detail': specimen.taxonomy_id}[options['endpoint']]}
+
+        results = []
+        for name in servers:
+            endpoint = options['endpoint'] if name == 'wsgi' else f"async-{options['endpoint']}"
+            path = reverse(endpoint, kwargs=kwargs)
+            port = free_port()
+            process = self.start_server(name, port, options['workers'])
+            try:
+                asyncio.run(self.wait_until_ready(port, path, process))
+                for level in levels:
+                    result = asyncio.run(self.run_level(port, path, level, options))
+                    result.update(server=name, path=path)
+                    results.append(result)
+            finally:
+                process.terminate()
+                process.wait()
+
+        capacity = {}
+        for result in results:
+            if result['errors'] == 0 and result['p99_ms'] <= options['p99_limit']:
+                capacity[result['server']] = max(capacity.get(result['server'], 0), result['concurrency'])
+
+        if options['json']:
+            self.stdout.write(json.dumps({'results': results, 'capacity': capacity}, indent=2))
+            return
+
+        self.stdout.write(f"{'server':<6} {'conns':>6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+        for result in results:
+            self.stdout.write(
+                f"{result['server']:<6} {result['concurrency']:>6} {result['requests_per_second']:>9.1f} "
+                f"{result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['errors']:>7}")
+        for name in servers:
+            self.stdout.write(f"{name} sustained {capacity.get(name, 0)} concurrent connections "
+                              f"with p99 under {options['p99_limit']:.0f} ms and no errors")
+
+    def start_server(self, name, port, workers):
+        arguments = [part.format(workers=workers, bind=f'127.0.0.1:{port}') for part in SERVERS[name]]
+        return subprocess.Popen([sys.executable, *arguments], cwd=settings.BASE_DIR, env=os.environ.copy(),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    async def wait_until_ready(self, port, path, process, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'The server exited with code {process.returncode}.')
+            try:
+                await fetch(port, host_header(), path)
+                return
+            except OSError:
+                await asyncio.sleep(0.2)
+        raise CommandError('The server did not start in time.')
+
+    async def run_level(self, port, path, concurrency, options):
+        host = host_header()
+        deadline = time.monotonic() + options['seconds']
+        latencies = []
+        errors = 0
+
+        async def client():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    code = await asyncio.wait_for(fetch(port, host, path), options['timeout'])
+                except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                    errors += 1
+                    continue
+                if code != 200:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+        async def slow_client():
+            while time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(fetch(port, host, path, options['slow_delay']), options['timeout'])
+                except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                    pass
+
+        await asyncio.gather(*[client() for _ in range(concurrency)],
+                             *[slow_client() for _ in range(options['slow_clients'])])
+        return {
+            'concurrency': concurrency,
+            'requests_per_second': len(latencies) / options['seconds'],
+            'p50_ms': percentile(sorted(latencies), 50) * 1000,
+            'p99_ms': percentile(sorted(latencies), 99) * 1000,
+            'errors': errors,
+        }
+
+
+# A Host header the project accepts
+def host_header():
+    return next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
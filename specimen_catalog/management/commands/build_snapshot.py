@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from specimen_catalog import analytics, versioning
+
+# Builds the memory-mapped analytics snapshot for the current data version
+class Command(BaseCommand):
+    help = 'Builds the dictionary-encoded NumPy snapshot used by the analytics API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild even if the snapshot already matches the data version.')
+
+    def handle(self, *args, **options):
+        path = analytics.current_snapshot_path()
+        version = versioning.current_version()
+
+        if not options['force'] and path is not None and path.exists() and analytics.Snapshot(path).version == version:
+            self.stdout.write(f'Snapshot {path.name} is already up to date.')
+            return
+
+        path = analytics.build_snapshot(version=version)
+        snapshot = analytics.Snapshot(path)
+        self.stdout.write(self.style.SUCCESS(f'Built snapshot {path.name} with {snapshot.rows} rows.'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from specimen_catalog import sharding, synthetic
+
+# Appends a large, reproducible synthetic catalogue for load testing
+class Command(BaseCommand):
+    help = 'Generates Zipf-skewed synthetic specimens, taxa and expeditions in bulk for load testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='Number of specimens to generate.')
+        parser.add_argument('--taxa', type=int, default=None, help='Number of species (default: count / 50).')
+        parser.add_argument('--expeditions', type=int, default=None, help='Number of expeditions (default: count / 500).')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed; the same seed produces the same data.')
+        parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of the taxon and expedition skew.')
+        parser.add_argument('--batch-size', type=int, default=synthetic.BATCH_SIZE, help='Rows per INSERT batch.')
+        parser.add_argument('--rebuild-related', action='store_true',
+                            help='Rebuild the related-specimen groups now instead of queueing a job for run_jobs.')
+
+    def handle(self, *args, **options):
+        if sharding.enabled():
+            raise CommandError('Synthetic data is written to the default database; disable DATABASE_SHARDS first.')
+
+        result = synthetic.generate(options['count'], taxa=options['taxa'], expeditions=options['expeditions'],
+                                    seed=options['seed'], exponent=options['zipf'], batch_size=options['batch_size'],
+                                    rebuild_related=options['rebuild_related'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {result['specimens']} specimens over {result['taxa']} taxa and {result['expeditions']} "
+            f"expeditions in {result['seconds']:.1f}s ({result['rows']:,} rows, {result['rows_per_second']:,.0f} rows/s)."))
+        if result['related_job']:
+            self.stdout.write(f"Related-specimen groups are rebuilt by job {result['related_job']}; start run_jobs to process it.")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from specimen_catalog import neighbours
+
+# Rebuilds the neighbour groups behind the related-specimens panel from the read model,
+# e.g. after rows were loaded with direct SQL or RELATED_SPECIMENS was changed
+class Command(BaseCommand):
+    help = 'Rebuilds the precomputed neighbour groups used to show related specimens.'
+
+    def handle(self, *args, **options):
+        for alias, groups in neighbours.rebuild_all().items():
+            self.stdout.write(self.style.SUCCESS(f'{alias}: rebuilt {groups} neighbour groups.'))
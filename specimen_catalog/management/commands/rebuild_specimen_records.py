@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from specimen_catalog import read_model
+
+# Rebuilds the SpecimenRecord read model from the Specimen, Taxonomy and Expedition tables
+class Command(BaseCommand):
+    help = 'Rebuilds the denormalised SpecimenRecord read table from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=read_model.REBUILD_BATCH_SIZE,
+                            help='Number of records written per INSERT.')
+
+    def handle(self, *args, **options):
+        total = read_model.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {total} specimen records.'))
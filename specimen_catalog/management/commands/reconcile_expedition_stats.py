@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from specimen_catalog import expedition_stats
+
+# Recomputes the expedition specimen counters from the read model and reports any drift.
+# Meant to run periodically (cron or a reconcile_expedition_stats job) next to the incremental updates.
+class Command(BaseCommand):
+    help = 'Recomputes expedition specimen counts and top families, reporting expeditions that had drifted.'
+
+    def handle(self, *args, **options):
+        for alias, result in expedition_stats.reconcile_all().items():
+            style = self.style.WARNING if result['drifted'] else self.style.SUCCESS
+            self.stdout.write(style(f"{alias}: {result['expeditions']} expeditions, {result['drifted']} drifted."))
@@ -0,0 +1,32 @@
+import os
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from specimen_catalog import importer
+
+# Checks the taxon names of an import file against the existing ones before it is imported,
+# so misspellings and whitespace variants can be fixed instead of becoming new Taxonomy rows
+class Command(BaseCommand):
+    help = 'Matches the taxon names of a CSV import file against existing names and writes a report.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file in the import format.')
+        parser.add_argument('--report', default='', help='Where to write the CSV report (default: <path>.reconcile.csv).')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Matching processes.')
+        parser.add_argument('--threshold', type=float, default=None,
+                            help='Minimum similarity of a match (default: TAXON_MATCH_THRESHOLD).')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['path']):
+            raise CommandError(f"{options['path']} does not exist.")
+
+        report_file = options['report'] or f"{options['path']}.reconcile.csv"
+        report = importer.reconcile_csv(options['path'], report_file, threshold=options['threshold'],
+                                        workers=options['workers'])
+
+        statuses = Counter(row['status'] for row in report)
+        self.stdout.write(', '.join(f'{statuses[status]} {status}' for status in ('exact', 'variant', 'fuzzy', 'new')))
+        for row in report:
+            if row['status'] in ('variant', 'fuzzy'):
+                self.stdout.write(f"{row['column']}: {row['value']!r} -> {row['match']!r} ({row['score']}, {row['rows']} rows)")
+        self.stdout.write(self.style.SUCCESS(f'Report written to {report_file}'))
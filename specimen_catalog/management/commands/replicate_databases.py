@@ -0,0 +1,36 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from specimen_catalog.database import replicate_sqlite
+from specimen_catalog.routers import synced_marker
+
+# Refreshes the local SQLite read replicas from the primary database
+class Command(BaseCommand):
+    help = 'Copies the primary SQLite database into each read replica using the online backup API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep refreshing every INTERVAL seconds (keep it below REPLICA_MAX_LAG).')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICA_ALIASES:
+            raise CommandError('No replicas are configured; set DATABASE_REPLICAS to enable them.')
+
+        while True:
+            self.replicate_all()
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    def replicate_all(self):
+        primary = settings.DATABASES['default']
+        for alias in settings.DATABASE_REPLICA_ALIASES:
+            started = time.perf_counter()
+            replicate_sqlite(str(primary['NAME']), str(settings.DATABASES[alias]['NAME']), primary.get('PRAGMAS'))
+
+            # Marks the replica as fresh for the router's lag check
+            Path(synced_marker(alias)).touch()
+            self.stdout.write(f'Refreshed {alias} in {time.perf_counter() - started:.2f}s.')
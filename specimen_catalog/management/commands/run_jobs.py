@@ -0,0 +1,48 @@
+import signal
+import threading
+from django.core.management.base import BaseCommand
+from specimen_catalog import jobs
+
+# Runs queued background jobs in a pool of worker threads, outside the web processes
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (imports, exports, rebuilds, bulk deletes).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Number of worker threads.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before polling an empty queue again.')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs that are queued now, then exit.')
+
+    def handle(self, *args, **options):
+        # Jobs left running by a worker that died would otherwise stay running forever
+        abandoned = jobs.fail_abandoned()
+        if abandoned:
+            self.stdout.write(self.style.WARNING(f'Marked {abandoned} abandoned job(s) as failed.'))
+
+        if options['once']:
+            count = jobs.run_pending()
+            self.stdout.write(self.style.SUCCESS(f'Ran {count} job(s).'))
+            return
+
+        # Stops the workers after their current job on Ctrl+C or SIGTERM
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+
+        threads = [
+            threading.Thread(target=jobs.work, name=f'job-worker-{number}',
+                             args=(f'{jobs.default_worker_name()}-{number}', stop, options['poll_interval']))
+            for number in range(options['workers'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Started {len(threads)} job worker(s).")
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1.0)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,53 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from specimen_catalog import startup
+
+
+# Reports how long a worker takes to boot, how much memory it holds afterwards and which
+# packages and modules the time goes to, measured in a fresh interpreter
+class Command(BaseCommand):
+    help = 'Measures worker boot time and RSS and breaks down import costs per package and module.'
+
+    # The report measures its own child process; loading the URLconf here would only slow it down
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=15, help='Packages and modules to list.')
+        parser.add_argument('--json', action='store_true', help='Print the full report as JSON.')
+        parser.add_argument('--check', action='store_true',
+                            help='Fail when boot time or RSS exceed STARTUP_TARGET_SECONDS / STARTUP_TARGET_RSS_MB.')
+
+    def handle(self, *args, **options):
+        report = startup.measure_boot()
+        report['packages'] = startup.package_costs(report['imports'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(f"Boot: {report['total_seconds'] * 1000:.0f} ms (django.setup {report['setup_seconds'] * 1000:.0f} ms, "
+                              f"WSGI app and URLconf {report['urls_seconds'] * 1000:.0f} ms), peak RSS {report['rss_kb'] / 1024:.1f} MB")
+            self.stdout.write('Lazy modules: ' + ', '.join(
+                f"{name} {'loaded' if loaded else 'not loaded'}" for name, loaded in report['loaded'].items()))
+
+            self.stdout.write(f"\n{'package':<32} {'self ms':>9}")
+            for package, self_time in report['packages'][:options['limit']]:
+                self.stdout.write(f'{package:<32} {self_time / 1000:>9.1f}')
+
+            # Top-level imports of the boot script and their cumulative cost
+            self.stdout.write(f"\n{'module':<48} {'cumulative ms':>14}")
+            top_level = sorted((entry for entry in report['imports'] if entry[3] == 0), key=lambda entry: entry[2], reverse=True)
+            for module, _, cumulative, _ in top_level[:options['limit']]:
+                self.stdout.write(f'{module:<48} {cumulative / 1000:>14.1f}')
+
+        if options['check']:
+            problems = []
+            if report['total_seconds'] > settings.STARTUP_TARGET_SECONDS:
+                problems.append(f"boot took {report['total_seconds']:.2f}s (target {settings.STARTUP_TARGET_SECONDS}s)")
+            if report['rss_kb'] / 1024 > settings.STARTUP_TARGET_RSS_MB:
+                problems.append(f"RSS is {report['rss_kb'] / 1024:.1f} MB (target {settings.STARTUP_TARGET_RSS_MB} MB)")
+            problems += [f'{name} was imported at boot' for name, loaded in report['loaded'].items() if loaded]
+            if problems:
+                raise CommandError('; '.join(problems))
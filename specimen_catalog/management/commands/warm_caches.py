@@ -0,0 +1,43 @@
+import urllib.error
+import urllib.request
+
+from django.core.management.base import BaseCommand, CommandError
+
+from specimen_catalog import warmup
+
+
+# Re-warms caches on demand, e.g. after a bulk import. Run locally it warms the database
+# and OS page caches and whatever caches are shared between processes; with --server the
+# warm-up requests go to a running server, spread over its workers by --repeat.
+class Command(BaseCommand):
+    help = 'Warms templates, lookup tables, the analytics snapshot and the most common pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stages', default=','.join(warmup.STAGES),
+                            help=f"Comma-separated stages (default: {','.join(warmup.STAGES)}).")
+        parser.add_argument('--server', default='', help='Base URL of a running server to send the warm-up requests to.')
+        parser.add_argument('--repeat', type=int, default=1, help='Times each warm-up request is sent to the server.')
+
+    def handle(self, *args, **options):
+        stages = [stage for stage in options['stages'].split(',') if stage]
+        unknown = set(stages) - set(warmup.STAGES)
+        if unknown:
+            raise CommandError(f"Unknown stage(s): {', '.join(sorted(unknown))}")
+
+        fetch = None
+        if options['server']:
+            base_url = options['server'].rstrip('/')
+
+            def fetch(path):
+                status = 200
+                for _ in range(options['repeat']):
+                    try:
+                        with urllib.request.urlopen(base_url + path) as response:
+                            response.read()
+                    except urllib.error.HTTPError as error:
+                        status = error.code
+                return status
+
+        for stage, seconds, detail in warmup.warm(stages, fetch=fetch):
+            self.stdout.write(f'{stage:<10} {seconds * 1000:>8.0f} ms  {detail}')
+        self.stdout.write(self.style.SUCCESS('Caches warmed.'))
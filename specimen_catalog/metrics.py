@@ -0,0 +1,175 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from .lazy_imports import lazy_import
+
+# Only loaded once the metrics table is opened, so a deployment without METRICS never imports it
+np = lazy_import('numpy')
+
+# Upper bounds (seconds) of the request latency histogram buckets; the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Status classes counted per URL name
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+# Counters kept per URL name, in file order
+FIELDS = ([f'bucket_{bound}' for bound in BUCKETS] + ['bucket_inf', 'sum', 'count']
+          + [f'status_{status_class}' for status_class in STATUS_CLASSES]
+          + ['queries', 'cache_hits', 'cache_misses'])
+FIELD = {name: index for index, name in enumerate(FIELDS)}
+
+# Worker slots in the file; every process writes only to its own slot
+SLOTS = 64
+
+# Bytes before the slot table: layout signature, then one pid per slot
+SIGNATURE_SIZE = 32
+
+# Series for requests that did not resolve to a named URL
+OTHER = ''
+
+
+# URL names of specimen_catalog/urls.py, one series each
+def url_names():
+    from . import urls
+    return [OTHER] + [pattern.name for pattern in urls.urlpatterns if pattern.name]
+
+
+def metrics_file():
+    return Path(getattr(settings, 'METRICS_FILE', settings.BASE_DIR / 'var' / 'metrics.mmap'))
+
+
+# Request metrics of all workers in one memory-mapped file. The file holds a float64 table of
+# slot x URL name x field; each worker claims a slot (reusing those of exited workers, whose
+# counts are kept) and adds to it without locking other processes. Readers sum every slot.
+class MetricsRegistry:
+    def __init__(self, path, names):
+        self.path = Path(path)
+        self.names = names
+        self.index = {name: position for position, name in enumerate(names)}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+        shape = (SLOTS, len(names), len(FIELDS))
+        size = SIGNATURE_SIZE + SLOTS * 8 + int(np.prod(shape)) * 8
+        signature = hashlib.sha256(repr((names, FIELDS, SLOTS)).encode()).digest()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            try:
+                # Starts a fresh file when the URL names or fields changed since it was written
+                if os.fstat(descriptor).st_size != size or os.pread(descriptor, SIGNATURE_SIZE, 0) != signature:
+                    os.ftruncate(descriptor, 0)
+                    os.ftruncate(descriptor, size)
+                    os.pwrite(descriptor, signature, 0)
+                self.mmap = mmap.mmap(descriptor, size)
+                self.pids = np.ndarray((SLOTS,), dtype=np.int64, buffer=self.mmap, offset=SIGNATURE_SIZE)
+                self.table = np.ndarray(shape, dtype=np.float64, buffer=self.mmap, offset=SIGNATURE_SIZE + SLOTS * 8)
+                self.slot = self.claim_slot()
+            finally:
+                fcntl.flock(descriptor, fcntl.LOCK_UN)
+        finally:
+            os.close(descriptor)
+
+    # Takes the slot of this pid, an unused one or one whose worker has exited
+    def claim_slot(self):
+        pids = self.pids.tolist()
+        if self.pid in pids:
+            return pids.index(self.pid)
+        for slot, pid in enumerate(pids):
+            if pid == 0 or not process_alive(pid):
+                self.pids[slot] = self.pid
+                return slot
+        raise RuntimeError(f'All {SLOTS} metrics slots are in use.')
+
+    def observe(self, url_name, duration, status_code, queries=0, cache_hits=0, cache_misses=0):
+        row = self.table[self.slot, self.index.get(url_name, 0)]
+        bucket = next((position for position, bound in enumerate(BUCKETS) if duration <= bound), len(BUCKETS))
+        status_class = f'status_{min(max(status_code // 100, 1), 5)}xx'
+        with self.lock:
+            row[bucket] += 1
+            row[FIELD['sum']] += duration
+            row[FIELD['count']] += 1
+            row[FIELD[status_class]] += 1
+            row[FIELD['queries']] += queries
+            row[FIELD['cache_hits']] += cache_hits
+            row[FIELD['cache_misses']] += cache_misses
+
+    # Counters summed over every worker, as {url_name: {field: value}} for names seen so far
+    def totals(self):
+        summed = self.table.sum(axis=0)
+        return {name: dict(zip(FIELDS, summed[position].tolist()))
+                for name, position in self.index.items() if summed[position][FIELD['count']]}
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+# This process's registry, opened on first use and again in a forked worker
+def get_registry():
+    path = metrics_file()
+    key = (str(path), os.getpid())
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = MetricsRegistry(path, url_names())
+        return _registries[key]
+
+
+# Renders the totals in the Prometheus text exposition format
+def render(totals):
+    lines = [
+        '# HELP specimen_catalog_request_duration_seconds Request latency per URL name.',
+        '# TYPE specimen_catalog_request_duration_seconds histogram',
+    ]
+    for name, values in totals.items():
+        cumulative = 0
+        for bound in BUCKETS:
+            cumulative += values[f'bucket_{bound}']
+            lines.append(f'specimen_catalog_request_duration_seconds_bucket{{url_name="{name}",le="{bound}"}} {cumulative:.0f}')
+        cumulative += values['bucket_inf']
+        lines.append(f'specimen_catalog_request_duration_seconds_bucket{{url_name="{name}",le="+Inf"}} {cumulative:.0f}')
+        lines.append(f'specimen_catalog_request_duration_seconds_sum{{url_name="{name}"}} {values["sum"]:.6f}')
+        lines.append(f'specimen_catalog_request_duration_seconds_count{{url_name="{name}"}} {values["count"]:.0f}')
+
+    lines += ['# HELP specimen_catalog_responses_total Responses per URL name and status class.',
+              '# TYPE specimen_catalog_responses_total counter']
+    for name, values in totals.items():
+        for status_class in STATUS_CLASSES:
+            if values[f'status_{status_class}']:
+                lines.append(f'specimen_catalog_responses_total{{url_name="{name}",status="{status_class}"}} '
+                             f'{values[f"status_{status_class}"]:.0f}')
+
+    lines += ['# HELP specimen_catalog_db_queries_total SQL queries run per URL name.',
+              '# TYPE specimen_catalog_db_queries_total counter']
+    for name, values in totals.items():
+        lines.append(f'specimen_catalog_db_queries_total{{url_name="{name}"}} {values["queries"]:.0f}')
+
+    lines += ['# HELP specimen_catalog_cache_requests_total Cache lookups per URL name and result.',
+              '# TYPE specimen_catalog_cache_requests_total counter',
+              '# HELP specimen_catalog_cache_hit_ratio Share of cache lookups that hit, per URL name.',
+              '# TYPE specimen_catalog_cache_hit_ratio gauge']
+    for name, values in totals.items():
+        lookups = values['cache_hits'] + values['cache_misses']
+        if lookups:
+            lines.append(f'specimen_catalog_cache_requests_total{{url_name="{name}",result="hit"}} {values["cache_hits"]:.0f}')
+            lines.append(f'specimen_catalog_cache_requests_total{{url_name="{name}",result="miss"}} {values["cache_misses"]:.0f}')
+            lines.append(f'specimen_catalog_cache_hit_ratio{{url_name="{name}"}} {values["cache_hits"] / lookups:.6f}')
+
+    return '\n'.join(lines) + '\n'
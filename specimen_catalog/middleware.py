@@ -0,0 +1,374 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from . import routers, instrumentation, metrics, profiling, admission
+
+slow_request_logger = logging.getLogger('specimen_catalog.slow_requests')
+
+# Session key holding the time until which the session reads from the primary
+PRIMARY_UNTIL_SESSION_KEY = '_read_primary_until'
+
+# Request methods that do not write
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+
+# Base of the middleware below. It runs in the mode of the rest of the chain, sync under WSGI
+# and async under ASGI, so Django does not hop threads around it. Subclasses implement
+# __call__ and __acall__, and __call__ hands over to __acall__ in async mode. Per-request
+# state is kept in ContextVars, which follow the request into sync_to_async threads.
+class SyncAndAsyncMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+# Gives each session read-your-writes consistency when reads go to replicas.
+# Writing requests read from the primary, and so does the same session for
+# REPLICA_STICKY_SECONDS afterwards, which covers the replication interval.
+class ReplicaStickinessMiddleware(SyncAndAsyncMiddleware):
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        token = routers.pin_primary() if self.reads_primary(request) else None
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                routers.unpin_primary(token)
+
+        if request.method not in SAFE_METHODS:
+            self.stick(request)
+        return response
+
+    # The session is read and written in a thread, as loading it queries the database
+    async def __acall__(self, request):
+        token = routers.pin_primary() if await sync_to_async(self.reads_primary)(request) else None
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                routers.unpin_primary(token)
+
+        if request.method not in SAFE_METHODS:
+            await sync_to_async(self.stick)(request)
+        return response
+
+    def reads_primary(self, request):
+        return request.method not in SAFE_METHODS or request.session.get(PRIMARY_UNTIL_SESSION_KEY, 0) > time.time()
+
+    def stick(self, request):
+        request.session[PRIMARY_UNTIL_SESSION_KEY] = time.time() + settings.REPLICA_STICKY_SECONDS
+
+
+# Interval at which queued requests check for a free place; the queue is shared by every
+# worker process, so it is polled rather than signalled
+QUEUE_POLL_INTERVAL = 0.005
+
+
+# One route group's concurrency limit, counted over all workers in the shared admission table
+# (see admission.py). Requests over the limit queue for up to queue_timeout seconds and are shed
+# after that, or straight away while a group with a higher priority has requests queued, so
+# expensive pages give way to cheap ones under load.
+class AdmissionGroup:
+    def __init__(self, name, limit, queue_timeout=0.0, priority=0, retry_after=1):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.priority = priority
+        self.retry_after = retry_after
+        # Requests shed by this process
+        self.rejected = 0
+
+    # Requests of the group queued in any worker
+    @property
+    def waiting(self):
+        table = admission.get_table()
+        with table.locked():
+            return table.total(self.name, admission.WAITING)
+
+    # Takes a place if one is free; requests that did not queue never overtake queued ones.
+    # Must be called under table.locked().
+    def admit(self, table, queued):
+        if table.total(self.name, admission.IN_FLIGHT) >= self.limit:
+            # Places held by workers that exited mid-request are given back first
+            table.reap()
+            if table.total(self.name, admission.IN_FLIGHT) >= self.limit:
+                return False
+        if not queued and table.total(self.name, admission.WAITING):
+            return False
+        table.add(self.name, admission.IN_FLIGHT, 1)
+        return True
+
+    def acquire(self, higher_priority_waiting=False):
+        table = admission.get_table()
+        queue = not higher_priority_waiting and self.queue_timeout > 0
+        with table.locked():
+            if self.admit(table, queued=False):
+                return True
+            if queue:
+                table.add(self.name, admission.WAITING, 1)
+
+        if queue:
+            deadline = time.monotonic() + self.queue_timeout
+            admitted = False
+            try:
+                while not admitted and time.monotonic() < deadline:
+                    time.sleep(QUEUE_POLL_INTERVAL)
+                    with table.locked():
+                        admitted = self.admit(table, queued=True)
+            finally:
+                with table.locked():
+                    table.add(self.name, admission.WAITING, -1)
+            if admitted:
+                return True
+
+        with table.locked():
+            self.rejected += 1
+        return False
+
+    def release(self):
+        table = admission.get_table()
+        with table.locked():
+            table.add(self.name, admission.IN_FLIGHT, -1)
+
+
+# In-flight requests, queue time and rejections of one view class
+class ViewLoad:
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+
+
+# Limits concurrent requests per route group (ADMISSION_GROUPS, routes mapped by URL name in
+# ADMISSION_ROUTES) and answers with a fast 503 and Retry-After instead of letting requests
+# pile up until workers time out. Limits apply to the whole server: the counts are shared
+# by every worker process through the admission table.
+class AdmissionControlMiddleware(SyncAndAsyncMiddleware):
+    def __init__(self, get_response):
+        if not getattr(settings, 'ADMISSION_CONTROL', False):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.groups = {name: AdmissionGroup(name, **options) for name, options in settings.ADMISSION_GROUPS.items()}
+        self.routes = settings.ADMISSION_ROUTES
+        self.default_group = settings.ADMISSION_DEFAULT_GROUP
+        self.views = defaultdict(ViewLoad)
+        self.lock = threading.Lock()
+        # Django calls the view hook in the middleware's mode. In async mode a queued request
+        # waits in a pool thread rather than in the thread that runs sync views.
+        if self.async_mode:
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        try:
+            return self.get_response(request)
+        finally:
+            self.release(request)
+
+    async def __acall__(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            self.release(request)
+
+    def release(self, request):
+        admitted = getattr(request, '_admission', None)
+        if admitted is not None:
+            group, view = admitted
+            group.release()
+            with self.lock:
+                view.in_flight -= 1
+
+    def group_for(self, request):
+        match = request.resolver_match
+        return self.groups[self.routes.get(match.url_name if match else None, self.default_group)]
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        return self.admit(request, view_func)
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return await sync_to_async(self.admit, thread_sensitive=False)(request, view_func)
+
+    # Takes a place in the request's group, or returns the 503 response that sheds it
+    def admit(self, request, view_func):
+        group = self.group_for(request)
+        view_class = getattr(view_func, 'view_class', view_func)
+        with self.lock:
+            view = self.views[view_class.__name__]
+
+        higher_priority_waiting = any(other.waiting for other in self.groups.values() if other.priority > group.priority)
+        started = time.monotonic()
+        admitted = group.acquire(higher_priority_waiting)
+        queued = time.monotonic() - started
+
+        with self.lock:
+            view.requests += 1
+            view.queue_time += queued
+            view.max_queue_time = max(view.max_queue_time, queued)
+            if not admitted:
+                view.rejected += 1
+            else:
+                view.in_flight += 1
+
+        if not admitted:
+            response = HttpResponse('The server is busy, please try again shortly.', status=503, content_type='text/plain')
+            response['Retry-After'] = str(group.retry_after)
+            return response
+
+        request._admission = (group, view)
+        return None
+
+
+# Records per request how many SQL queries ran, the time spent in the database, in template
+# rendering and in DRF serialisation, and sends them in a Server-Timing header. Requests over
+# SERVER_TIMING_SLOW_MS or SERVER_TIMING_MAX_QUERIES are logged with their slowest statements.
+# Disabled unless SERVER_TIMING is set, in which case it is removed from the middleware chain.
+class ServerTimingMiddleware(SyncAndAsyncMiddleware):
+    def __init__(self, get_response):
+        if not getattr(settings, 'SERVER_TIMING', False):
+            raise MiddlewareNotUsed
+        instrumentation.install()
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings, token = instrumentation.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            instrumentation.stop(token)
+        return self.report(request, response, timings)
+
+    async def __acall__(self, request):
+        timings, token = instrumentation.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            instrumentation.stop(token)
+        return self.report(request, response, timings)
+
+    def report(self, request, response, timings):
+        total = timings.total()
+        response['Server-Timing'] = ', '.join([
+            f'db;desc="{len(timings.queries)} queries";dur={timings.db_time * 1000:.2f}',
+            f'template;dur={timings.template_time * 1000:.2f}',
+            f'serialize;dur={timings.serialize_time * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ])
+
+        if total * 1000 >= settings.SERVER_TIMING_SLOW_MS or len(timings.queries) > settings.SERVER_TIMING_MAX_QUERIES:
+            self.log_slow_request(request, response, timings, total)
+        return response
+
+    def log_slow_request(self, request, response, timings, total):
+        statements = ''.join(f'\n  {duration * 1000:.2f} ms  {sql}'
+                             for duration, sql in timings.slowest_queries(settings.SERVER_TIMING_LOGGED_QUERIES))
+        slow_request_logger.warning(
+            'Slow request %s %s (%s): %.1f ms total, %d queries in %.1f ms, template %.1f ms, serialize %.1f ms%s',
+            request.method, request.get_full_path(), response.status_code, total * 1000, len(timings.queries),
+            timings.db_time * 1000, timings.template_time * 1000, timings.serialize_time * 1000, statements)
+
+
+# Records latency, status, query count and cache lookups of every request per URL name in the
+# shared metrics file (see metrics.py), which the /metrics endpoint reads. Enabled with METRICS.
+class MetricsMiddleware(SyncAndAsyncMiddleware):
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS', False):
+            raise MiddlewareNotUsed
+        instrumentation.install_query_timing()
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+
+        # Shares the timings of ServerTimingMiddleware when it is enabled too
+        timings = instrumentation.current()
+        if timings is not None:
+            response = self.get_response(request)
+        else:
+            timings, token = instrumentation.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                instrumentation.stop(token)
+        return self.record(request, response, timings, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        timings = instrumentation.current()
+        if timings is not None:
+            response = await self.get_response(request)
+        else:
+            timings, token = instrumentation.start()
+            try:
+                response = await self.get_response(request)
+            finally:
+                instrumentation.stop(token)
+        return self.record(request, response, timings, started)
+
+    def record(self, request, response, timings, started):
+        match = request.resolver_match
+        metrics.get_registry().observe(
+            match.url_name if match else metrics.OTHER, time.perf_counter() - started, response.status_code,
+            queries=len(timings.queries), cache_hits=timings.cache_hits, cache_misses=timings.cache_misses)
+        return response
+
+
+# Profiles a request with cProfile when a staff user adds PROFILING_PARAMETER to it (e.g.
+# /all_specimens/?genus=Homo&_profile). The capture is stored with the request's SQL and
+# shown in the admin; X-Profile-Id names it. Disabled unless PROFILING is set, and limited
+# to PROFILING_RATE_LIMIT captures per PROFILING_RATE_WINDOW seconds.
+class ProfilingMiddleware(SyncAndAsyncMiddleware):
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING', False):
+            raise MiddlewareNotUsed
+        instrumentation.install_query_timing()
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not profiling.requested(request):
+            return self.get_response(request)
+        return self.profile(request, self.get_response)
+
+    # cProfile only sees the thread it runs in, so a profiled request runs the rest of the chain
+    # from one sync thread; sync views run in that thread too (async_to_sync hands them back).
+    # Code of async views runs on the event loop and is not in the capture, but their SQL is.
+    async def __acall__(self, request):
+        if settings.PROFILING_PARAMETER not in request.GET or not await sync_to_async(profiling.requested)(request):
+            return await self.get_response(request)
+        return await sync_to_async(self.profile)(request, async_to_sync(self.get_response))
+
+    def profile(self, request, get_response):
+        if not profiling.within_rate_limit():
+            response = get_response(request)
+            response['X-Profile'] = 'rate-limited'
+            return response
+
+        timings, token = instrumentation.start()
+        try:
+            response, capture = profiling.profile(request, get_response, timings)
+        finally:
+            instrumentation.stop(token)
+
+        response['X-Profile-Id'] = str(capture.pk)
+        return response
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.3 on 2026-10-19 16:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Fills the new read table from the existing specimens in a single INSERT ... SELECT
+POPULATE_RECORDS_SQL = """
+    INSERT INTO specimen_catalog_specimenrecord (
+        specimen_id, catalog_number,
+        expedition_id, expedition_name, continent, country,
+        taxonomy_id, kingdom, phylum, highest_biostratigraphic_zone, class_name,
+        identification_description, family, genus, species
+    )
+    SELECT s.specimen_id, s.catalog_number,
+        s.expedition_id, COALESCE(e.expedition, ''), COALESCE(e.continent, ''), COALESCE(e.country, ''),
+        s.taxonomy_id, COALESCE(t.kingdom, ''), COALESCE(t.phylum, ''), COALESCE(t.highest_biostratigraphic_zone, ''),
+        COALESCE(t.class_name, ''), COALESCE(t.identification_description, ''), COALESCE(t.family, ''),
+        COALESCE(t.genus, ''), COALESCE(t.species, '')
+    FROM specimen_catalog_specimen s
+    LEFT JOIN specimen_catalog_expedition e ON e.expedition_id = s.expedition_id
+    LEFT JOIN specimen_catalog_taxonomy t ON t.taxonomy_id = s.taxonomy_id
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimen_catalog', '0005_remove_specimen_continent_remove_specimen_country'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpecimenRecord',
+            fields=[
+                ('specimen', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='record', serialize=False, to='specimen_catalog.specimen')),
+                ('catalog_number', models.CharField(blank=True, max_length=50)),
+                ('expedition_id', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('expedition_name', models.CharField(blank=True, max_length=100)),
+                ('continent', models.CharField(blank=True, max_length=50)),
+                ('country', models.CharField(blank=True, max_length=50)),
+                ('taxonomy_id', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('kingdom', models.CharField(blank=True, max_length=50)),
+                ('phylum', models.CharField(blank=True, max_length=50)),
+                ('highest_biostratigraphic_zone', models.CharField(blank=True, max_length=50)),
+                ('class_name', models.CharField(blank=True, max_length=50)),
+                ('identification_description', models.CharField(blank=True, max_length=50)),
+                ('family', models.CharField(blank=True, max_length=50)),
+                ('genus', models.CharField(blank=True, max_length=50)),
+                ('species', models.CharField(blank=True, max_length=50)),
+            ],
+            options={
+                'ordering': ['-specimen_id'],
+                'indexes': [models.Index(fields=['continent', 'country'], name='record_geo_idx'), models.Index(fields=['family', 'genus', 'species'], name='record_taxon_idx')],
+            },
+        ),
+        migrations.RunSQL(POPULATE_RECORDS_SQL, migrations.RunSQL.noop),
+    ]
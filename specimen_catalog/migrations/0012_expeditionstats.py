@@ -0,0 +1,80 @@
+# Generated by Django 4.2.3 on 2026-10-19 16:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Counts the existing specimens per expedition and family, then per expedition
+POPULATE_TAXON_COUNTS_SQL = """
+    INSERT INTO specimen_catalog_expeditiontaxoncount (expedition_id, family, specimen_count)
+    SELECT r.expedition_id, r.family, COUNT(*)
+    FROM specimen_catalog_specimenrecord r
+    JOIN specimen_catalog_expedition e ON e.expedition_id = r.expedition_id
+    GROUP BY r.expedition_id, r.family
+"""
+
+POPULATE_STATS_SQL = """
+    INSERT INTO specimen_catalog_expeditionstats (expedition_id, specimen_count, top_taxa)
+    SELECT e.expedition_id, COALESCE(SUM(c.specimen_count), 0), '[]'
+    FROM specimen_catalog_expedition e
+    LEFT JOIN specimen_catalog_expeditiontaxoncount c ON c.expedition_id = e.expedition_id
+    GROUP BY e.expedition_id
+"""
+
+
+# Fills top_taxa with the three most common named families of every expedition
+def populate_top_taxa(apps, schema_editor):
+    ExpeditionStats = apps.get_model('specimen_catalog', 'ExpeditionStats')
+    ExpeditionTaxonCount = apps.get_model('specimen_catalog', 'ExpeditionTaxonCount')
+    using = schema_editor.connection.alias
+
+    taxa = {}
+    rows = (ExpeditionTaxonCount.objects.using(using).exclude(family='')
+            .order_by('expedition_id', '-specimen_count', 'family').values_list('expedition_id', 'family', 'specimen_count'))
+    for expedition_id, family, count in rows.iterator():
+        families = taxa.setdefault(expedition_id, [])
+        if len(families) < 3:
+            families.append({'family': family, 'specimens': count})
+    for expedition_id, families in taxa.items():
+        ExpeditionStats.objects.using(using).filter(expedition_id=expedition_id).update(top_taxa=families)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimen_catalog', '0011_profilecapture'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpeditionStats',
+            fields=[
+                ('expedition', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='specimen_catalog.expedition')),
+                ('specimen_count', models.IntegerField(default=0)),
+                ('top_taxa', models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                'ordering': ['-specimen_count', '-expedition_id'],
+                'indexes': [models.Index(fields=['specimen_count', 'expedition'], name='expedition_count_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExpeditionTaxonCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('family', models.CharField(blank=True, max_length=50)),
+                ('specimen_count', models.IntegerField(default=0)),
+                ('expedition', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='taxon_counts', to='specimen_catalog.expedition')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expedition', 'specimen_count'], name='expedition_taxon_count_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='expeditiontaxoncount',
+            constraint=models.UniqueConstraint(fields=('expedition', 'family'), name='expedition_family_unique'),
+        ),
+        migrations.RunSQL(POPULATE_TAXON_COUNTS_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(POPULATE_STATS_SQL, migrations.RunSQL.noop),
+        migrations.RunPython(populate_top_taxa, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.3 on 2026-10-19 16:58
+
+from itertools import groupby
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+
+# Neighbour levels and the record columns their members share, as in neighbours.LEVELS
+LEVELS = [
+    ('species_expedition', ['family', 'genus', 'species', 'expedition_id']),
+    ('species', ['family', 'genus', 'species']),
+    ('genus_expedition', ['family', 'genus', 'expedition_id']),
+    ('genus', ['family', 'genus']),
+    ('family_expedition', ['family', 'expedition_id']),
+    ('family', ['family']),
+]
+
+
+# Builds the groups of the existing specimens: the newest RELATED_SPECIMENS + 1 of each
+def populate_groups(apps, schema_editor):
+    NeighbourGroup = apps.get_model('specimen_catalog', 'NeighbourGroup')
+    SpecimenRecord = apps.get_model('specimen_catalog', 'SpecimenRecord')
+    using = schema_editor.connection.alias
+
+    for level, columns in LEVELS:
+        rows = (SpecimenRecord.objects.using(using)
+                .annotate(position=Window(RowNumber(), partition_by=[F(column) for column in columns],
+                                          order_by=F('specimen_id').desc()))
+                .filter(position__lte=settings.RELATED_SPECIMENS + 1))
+        for column in columns:
+            rows = rows.exclude(**{column: ''}) if column != 'expedition_id' else rows.filter(expedition_id__isnull=False)
+        rows = rows.order_by(*columns, '-specimen_id').values_list(*columns, 'specimen_id')
+        groups = [NeighbourGroup(key=f"{level}:{'|'.join(str(part) for part in parts)}", level=level,
+                                 specimen_ids=[row[-1] for row in grouped])
+                  for parts, grouped in groupby(rows.iterator(), key=lambda row: row[:-1])]
+        NeighbourGroup.objects.using(using).bulk_create(groups, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimen_catalog', '0012_expeditionstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NeighbourGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=200, unique=True)),
+                ('level', models.CharField(max_length=20)),
+                ('specimen_ids', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.RunPython(populate_groups, migrations.RunPython.noop),
+    ]
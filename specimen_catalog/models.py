@@ -1,4 +1,18 @@
 from django.db import models
+from django.conf import settings
+from django.utils import timezone
+
+#This code defines the queryset of the models that can be sharded. Its create()
+#saves through Model.save() so the database router sees the new instance and
+#can pick the shard from its fields (QuerySet.create() would hide it).
+class CatalogueQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True)
+        return obj
 
 #This code defines a Django model named Expedition and it's information
 class Expedition(models.Model):
@@ -7,6 +21,8 @@ class Expedition(models.Model):
     continent = models.CharField(max_length=50, null=False, blank=True)
     country = models.CharField(max_length=50, null=False, blank=True)
 
+    objects = CatalogueQuerySet.as_manager()
+
     def __str__(self):
         return self.expedition
     
@@ -42,8 +58,187 @@ class Specimen(models.Model):
     expedition = models.ForeignKey('Expedition', on_delete=models.CASCADE, null=True, blank=True)
     taxonomy = models.ForeignKey(Taxonomy, on_delete=models.CASCADE, null=True, blank=True)
 
+    objects = CatalogueQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-specimen_id']
+
+    def __str__(self):
+        return f"Specimen {self.specimen_id}"
+
+#This code defines a flat, denormalised read model with one row per specimen.
+#It is kept in sync by the receivers in signals.py so that list pages, filters,
+#the API and exports can read every displayed column without joins.
+class SpecimenRecord(models.Model):
+    specimen = models.OneToOneField(Specimen, on_delete=models.CASCADE, primary_key=True, related_name='record')
+    catalog_number = models.CharField(max_length=50, blank=True)
+
+    # Expedition columns
+    expedition_id = models.IntegerField(null=True, blank=True, db_index=True)
+    expedition_name = models.CharField(max_length=100, blank=True)
+    continent = models.CharField(max_length=50, blank=True)
+    country = models.CharField(max_length=50, blank=True)
+
+    # Taxonomy columns
+    taxonomy_id = models.IntegerField(null=True, blank=True, db_index=True)
+    kingdom = models.CharField(max_length=50, blank=True)
+    phylum = models.CharField(max_length=50, blank=True)
+    highest_biostratigraphic_zone = models.CharField(max_length=50, blank=True)
+    class_name = models.CharField(max_length=50, blank=True)
+    identification_description = models.CharField(max_length=50, blank=True)
+    family = models.CharField(max_length=50, blank=True)
+    genus = models.CharField(max_length=50, blank=True)
+    species = models.CharField(max_length=50, blank=True)
+
     class Meta:
         ordering = ['-specimen_id']
+        indexes = [
+            models.Index(fields=['continent', 'country'], name='record_geo_idx'),
+            models.Index(fields=['family', 'genus', 'species'], name='record_taxon_idx'),
+        ]
+
+    def __str__(self):
+        return f"Specimen {self.specimen_id}"
+
+#This code defines the precomputed statistics of one expedition: how many specimens
+#it holds and its most common families. The receivers in signals.py adjust them on
+#every specimen create, move and delete, and reconcile_expedition_stats recomputes
+#them from the read model. The count index serves the listing sorted by count.
+class ExpeditionStats(models.Model):
+    expedition = models.OneToOneField(Expedition, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    specimen_count = models.IntegerField(default=0)
+    # [{'family': ..., 'specimens': ...}, ...], most common first
+    top_taxa = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        ordering = ['-specimen_count', '-expedition_id']
+        indexes = [models.Index(fields=['specimen_count', 'expedition'], name='expedition_count_idx')]
+
+    def __str__(self):
+        return f"{self.expedition_id}: {self.specimen_count} specimens"
+
+#This code defines the number of specimens of each family in each expedition, from
+#which ExpeditionStats.top_taxa is refreshed whenever one of them changes.
+class ExpeditionTaxonCount(models.Model):
+    expedition = models.ForeignKey(Expedition, on_delete=models.CASCADE, related_name='taxon_counts', db_index=False)
+    family = models.CharField(max_length=50, blank=True)
+    specimen_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['expedition', 'family'], name='expedition_family_unique')]
+        indexes = [models.Index(fields=['expedition', 'specimen_count'], name='expedition_taxon_count_idx')]
+
+    def __str__(self):
+        return f"{self.expedition_id}/{self.family}: {self.specimen_count}"
+
+#This code defines the precomputed neighbour index behind the related-specimens panel.
+#Specimens sharing the same species, genus or family (optionally also the expedition)
+#form a group, and each group keeps the ids of its newest members, one more than the
+#panel shows. The receivers in signals.py add and remove specimens as they are written.
+class NeighbourGroup(models.Model):
+    # Level and column values, e.g. 'genus:Ranidae|Rana'
+    key = models.CharField(max_length=200, unique=True)
+    level = models.CharField(max_length=20)
+    # Newest first
+    specimen_ids = models.JSONField(default=list)
+
+    def __str__(self):
+        return f"{self.key}: {len(self.specimen_ids)} specimens"
+
+#This code defines a single-row counter that is bumped on every catalogue write.
+#Caches and snapshots compare it to know when their data has gone stale.
+class DataVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Data version {self.version}"
+
+#This code defines the change feed: one row per create, update or delete of a
+#Specimen, Taxonomy or Expedition. The auto-incrementing seq gives mirrors a
+#monotonically increasing position to resume from.
+class Change(models.Model):
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = [(CREATE, 'Create'), (UPDATE, 'Update'), (DELETE, 'Delete')]
+
+    seq = models.BigAutoField(primary_key=True)
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    # Field values after the change; empty for delete tombstones
+    data = models.JSONField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+
+    def __str__(self):
+        return f"#{self.seq} {self.action} {self.model} {self.object_id}"
+
+#This code defines a background job. The table doubles as the queue that the
+#run_jobs workers claim from, and as the record of progress and results.
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    processed = models.IntegerField(default=0)
+    total = models.IntegerField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [models.Index(fields=['status', 'id'], name='job_queue_idx')]
+
+    def __str__(self):
+        return f"Job {self.pk} ({self.kind}, {self.status})"
+
+    # Rows processed per second since the job started
+    @property
+    def throughput(self):
+        if not self.started:
+            return None
+        elapsed = ((self.finished or timezone.now()) - self.started).total_seconds()
+        return round(self.processed / elapsed, 1) if elapsed > 0 else None
+
+#This code defines the id sequences used in sharding mode. Specimens and
+#expeditions live in several databases, so their primary keys are handed
+#out from these counters in the default database to stay globally unique.
+class ShardSequence(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+#This code defines a profile of one request, captured on demand for a staff
+#user. It keeps the hottest functions from cProfile and the SQL statements the
+#request ran, so a slow page can be examined in the admin afterwards.
+class ProfileCapture(models.Model):
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    status_code = models.IntegerField()
+    duration = models.FloatField()
+    query_count = models.IntegerField()
+    db_time = models.FloatField()
+    functions = models.JSONField(default=list)
+    queries = models.JSONField(default=list)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
 
     def __str__(self):
-        return f"Specimen {self.specimen_id}"
\ No newline at end of file
+        return f"{self.method} {self.path} ({self.duration * 1000:.0f} ms)"
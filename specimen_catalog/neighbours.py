@@ -0,0 +1,278 @@
+import json
+from collections import defaultdict
+from itertools import groupby
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from .models import NeighbourGroup, SpecimenRecord
+from . import sharding
+
+# Neighbour levels from the closest relation down, with the record columns their members share.
+# Related specimens are taken level by level, newest first within a level.
+LEVELS = [
+    ('species_expedition', ['family', 'genus', 'species', 'expedition_id'], 'Same species, same expedition'),
+    ('species', ['family', 'genus', 'species'], 'Same species'),
+    ('genus_expedition', ['family', 'genus', 'expedition_id'], 'Same genus, same expedition'),
+    ('genus', ['family', 'genus'], 'Same genus'),
+    ('family_expedition', ['family', 'expedition_id'], 'Same family, same expedition'),
+    ('family', ['family'], 'Same family'),
+]
+LABELS = {level: label for level, _, label in LEVELS}
+
+# Members kept per group. One more than shown is enough to skip the specimen itself and the
+# specimens already taken from a closer level, as those are members of every wider group too.
+def group_size():
+    return settings.RELATED_SPECIMENS + 1
+
+
+def group_key(level, parts):
+    return f"{level}:{'|'.join(str(part) for part in parts)}"
+
+
+# Key, level and column filters of every group the values place a specimen in.
+# Levels with an empty column (no family, no expedition, ...) are skipped.
+def group_keys(values):
+    keys = {}
+    for level, columns, _ in LEVELS:
+        parts = [values[column] for column in columns]
+        if all(part not in ('', None) for part in parts):
+            keys[group_key(level, parts)] = (level, dict(zip(columns, parts)))
+    return keys
+
+
+# Grouping values of a specimen instance, as they will be once its record is refreshed
+def values_of(specimen):
+    taxonomy = specimen.taxonomy if specimen.taxonomy_id is not None else None
+    values = {column: getattr(taxonomy, column) if taxonomy else '' for column in ('family', 'genus', 'species')}
+    return {**values, 'expedition_id': specimen.expedition_id}
+
+
+def record_values(specimen_id, using='default'):
+    return (SpecimenRecord.objects.using(using).filter(pk=specimen_id)
+            .values('family', 'genus', 'species', 'expedition_id').first())
+
+
+# Newest members of a group, read from the records
+def members(filters, using='default', exclude=None):
+    queryset = SpecimenRecord.objects.using(using).filter(**filters).order_by('-specimen_id')
+    if exclude is not None:
+        queryset = queryset.exclude(pk=exclude)
+    return list(queryset.values_list('specimen_id', flat=True)[:group_size()])
+
+
+# Adds a specimen to one group. A group seen for the first time starts from the records.
+def add(key, level, filters, specimen_id, using='default'):
+    with transaction.atomic(using=using):
+        group = NeighbourGroup.objects.using(using).select_for_update().filter(key=key).first()
+        if group is None:
+            ids = sorted(set(members(filters, using, exclude=specimen_id)) | {specimen_id}, reverse=True)
+            try:
+                with transaction.atomic(using=using):
+                    NeighbourGroup.objects.using(using).create(key=key, level=level, specimen_ids=ids[:group_size()])
+                return
+            except IntegrityError:
+                # Created by a concurrent write in between
+                group = NeighbourGroup.objects.using(using).select_for_update().get(key=key)
+
+        ids = sorted(set(group.specimen_ids) | {specimen_id}, reverse=True)[:group_size()]
+        if ids != group.specimen_ids:
+            group.specimen_ids = ids
+            group.save(update_fields=['specimen_ids'])
+
+
+# Ids left in a group after a specimen leaves it. A full group may have older members to move
+# up, so it is refilled from the records.
+def without(group, filters, specimen_id, using='default'):
+    if len(group.specimen_ids) >= group_size():
+        return members(filters, using, exclude=specimen_id)
+    return [pk for pk in group.specimen_ids if pk != specimen_id]
+
+
+# Moves a specimen from the groups of `old` to those of `new` (both as returned by group_keys).
+# All groups involved are locked and read with one query and written back with one UPDATE;
+# groups seen for the first time start from the records and groups left empty are deleted.
+def move(specimen_id, old, new, using='default'):
+    leaving = {key: old[key] for key in old.keys() - new.keys()}
+    joining = {key: new[key] for key in new.keys() - old.keys()}
+    if not leaving and not joining:
+        return
+
+    with transaction.atomic(using=using):
+        groups = (NeighbourGroup.objects.using(using).select_for_update()
+                  .in_bulk(list(leaving.keys() | joining.keys()), field_name='key'))
+        changed, created, emptied = [], [], []
+
+        for key, (level, filters) in leaving.items():
+            group = groups.get(key)
+            if group is None or specimen_id not in group.specimen_ids:
+                continue
+            ids = without(group, filters, specimen_id, using)
+            if ids:
+                group.specimen_ids = ids
+                changed.append(group)
+            else:
+                emptied.append(key)
+
+        for key, (level, filters) in joining.items():
+            group = groups.get(key)
+            if group is None:
+                ids = sorted(set(members(filters, using, exclude=specimen_id)) | {specimen_id}, reverse=True)
+                created.append(NeighbourGroup(key=key, level=level, specimen_ids=ids[:group_size()]))
+                continue
+            ids = sorted(set(group.specimen_ids) | {specimen_id}, reverse=True)[:group_size()]
+            if ids != group.specimen_ids:
+                group.specimen_ids = ids
+                changed.append(group)
+
+        if emptied:
+            NeighbourGroup.objects.using(using).filter(key__in=emptied).delete()
+        if changed:
+            NeighbourGroup.objects.using(using).bulk_update(changed, ['specimen_ids'])
+        if created:
+            try:
+                with transaction.atomic(using=using):
+                    NeighbourGroup.objects.using(using).bulk_create(created)
+            except IntegrityError:
+                # Some were created by a concurrent write in between
+                for group in created:
+                    add(group.key, group.level, joining[group.key][1], specimen_id, using)
+
+
+# Moves a saved specimen between groups. It compares against the specimen's record, so it
+# must run before the record is refreshed.
+def specimen_saved(specimen, using='default'):
+    previous = record_values(specimen.pk, using)
+    move(specimen.pk, group_keys(previous) if previous else {}, group_keys(values_of(specimen)), using)
+
+
+# Takes a specimen that is about to be deleted out of its groups
+def specimen_deleting(specimen, using='default'):
+    previous = record_values(specimen.pk, using)
+    move(specimen.pk, group_keys(previous) if previous else {}, {}, using)
+
+
+# Groups that a taxonomy's specimens leave or join when its family, genus or species changes.
+# Read before the records are refreshed; pass the result to refresh() afterwards.
+def taxonomy_groups(taxonomy, using='default'):
+    return taxonomies_groups({taxonomy.pk: taxonomy}, using)
+
+
+# Same for several taxonomies, {pk: taxonomy}
+def taxonomies_groups(taxonomies, using='default'):
+    combinations = (SpecimenRecord.objects.using(using).filter(taxonomy_id__in=list(taxonomies))
+                    .order_by().values('taxonomy_id', 'family', 'genus', 'species', 'expedition_id').distinct())
+    groups = {}
+    for values in combinations:
+        taxonomy = taxonomies[values.pop('taxonomy_id')]
+        current = {**values, 'family': taxonomy.family, 'genus': taxonomy.genus, 'species': taxonomy.species}
+        if current == values:
+            continue
+        old = group_keys(values)
+        new = group_keys(current)
+        for key in old.keys() ^ new.keys():
+            groups[key] = old.get(key) or new[key]
+    return groups
+
+
+# Recomputes the given groups from the records
+def refresh(groups, using='default'):
+    for key, (level, filters) in groups.items():
+        ids = members(filters, using)
+        if ids:
+            NeighbourGroup.objects.using(using).update_or_create(key=key, defaults={'level': level, 'specimen_ids': ids})
+        else:
+            NeighbourGroup.objects.using(using).filter(key=key).delete()
+
+
+# Recomputes many groups, e.g. all those a bulk reclassification touches, with one window query
+# per level like rebuild() instead of a query per group. Each query reads the records whose
+# values all occur among the groups' filters, and keeps the partitions of the given groups.
+def refresh_many(groups, using='default'):
+    filters_by_level = defaultdict(dict)
+    for key, (level, filters) in groups.items():
+        filters_by_level[level][key] = filters
+
+    found = []
+    for level, columns, _ in LEVELS:
+        wanted = filters_by_level.get(level)
+        if not wanted:
+            continue
+        rows = (SpecimenRecord.objects.using(using)
+                .filter(**{f'{column}__in': list({filters[column] for filters in wanted.values()}) for column in columns})
+                .annotate(position=Window(RowNumber(), partition_by=[F(column) for column in columns],
+                                          order_by=F('specimen_id').desc()))
+                .filter(position__lte=group_size())
+                .order_by(*columns, '-specimen_id').values_list(*columns, 'specimen_id'))
+        for parts, grouped in groupby(rows.iterator(), key=lambda row: row[:-1]):
+            key = group_key(level, parts)
+            if key in wanted:
+                found.append(NeighbourGroup(key=key, level=level, specimen_ids=[row[-1] for row in grouped]))
+
+    with transaction.atomic(using=using):
+        NeighbourGroup.objects.using(using).filter(key__in=list(groups)).delete()
+        NeighbourGroup.objects.using(using).bulk_create(found, batch_size=500)
+
+
+# Up to `limit` specimens related to a specimen as (record, level) pairs, closest level first.
+# Reads the specimen's groups and then their records, on every shard when sharding is enabled.
+def related(specimen, limit=None):
+    limit = min(limit or settings.RELATED_SPECIMENS, settings.RELATED_SPECIMENS)
+    keys = group_keys(values_of(specimen))
+    # Without sharding the router picks the database, so replicas serve these reads too
+    aliases = sharding.shard_aliases() if sharding.enabled() else [None]
+
+    candidates = {}
+    for alias in aliases:
+        for key, ids in NeighbourGroup.objects.using(alias).filter(key__in=keys).values_list('key', 'specimen_ids'):
+            candidates.setdefault(key, []).extend((pk, alias) for pk in ids)
+
+    chosen = []
+    seen = {specimen.pk}
+    for key, (level, filters) in keys.items():
+        if key not in candidates:
+            # Only a group the index has not been built for yet can be missing, as it would hold
+            # the specimen itself; its members are read from the records instead
+            candidates[key] = [(pk, alias) for alias in aliases for pk in members(filters, alias)]
+        for pk, alias in sorted(candidates[key], reverse=True, key=lambda candidate: candidate[0]):
+            if pk not in seen and len(chosen) < limit:
+                seen.add(pk)
+                chosen.append((pk, alias, level))
+        if len(chosen) == limit:
+            break
+
+    records = {}
+    for alias in {alias for _, alias, _ in chosen}:
+        records.update(SpecimenRecord.objects.using(alias).in_bulk([pk for pk, other, _ in chosen if other == alias]))
+    return [(records[pk], level) for pk, _, level in chosen if pk in records]
+
+
+# Rebuilds every group of one database from the records and returns how many there are.
+# One window query per level picks the newest members of all its groups, and the groups are
+# written with executemany, skipping model instances.
+def rebuild(using='default'):
+    groups = []
+    for level, columns, _ in LEVELS:
+        rows = (SpecimenRecord.objects.using(using)
+                .annotate(position=Window(RowNumber(), partition_by=[F(column) for column in columns],
+                                          order_by=F('specimen_id').desc()))
+                .filter(position__lte=group_size()))
+        for column in columns:
+            rows = rows.exclude(**{column: ''}) if column != 'expedition_id' else rows.filter(expedition_id__isnull=False)
+        rows = rows.order_by(*columns, '-specimen_id').values_list(*columns, 'specimen_id')
+        for parts, grouped in groupby(rows.iterator(), key=lambda row: row[:-1]):
+            groups.append((group_key(level, parts), level, json.dumps([row[-1] for row in grouped])))
+
+    table = NeighbourGroup._meta.db_table
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table}')
+        cursor.executemany(f'INSERT INTO {table} (key, level, specimen_ids) VALUES (%s, %s, %s)', groups)
+    return len(groups)
+
+
+# Rebuilds the default database, or every shard when sharding is enabled
+def rebuild_all():
+    aliases = sharding.shard_aliases() if sharding.enabled() else ['default']
+    return {alias: rebuild(alias) for alias in aliases}
@@ -0,0 +1,46 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+from rest_framework.pagination import PageNumberPagination
+
+from . import instrumentation, versioning
+
+
+# Cache key of a queryset's row count at the current data version, so any write makes every
+# cached count stale. A sharded queryset is keyed by the query it runs on each shard.
+def count_key(object_list):
+    queryset = getattr(object_list, 'queryset', object_list)
+    query = getattr(queryset, 'query', None)
+    if query is None:
+        return None
+    sql, params = query.sql_with_params()
+    digest = hashlib.sha1(repr((type(object_list).__name__, queryset.db, sql, params)).encode()).hexdigest()
+    return f'count:{versioning.current_version()}:{digest}'
+
+
+# Paginator that shares the COUNT(*) behind its page links through the cache. Counting a
+# filtered SpecimenRecord table scans it, while the page itself is a short indexed read.
+class CachedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        key = count_key(self.object_list)
+        if key is None:
+            return super().count
+
+        count = cache.get(key)
+        instrumentation.record_cache(count is not None)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, settings.COUNT_CACHE_TIMEOUT)
+        return count
+
+
+# Page-numbered API pagination (?page=, ?page_size=) that counts through CachedCountPaginator
+class ExpeditionStatsPagination(PageNumberPagination):
+    django_paginator_class = CachedCountPaginator
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
@@ -0,0 +1,65 @@
+import cProfile
+import pstats
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import ProfileCapture
+
+
+# True when the request asks to be profiled and is allowed to be
+def requested(request):
+    if settings.PROFILING_PARAMETER not in request.GET:
+        return False
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_staff
+
+
+# True while fewer than PROFILING_RATE_LIMIT captures were stored in the last
+# PROFILING_RATE_WINDOW seconds, counted over all workers through the table itself
+def within_rate_limit():
+    since = timezone.now() - timedelta(seconds=settings.PROFILING_RATE_WINDOW)
+    return ProfileCapture.objects.filter(created__gte=since).count() < settings.PROFILING_RATE_LIMIT
+
+
+# The hottest functions of a profile, sorted by cumulative time
+def hot_functions(profiler, limit):
+    stats = pstats.Stats(profiler).stats
+    rows = [
+        {
+            'function': function,
+            'file': filename,
+            'line': line,
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'tottime': round(total_time, 6),
+            'cumtime': round(cumulative_time, 6),
+        }
+        for (filename, line, function), (primitive_calls, calls, total_time, cumulative_time, _) in stats.items()
+    ]
+    rows.sort(key=lambda row: row['cumtime'], reverse=True)
+    return rows[:limit]
+
+
+# Runs the rest of the request under cProfile and returns the response and its stored capture
+def profile(request, get_response, timings):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        response = get_response(request)
+    finally:
+        profiler.disable()
+
+    capture = ProfileCapture.objects.create(
+        method=request.method,
+        path=request.get_full_path()[:500],
+        user=request.user if request.user.is_authenticated else None,
+        status_code=response.status_code,
+        duration=timings.total(),
+        query_count=len(timings.queries),
+        db_time=timings.db_time,
+        functions=hot_functions(profiler, settings.PROFILING_TOP_FUNCTIONS),
+        queries=[{'sql': sql, 'duration': round(duration, 6)} for duration, sql in timings.queries],
+    )
+    return response, capture
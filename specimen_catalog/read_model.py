@@ -0,0 +1,120 @@
+from django.db import connections, transaction
+from django.db.models import OuterRef, Subquery
+from .models import Specimen, SpecimenRecord, Expedition, Taxonomy
+
+# Number of rows written per INSERT when rebuilding the read model
+REBUILD_BATCH_SIZE = 2000
+
+# Columns copied from Taxonomy and Expedition into SpecimenRecord
+TAXONOMY_COLUMNS = ['kingdom', 'phylum', 'highest_biostratigraphic_zone', 'class_name',
+                    'identification_description', 'family', 'genus', 'species']
+EXPEDITION_COLUMNS = {'expedition_name': 'expedition', 'continent': 'continent', 'country': 'country'}
+
+# Path of every SpecimenRecord column in a Specimen.objects.values() query
+SPECIMEN_VALUES = {
+    'specimen_id': 'specimen_id',
+    'catalog_number': 'catalog_number',
+    'expedition_id': 'expedition_id',
+    'taxonomy_id': 'taxonomy_id',
+    **{column: f'expedition__{field}' for column, field in EXPEDITION_COLUMNS.items()},
+    **{column: f'taxonomy__{column}' for column in TAXONOMY_COLUMNS},
+}
+
+
+# Returns the taxonomy columns of a record for the given taxonomy (blank when missing)
+def taxonomy_columns(taxonomy):
+    return {column: getattr(taxonomy, column) if taxonomy else '' for column in TAXONOMY_COLUMNS}
+
+
+# Returns the expedition columns of a record for the given expedition (blank when missing)
+def expedition_columns(expedition):
+    return {column: getattr(expedition, field) if expedition else '' for column, field in EXPEDITION_COLUMNS.items()}
+
+
+# Builds an unsaved SpecimenRecord from a row returned by Specimen.objects.values(*SPECIMEN_VALUES.values())
+def record_from_values(row):
+    values = {column: row[path] for column, path in SPECIMEN_VALUES.items()}
+
+    # Specimens without a taxonomy or expedition get blank text columns, like the templates expect
+    for column in TAXONOMY_COLUMNS + list(EXPEDITION_COLUMNS):
+        values[column] = values[column] or ''
+
+    return SpecimenRecord(**values)
+
+
+# Creates or refreshes the read model row of a single specimen in the database it was saved to
+def sync_specimen(specimen, using='default'):
+    defaults = {
+        'catalog_number': specimen.catalog_number,
+        'expedition_id': specimen.expedition_id,
+        'taxonomy_id': specimen.taxonomy_id,
+        **expedition_columns(specimen.expedition),
+        **taxonomy_columns(specimen.taxonomy),
+    }
+    SpecimenRecord.objects.using(using).update_or_create(specimen_id=specimen.pk, defaults=defaults)
+
+
+# Pushes changed taxonomy columns to every record that references the taxonomy
+def sync_taxonomy(taxonomy, using='default'):
+    return SpecimenRecord.objects.using(using).filter(taxonomy_id=taxonomy.pk).update(**taxonomy_columns(taxonomy))
+
+
+# Pushes the given taxonomy columns of several taxonomies to their records in one UPDATE
+def sync_taxonomies(taxonomy_ids, columns=TAXONOMY_COLUMNS, using='default'):
+    taxonomy = Taxonomy.objects.using(using).filter(pk=OuterRef('taxonomy_id'))
+    return SpecimenRecord.objects.using(using).filter(taxonomy_id__in=list(taxonomy_ids)).update(
+        **{column: Subquery(taxonomy.values(column)[:1]) for column in columns})
+
+
+# Pushes changed expedition columns to every record that references the expedition
+def sync_expedition(expedition, using='default'):
+    return SpecimenRecord.objects.using(using).filter(expedition_id=expedition.pk).update(**expedition_columns(expedition))
+
+
+# Refreshes the records of the given specimen ids (used after bulk writes that bypass signals)
+def sync_specimen_ids(specimen_ids):
+    specimen_ids = list(specimen_ids)
+    rows = Specimen.objects.filter(pk__in=specimen_ids).order_by().values(*SPECIMEN_VALUES.values())
+    with transaction.atomic():
+        SpecimenRecord.objects.filter(specimen_id__in=specimen_ids).delete()
+        SpecimenRecord.objects.bulk_create([record_from_values(row) for row in rows], batch_size=REBUILD_BATCH_SIZE)
+
+
+# Drops and rebuilds the whole read model from the normalised tables
+def rebuild(batch_size=REBUILD_BATCH_SIZE):
+    rows = Specimen.objects.order_by().values(*SPECIMEN_VALUES.values())
+    total = 0
+
+    with transaction.atomic():
+        SpecimenRecord.objects.all().delete()
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(record_from_values(row))
+            if len(batch) >= batch_size:
+                SpecimenRecord.objects.bulk_create(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            SpecimenRecord.objects.bulk_create(batch)
+            total += len(batch)
+
+    return total
+
+
+# Creates the records of every specimen with a primary key above after_id in one INSERT ... SELECT.
+# For rows written in bulk with direct SQL, where building model instances would be the bottleneck.
+def insert_records_after(after_id=0, using='default'):
+    columns = ['specimen_id', 'catalog_number', 'expedition_id', 'taxonomy_id'] + list(EXPEDITION_COLUMNS) + TAXONOMY_COLUMNS
+    selected = (['s.specimen_id', 's.catalog_number', 's.expedition_id', 's.taxonomy_id']
+                + [f"COALESCE(e.{field}, '')" for field in EXPEDITION_COLUMNS.values()]
+                + [f"COALESCE(t.{column}, '')" for column in TAXONOMY_COLUMNS])
+    sql = (
+        f"INSERT INTO {SpecimenRecord._meta.db_table} ({', '.join(columns)}) "
+        f"SELECT {', '.join(selected)} FROM {Specimen._meta.db_table} s "
+        f"LEFT JOIN {Expedition._meta.db_table} e ON e.expedition_id = s.expedition_id "
+        f"LEFT JOIN {Taxonomy._meta.db_table} t ON t.taxonomy_id = s.taxonomy_id "
+        f"WHERE s.specimen_id > %s"
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [after_id])
+        return cursor.rowcount
@@ -0,0 +1,153 @@
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, Count, F, Value, When
+from django.db.models.functions import Concat, Length, Substr
+
+from .models import Specimen, SpecimenRecord, Taxonomy
+from .read_model import TAXONOMY_COLUMNS
+from . import changes, expedition_stats, neighbours, read_model, reference_cache, sharding, taxon_index, validation, versioning
+
+
+# Checks the new rank values of a reclassification, {rank: name}, against the form rules and
+# returns them normalised, e.g. {'genus': 'Lithobates'} or {'family': 'Ranidae'}
+def clean_changes(new_values):
+    unknown = set(new_values) - set(TAXONOMY_COLUMNS)
+    if unknown:
+        raise ValidationError(f'Unknown ranks: {", ".join(sorted(unknown))}. Choose from: {", ".join(TAXONOMY_COLUMNS)}.')
+    if not new_values:
+        raise ValidationError('Set at least one rank.')
+
+    table = validation.validate_columns({rank: [name] for rank, name in new_values.items()})
+    if table:
+        raise ValidationError([f"{validation.TAXONOMY_LABELS[error['field']]}: {error['message']}" for error in table.as_list()])
+    return {rank: taxon_index.normalise(str(name)) for rank, name in new_values.items()}
+
+
+# Column expressions of the UPDATE. A renamed genus also renames the species written as
+# binomials that start with it, so "Rana temporaria" becomes "Lithobates temporaria".
+def expressions(new_values):
+    columns = {rank: Value(name) for rank, name in new_values.items()}
+    if 'genus' in new_values and 'species' not in new_values:
+        columns['species'] = Case(
+            When(species__startswith=Concat(F('genus'), Value(' ')),
+                 then=Concat(Value(f"{new_values['genus']} "), Substr('species', Length('genus') + 2))),
+            default=F('species'),
+        )
+    return columns
+
+
+def databases():
+    return sharding.shard_aliases() if sharding.enabled() else ['default']
+
+
+# What a reclassification of the taxonomies in queryset would do, without writing anything.
+# One grouped query per database counts taxonomies and specimens per current classification,
+# with the classification they would get computed by the same expressions as the UPDATE.
+# Groups whose new classification another taxonomy already has are marked as merges.
+def preview(queryset, new_values):
+    new_values = clean_changes(new_values)
+    annotations = {f'new_{column}': expression for column, expression in expressions(new_values).items()}
+
+    groups = {}
+    for alias in databases():
+        rows = (queryset.using(alias).order_by().values(*TAXONOMY_COLUMNS)
+                .annotate(taxonomies=Count('pk', distinct=True), specimens=Count('specimen'), **annotations))
+        for row in rows:
+            current = tuple(row[column] for column in TAXONOMY_COLUMNS)
+            group = groups.setdefault(current, {
+                'current': {column: row[column] for column in TAXONOMY_COLUMNS},
+                'new': {column: row.get(f'new_{column}', row[column]) for column in TAXONOMY_COLUMNS},
+                'taxonomies': row['taxonomies'], 'specimens': 0,
+            })
+            group['specimens'] += row['specimens']
+
+    # Taxonomies sharing each resulting classification, in the selection and outside it
+    resulting = Counter()
+    for group in groups.values():
+        resulting[tuple(group['new'].values())] += group['taxonomies']
+    others = (Taxonomy.objects.filter(**new_values).exclude(pk__in=queryset.values('pk'))
+              .order_by().values_list(*TAXONOMY_COLUMNS).annotate(taxonomies=Count('pk')))
+    for *classification, count in others:
+        if tuple(classification) in resulting:
+            resulting[tuple(classification)] += count
+
+    for group in groups.values():
+        group['merges'] = resulting[tuple(group['new'].values())] > 1
+    return {
+        'groups': sorted(groups.values(), key=lambda group: -group['specimens']),
+        'taxonomies': sum(group['taxonomies'] for group in groups.values()),
+        'specimens': sum(group['specimens'] for group in groups.values()),
+        'merged': sum(count - 1 for count in resulting.values()),
+    }
+
+
+# Reclassifies the taxonomies in queryset, e.g. apply(Taxonomy.objects.filter(genus='Rana'),
+# {'family': 'Ranidae'}), and returns how many taxonomies and specimens changed and how many
+# taxonomies were merged. The taxonomies are rewritten with one UPDATE in a transaction, then
+# taxonomies that became identical are merged into the oldest one. The records, expedition
+# counters, neighbour groups, change feed, data version, reference cache and taxon name index
+# are brought up to date in the same pass instead of through a save signal per taxonomy.
+def apply(queryset, new_values):
+    new_values = clean_changes(new_values)
+    columns = expressions(new_values)
+
+    with ExitStack() as stack:
+        for alias in {'default', *databases()}:
+            stack.enter_context(transaction.atomic(using=alias))
+
+        ids = list(queryset.order_by().values_list('pk', flat=True))
+        if not ids:
+            return {'taxonomies': 0, 'specimens': 0, 'merged': 0}
+        Taxonomy.objects.filter(pk__in=ids).update(**columns)
+        taxonomies = Taxonomy.objects.in_bulk(ids)
+
+        specimens = 0
+        for alias in databases():
+            if alias != 'default':
+                # Taxonomies are copied to every shard; the copies take the same UPDATE
+                Taxonomy.objects.using(alias).filter(pk__in=ids).update(**columns)
+            expedition_stats.taxonomies_saved(taxonomies, alias)
+            groups = neighbours.taxonomies_groups(taxonomies, alias)
+            specimens += read_model.sync_taxonomies(ids, list(columns), alias)
+            neighbours.refresh_many(groups, alias)
+
+        merged = merge_duplicates(ids, new_values)
+        changes.record_updates(taxonomy for pk, taxonomy in taxonomies.items() if pk not in merged)
+        versioning.bump_version()
+
+    reference_cache.for_model(Taxonomy).invalidate(ids)
+    taxon_index.clear()
+    return {'taxonomies': len(ids), 'specimens': specimens, 'merged': len(merged)}
+
+
+# Merges taxonomies that now share a classification with another one into the oldest of them
+# and returns {merged pk: kept pk}. Only classifications of the given taxonomies are merged.
+# Specimens move to the kept taxonomy (with a change feed entry each), and the merged ones are
+# deleted through the ORM so their deletes reach the feed, caches and shards like any other.
+def merge_duplicates(ids, new_values):
+    classifications = defaultdict(list)
+    for pk, *classification in Taxonomy.objects.filter(**new_values).order_by('pk').values_list('pk', *TAXONOMY_COLUMNS):
+        classifications[tuple(classification)].append(pk)
+
+    selected = set(ids)
+    merged = {}
+    for pks in classifications.values():
+        if len(pks) > 1 and selected.intersection(pks):
+            merged.update((pk, pks[0]) for pk in pks[1:])
+    if not merged:
+        return merged
+
+    kept = Case(*[When(taxonomy_id=pk, then=Value(keep)) for pk, keep in merged.items()])
+    for alias in databases():
+        moved = list(Specimen.objects.using(alias).filter(taxonomy_id__in=list(merged)))
+        Specimen.objects.using(alias).filter(taxonomy_id__in=list(merged)).update(taxonomy_id=kept)
+        SpecimenRecord.objects.using(alias).filter(taxonomy_id__in=list(merged)).update(taxonomy_id=kept)
+        for specimen in moved:
+            specimen.taxonomy_id = merged[specimen.taxonomy_id]
+        changes.record_updates(moved)
+
+    Taxonomy.objects.filter(pk__in=list(merged)).delete()
+    return merged
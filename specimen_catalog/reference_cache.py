@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Expedition, Specimen, Taxonomy
+from . import instrumentation, sharding, versioning
+
+# Primary keys per IN (...) query, below SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+# Base of the compact per-model records: one slot per concrete field, nothing else
+class Record:
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, values):
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+
+    @property
+    def pk(self):
+        return getattr(self, self.fields[0])
+
+    def values(self):
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def as_dict(self):
+        return dict(zip(self.fields, self.values()))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __repr__(self):
+        return f'{type(self).__name__}{self.values()!r}'
+
+
+# Read-through cache of one reference model by primary key. The first tier is a bounded LRU of
+# records in this process; the second is the Django cache, which is per process unless CACHES
+# points at a shared backend. Saves and deletes evict both tiers of the writing process through
+# signals. Other processes notice the data version move (checked at most every CHECK_INTERVAL
+# seconds): they drop their LRU, and as second-tier keys carry the data version, entries cached
+# before the write are no longer read either.
+class ReferenceCache:
+    def __init__(self, model, size=None, timeout=None, check_interval=None):
+        self.model = model
+        self.fields = [field.attname for field in model._meta.concrete_fields]
+        self.record_class = type(f'{model.__name__}Record', (Record,), {'__slots__': tuple(self.fields),
+                                                                         'fields': tuple(self.fields)})
+        self.size = size or getattr(settings, 'REFERENCE_CACHE_SIZE', 5000)
+        self.timeout = timeout or getattr(settings, 'REFERENCE_CACHE_TIMEOUT', 3600)
+        self.check_interval = getattr(settings, 'REFERENCE_CACHE_CHECK_INTERVAL', 1.0) if check_interval is None else check_interval
+        self.prefix = f'ref:{model._meta.label_lower}:'
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked = 0.0
+        self.local_hits = self.shared_hits = self.misses = 0
+
+    def get(self, pk):
+        return self.get_many([pk]).get(pk)
+
+    # Records for the given primary keys as {pk: record}; keys without a row are left out.
+    # Whatever neither tier holds is loaded with one query per CHUNK_SIZE keys.
+    def get_many(self, ids):
+        self._check_version()
+        wanted = list(dict.fromkeys(pk for pk in ids if pk is not None))
+        found = {}
+
+        with self.lock:
+            for pk in wanted:
+                record = self.local.get(pk)
+                if record is not None:
+                    self.local.move_to_end(pk)
+                    found[pk] = record
+        local_hits = len(found)
+
+        not_local = [pk for pk in wanted if pk not in found]
+        if not_local:
+            shared = cache.get_many([self._key(pk) for pk in not_local])
+            for pk in not_local:
+                values = shared.get(self._key(pk))
+                if values is not None:
+                    found[pk] = self.record_class(values)
+        shared_hits = len(found) - local_hits
+
+        missing = [pk for pk in not_local if pk not in found]
+        loaded = self._load(missing) if missing else {}
+        if loaded:
+            cache.set_many({self._key(pk): record.values() for pk, record in loaded.items()}, self.timeout)
+            found.update(loaded)
+
+        self._remember([found[pk] for pk in not_local if pk in found])
+        with self.lock:
+            self.local_hits += local_hits
+            self.shared_hits += shared_hits
+            self.misses += len(missing)
+        for hit in [True] * (local_hits + shared_hits) + [False] * len(missing):
+            instrumentation.record_cache(hit)
+        return found
+
+    # Second-tier key of a row in the data version this process last saw
+    def _key(self, pk):
+        return f'{self.prefix}{self.version}:{pk}'
+
+    def _load(self, ids):
+        loaded = {}
+        for start in range(0, len(ids), CHUNK_SIZE):
+            queryset = sharding.sharded(self.model.objects.filter(pk__in=ids[start:start + CHUNK_SIZE]))
+            for instance in queryset:
+                record = self.record_class([getattr(instance, field) for field in self.fields])
+                loaded[record.pk] = record
+        return loaded
+
+    def _remember(self, records):
+        with self.lock:
+            for record in records:
+                self.local[record.pk] = record
+                self.local.move_to_end(record.pk)
+            while len(self.local) > self.size:
+                self.local.popitem(last=False)
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        version = versioning.current_version()
+        with self.lock:
+            if version != self.version:
+                self.local.clear()
+                self.version = version
+            self.checked = now
+
+    # Evicts rows from both tiers, again once the surrounding transaction commits, so a
+    # concurrent reader cannot put the old row back into the shared tier in between
+    def invalidate(self, ids):
+        keys = [self._key(pk) for pk in ids]
+        with self.lock:
+            for pk in ids:
+                self.local.pop(pk, None)
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+            self.local_hits = self.shared_hits = self.misses = 0
+
+    # Lookups served per tier since start (or the last clear) and the share served by a cache
+    def stats(self):
+        with self.lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+            return {
+                'size': len(self.local),
+                'capacity': self.size,
+                'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.local_hits + self.shared_hits) / lookups if lookups else None,
+            }
+
+    # A model instance built from a record, as if loaded from the given database
+    def instance(self, record, using='default'):
+        return self.model.from_db(using, self.fields, record.values())
+
+
+taxa = ReferenceCache(Taxonomy)
+expeditions = ReferenceCache(Expedition)
+
+_caches = {Taxonomy: taxa, Expedition: expeditions}
+
+
+def for_model(model):
+    return _caches.get(model)
+
+
+# Fills the taxonomy and expedition of every specimen from the cache, with one get_many per
+# model for the whole list, so templates and serializers read them without a query each
+def attach(specimens):
+    specimens = list(specimens)
+    for field_name, reference in (('taxonomy', taxa), ('expedition', expeditions)):
+        field = Specimen._meta.get_field(field_name)
+        records = reference.get_many(getattr(specimen, field.attname) for specimen in specimens)
+        for specimen in specimens:
+            record = records.get(getattr(specimen, field.attname))
+            if record is not None and not field.is_cached(specimen):
+                field.set_cached_value(specimen, reference.instance(record, specimen._state.db or 'default'))
+    return specimens
+
+
+# Hit-rate statistics of both reference caches in this process
+def stats():
+    return {'taxonomy': taxa.stats(), 'expedition': expeditions.stats()}
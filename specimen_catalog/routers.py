@@ -0,0 +1,69 @@
+import os
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Set while a request must read from the primary (its own writes may not be replicated yet)
+_pinned = ContextVar('pin_primary', default=False)
+
+# Apps whose reads always go to the primary because they are written on almost every request
+PRIMARY_ONLY_APPS = {'sessions'}
+
+# How long the list of fresh replicas is reused before the marker files are checked again
+FRESHNESS_CHECK_INTERVAL = 1.0
+
+
+# Routes all reads of the current context to the primary until unpin_primary(token) is called
+def pin_primary():
+    return _pinned.set(True)
+
+
+def unpin_primary(token):
+    _pinned.reset(token)
+
+
+# File touched by replicate_databases each time a replica has been refreshed
+def synced_marker(alias):
+    return f"{settings.DATABASES[alias]['NAME']}.synced"
+
+
+# Seconds since the replica was last refreshed (None if it never was)
+def replica_lag(alias):
+    try:
+        return time.time() - os.path.getmtime(synced_marker(alias))
+    except OSError:
+        return None
+
+
+# Sends writes to the primary and reads to a random replica refreshed within REPLICA_MAX_LAG.
+# Reads fall back to the primary when every replica is stale or the request is pinned.
+class PrimaryReplicaRouter:
+    def __init__(self):
+        self._fresh = []
+        self._checked = 0.0
+
+    def fresh_replicas(self):
+        if time.monotonic() - self._checked > FRESHNESS_CHECK_INTERVAL:
+            self._fresh = [alias for alias in settings.DATABASE_REPLICA_ALIASES
+                           if (lag := replica_lag(alias)) is not None and lag <= settings.REPLICA_MAX_LAG]
+            self._checked = time.monotonic()
+        return self._fresh
+
+    def db_for_read(self, model, **hints):
+        if _pinned.get() or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return 'default'
+        replicas = self.fresh_replicas()
+        return random.choice(replicas) if replicas else 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every database holds the same data, so objects can always be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary and get their schema from it
+        return db == 'default'
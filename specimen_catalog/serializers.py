@@ -1,11 +1,25 @@
 from rest_framework import serializers
-from .models import Expedition, Taxonomy, Specimen
+from .models import Expedition, ExpeditionStats, Taxonomy, Specimen, SpecimenRecord, Job
+from .read_model import TAXONOMY_COLUMNS, EXPEDITION_COLUMNS
+from .jobs import HANDLERS
 
 class ExpeditionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Expedition
         fields = '__all__'
 
+# Read-only expedition counters with the expedition's name and place
+class ExpeditionStatsSerializer(serializers.ModelSerializer):
+    expedition_id = serializers.IntegerField(read_only=True)
+    expedition = serializers.CharField(source='expedition.expedition', read_only=True)
+    continent = serializers.CharField(source='expedition.continent', read_only=True)
+    country = serializers.CharField(source='expedition.country', read_only=True)
+
+    class Meta:
+        model = ExpeditionStats
+        fields = ['expedition_id', 'expedition', 'continent', 'country', 'specimen_count', 'top_taxa']
+        read_only_fields = ['specimen_count', 'top_taxa']
+
 class TaxonomySerializer(serializers.ModelSerializer):
     class Meta:
         model = Taxonomy
@@ -31,4 +45,45 @@ class SpecimenSerializer(serializers.ModelSerializer):
         if taxonomy_data:
             Taxonomy.objects.create(specimen=specimen, **taxonomy_data)
 
-        return specimen
\ No newline at end of file
+        return specimen
+
+# Read-only serializer for the flat SpecimenRecord table.
+# Produces the same nested shape as SpecimenSerializer without touching the joined tables.
+class SpecimenRecordSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SpecimenRecord
+        fields = '__all__'
+
+    def to_representation(self, instance):
+        expedition = None
+        if instance.expedition_id is not None:
+            expedition = {'expedition_id': instance.expedition_id}
+            expedition.update({field: getattr(instance, column) for column, field in EXPEDITION_COLUMNS.items()})
+
+        taxonomy = None
+        if instance.taxonomy_id is not None:
+            taxonomy = {'taxonomy_id': instance.taxonomy_id}
+            taxonomy.update({column: getattr(instance, column) for column in TAXONOMY_COLUMNS})
+
+        return {
+            'specimen_id': instance.specimen_id,
+            'expedition': expedition,
+            'taxonomy': taxonomy,
+            'catalog_number': instance.catalog_number,
+        }
+
+# Serializer for background jobs; only kind and params can be set by clients
+class JobSerializer(serializers.ModelSerializer):
+    throughput = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'params', 'status', 'processed', 'total', 'throughput',
+                  'result', 'error', 'worker', 'created', 'started', 'finished']
+        read_only_fields = ['status', 'processed', 'total', 'result', 'error', 'worker',
+                            'created', 'started', 'finished']
+
+    def validate_kind(self, value):
+        if value not in HANDLERS:
+            raise serializers.ValidationError(f'Unknown job kind. Choose from: {", ".join(sorted(HANDLERS))}.')
+        return value
@@ -0,0 +1,271 @@
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import (Specimen, Expedition, Taxonomy, SpecimenRecord, ExpeditionStats, ExpeditionTaxonCount,
+                     NeighbourGroup, ShardSequence)
+from . import read_model, expedition_stats, neighbours
+
+# Models partitioned by continent; every other model lives in the default database
+SHARDED_MODELS = {Specimen, Expedition, SpecimenRecord}
+
+# Tables created on the shards: the partitioned models, the taxonomy copy and the tables derived from them
+SHARD_TABLES = {model._meta.model_name for model in
+                SHARDED_MODELS | {Taxonomy, ExpeditionStats, ExpeditionTaxonCount, NeighbourGroup}}
+
+_executor = None
+
+
+# True when DATABASE_SHARDS is set and specimens are spread over shard databases
+def enabled():
+    return bool(getattr(settings, 'DATABASE_SHARD_ALIASES', None))
+
+
+def shard_aliases():
+    return list(settings.DATABASE_SHARD_ALIASES)
+
+
+# Returns the shard holding expeditions of a continent.
+# SHARD_CONTINENTS can pin continents to shards; other continents are spread by a stable hash.
+def shard_for_continent(continent):
+    continent = (continent or '').strip().title()
+    pinned = getattr(settings, 'SHARD_CONTINENTS', {})
+    if continent in pinned:
+        return pinned[continent]
+    aliases = shard_aliases()
+    return aliases[zlib.crc32(continent.encode()) % len(aliases)]
+
+
+# Returns the shard for a continent when sharding is enabled, otherwise None (normal routing)
+def database_for_continent(continent):
+    return shard_for_continent(continent) if enabled() else None
+
+
+# Returns the shard a sharded instance is, or will be, stored in. Expeditions stay on the shard
+# they were created on; specimens follow their expedition, so a specimen moved to an expedition
+# on another shard is written there (see move_between_shards).
+def shard_for_instance(instance):
+    if isinstance(instance, Specimen):
+        return shard_for_specimen(instance)
+
+    if instance._state.db and not instance._state.adding:
+        return instance._state.db
+
+    if isinstance(instance, Expedition):
+        return shard_for_continent(instance.continent)
+
+    return None
+
+
+# Returns the shard of a specimen's expedition, or the one it is stored in when it has none
+def shard_for_specimen(specimen):
+    stored = specimen._state.db if not specimen._state.adding else None
+    if Specimen.expedition.is_cached(specimen) and specimen.expedition is not None:
+        return specimen.expedition._state.db or shard_for_continent(specimen.expedition.continent)
+    if specimen.expedition_id is None:
+        return stored or shard_for_continent('')
+
+    # The expedition is usually still on the specimen's own shard, which saves a fan-out
+    if stored and Expedition.objects.using(stored).filter(pk=specimen.expedition_id).exists():
+        return stored
+    expedition = ShardedQuerySet(Expedition.objects.all(), order_field='expedition_id').get(pk=specimen.expedition_id)
+    return expedition._state.db
+
+
+# Hands out the next id of a sequence from the default database
+def next_id(name):
+    with transaction.atomic(using='default'):
+        if not ShardSequence.objects.using('default').filter(name=name).update(value=F('value') + 1):
+            ShardSequence.objects.using('default').create(name=name, value=1)
+        return ShardSequence.objects.using('default').values_list('value', flat=True).get(name=name)
+
+
+# Runs fn(alias) on every shard in parallel and returns the results in shard order.
+# Worker threads keep one connection per shard, so repeated fan-outs reuse them.
+def fan_out(fn, aliases=None):
+    global _executor
+    aliases = aliases or shard_aliases()
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(len(shard_aliases()), 1), thread_name_prefix='shard')
+    return list(_executor.map(fn, aliases))
+
+
+# Merges per-shard lists that are each sorted by key into one sorted iterator
+def merge_sorted(lists, key, descending=True):
+    return heapq.merge(*lists, key=key, reverse=descending)
+
+
+# Read-only stand-in for a QuerySet that is spread over every shard.
+# Filtering is applied on each shard; counts are summed and rows are merged by order_field,
+# so list views, django-filter and the Paginator can use it like a normal queryset.
+class ShardedQuerySet:
+    def __init__(self, queryset, order_field='specimen_id', descending=True, aliases=None):
+        self.queryset = queryset
+        self.order_field = order_field
+        self.descending = descending
+        self.aliases = aliases or shard_aliases()
+        self.ordered = True
+
+    @property
+    def model(self):
+        return self.queryset.model
+
+    def _clone(self, queryset):
+        return ShardedQuerySet(queryset, self.order_field, self.descending, self.aliases)
+
+    def all(self):
+        return self._clone(self.queryset.all())
+
+    def filter(self, *args, **kwargs):
+        return self._clone(self.queryset.filter(*args, **kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return self._clone(self.queryset.exclude(*args, **kwargs))
+
+    def distinct(self, *fields):
+        return self._clone(self.queryset.distinct(*fields))
+
+    def none(self):
+        return self._clone(self.queryset.none())
+
+    # Rows of one shard in merge order
+    def _ordered(self, alias):
+        prefix = '-' if self.descending else ''
+        return self.queryset.using(alias).order_by(f'{prefix}{self.order_field}')
+
+    def _key(self, obj):
+        return getattr(obj, self.order_field)
+
+    def count(self):
+        return sum(fan_out(lambda alias: self.queryset.using(alias).count(), self.aliases))
+
+    def exists(self):
+        return any(fan_out(lambda alias: self.queryset.using(alias).exists(), self.aliases))
+
+    def get(self, *args, **kwargs):
+        found = [obj for rows in fan_out(lambda alias: list(self.queryset.using(alias).filter(*args, **kwargs)[:2]),
+                                         self.aliases) for obj in rows]
+        if not found:
+            raise self.model.DoesNotExist(f'{self.model._meta.object_name} matching query does not exist.')
+        if len(found) > 1:
+            raise self.model.MultipleObjectsReturned(f'get() returned more than one {self.model._meta.object_name}.')
+        return found[0]
+
+    # Keyset page: the first limit rows after the given order_field value, merged across shards
+    def page_after(self, after=None, limit=20):
+        lookup = f"{self.order_field}__{'lt' if self.descending else 'gt'}"
+        queryset = self.queryset if after is None else self.queryset.filter(**{lookup: after})
+        sharded = self._clone(queryset)
+        return sharded[:limit]
+
+    def __getitem__(self, item):
+        if isinstance(item, int):
+            return self[item:item + 1][0]
+
+        # Each shard returns its first `stop` rows; the merged list is then sliced once
+        start, stop = item.start or 0, item.stop
+        if stop is None:
+            return list(islice(iter(self), start, None))
+        rows = fan_out(lambda alias: list(self._ordered(alias)[:stop]), self.aliases)
+        return list(islice(merge_sorted(rows, self._key, self.descending), start, stop))
+
+    def __iter__(self):
+        rows = fan_out(lambda alias: list(self._ordered(alias)), self.aliases)
+        return merge_sorted(rows, self._key, self.descending)
+
+    def __len__(self):
+        return self.count()
+
+
+# Wraps a queryset of a sharded model for fan-out when sharding is enabled, otherwise returns it unchanged
+def sharded(queryset, order_field=None):
+    if not enabled() or queryset.model not in SHARDED_MODELS:
+        return queryset
+    order_field = order_field or queryset.model._meta.pk.attname
+    return ShardedQuerySet(queryset, order_field=order_field)
+
+
+# Sends specimens and expeditions to the shard of their continent and everything else to default.
+# Taxonomy is written to default and copied to every shard by replicate_taxonomy below.
+class ShardRouter:
+    def db_for_read(self, model, **hints):
+        # Related objects are read from the database of the instance they belong to
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if model in SHARDED_MODELS and instance is not None:
+            return shard_for_instance(instance)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Taxonomy rows exist on every database, other relations must stay on one shard
+        if isinstance(obj1, Taxonomy) or isinstance(obj2, Taxonomy):
+            return True
+        return obj1._state.db == obj2._state.db
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Shards hold the catalogue tables only; jobs, changes, profiles and sequences stay in default.
+        # Data migrations (no model_name) of the catalogue app also run on the shards.
+        if db == 'default':
+            return True
+        if app_label != 'specimen_catalog':
+            return False
+        return model_name is None or model_name in SHARD_TABLES
+
+
+# Gives new specimens and expeditions a globally unique id before they are written to a shard
+@receiver(pre_save, sender=Specimen)
+@receiver(pre_save, sender=Expedition)
+def assign_global_id(sender, instance, raw=False, **kwargs):
+    if enabled() and not raw and instance.pk is None:
+        instance.pk = next_id(sender._meta.model_name)
+
+
+# Moves a specimen that is saved to another shard than the one it is stored in, i.e. one moved
+# to an expedition on another shard. Its row is deleted from the old shard first, with the
+# record, counters, neighbour groups and a change feed tombstone of a normal delete; the save
+# then inserts it on the new shard as a created specimen. The shards have no shared
+# transaction, so the delete is committed on its own.
+@receiver(pre_save, sender=Specimen)
+def move_between_shards(sender, instance, raw=False, using=None, **kwargs):
+    stored = instance._state.db
+    if not enabled() or raw or instance._state.adding or stored is None or stored == using:
+        return
+    previous = Specimen.objects.using(stored).filter(pk=instance.pk).first()
+    if previous is not None:
+        previous.delete()
+
+
+# Copies every taxonomy write on default to the shards, without sending signals again
+@receiver(post_save, sender=Taxonomy)
+def replicate_taxonomy(sender, instance, raw=False, using='default', **kwargs):
+    if not enabled() or raw or using != 'default':
+        return
+    values = {field.attname: getattr(instance, field.attname) for field in Taxonomy._meta.concrete_fields}
+    for alias in shard_aliases():
+        if not Taxonomy.objects.using(alias).filter(pk=instance.pk).update(**values):
+            Taxonomy.objects.using(alias).bulk_create([Taxonomy(**values)])
+        expedition_stats.taxonomy_saved(instance, alias)
+        groups = neighbours.taxonomy_groups(instance, alias)
+        read_model.sync_taxonomy(instance, alias)
+        neighbours.refresh(groups, alias)
+
+
+# Removes deleted taxonomies from the shards; their specimens there cascade with them
+@receiver(post_delete, sender=Taxonomy)
+def remove_taxonomy(sender, instance, using='default', **kwargs):
+    if enabled() and using == 'default':
+        for alias in shard_aliases():
+            Taxonomy.objects.using(alias).filter(pk=instance.pk).delete()
+
@@ -0,0 +1,84 @@
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from .models import Specimen, Taxonomy, Expedition
+from . import read_model, versioning, changes, reference_cache, expedition_stats, neighbours, taxon_index
+
+# Keeps the SpecimenRecord read model in step with every write made through the ORM.
+# Deletes need no receiver: records cascade with their specimen.
+
+@receiver(post_save, sender=Specimen)
+def specimen_saved(sender, instance, raw=False, using='default', **kwargs):
+    # Fixtures are loaded raw, without their related rows, so they are rebuilt afterwards instead
+    if not raw:
+        # Expedition counters and neighbour groups compare against the record, so they move before it is refreshed
+        expedition_stats.specimen_saved(instance, using)
+        neighbours.specimen_saved(instance, using)
+        read_model.sync_specimen(instance, using)
+
+@receiver(post_save, sender=Taxonomy)
+def taxonomy_saved(sender, instance, created, raw=False, using='default', **kwargs):
+    # A new taxonomy has no specimens yet, so there is nothing to refresh
+    if not raw and not created:
+        expedition_stats.taxonomy_saved(instance, using)
+        groups = neighbours.taxonomy_groups(instance, using)
+        read_model.sync_taxonomy(instance, using)
+        neighbours.refresh(groups, using)
+
+@receiver(post_save, sender=Expedition)
+def expedition_saved(sender, instance, created, raw=False, using='default', **kwargs):
+    # A new expedition has no specimens yet, so there is nothing to refresh but its empty counters
+    if not raw and created:
+        expedition_stats.expedition_created(instance, using)
+    elif not raw:
+        read_model.sync_expedition(instance, using)
+
+# Takes specimens out of their expedition's counters and neighbour groups while their
+# records still exist, including specimens deleted by cascade
+@receiver(pre_delete, sender=Specimen)
+def specimen_deleting(sender, instance, using='default', **kwargs):
+    expedition_stats.specimen_deleting(instance, using)
+    neighbours.specimen_deleting(instance, using)
+
+# Every write to the catalogue moves the data version on, including cascade deletes
+@receiver(post_save, sender=Specimen)
+@receiver(post_save, sender=Taxonomy)
+@receiver(post_save, sender=Expedition)
+@receiver(post_delete, sender=Specimen)
+@receiver(post_delete, sender=Taxonomy)
+@receiver(post_delete, sender=Expedition)
+def catalogue_changed(sender, raw=False, **kwargs):
+    if not raw:
+        versioning.bump_version()
+
+# Appends every write to the change feed, with tombstones for deletes and cascade deletes
+@receiver(post_save, sender=Specimen)
+@receiver(post_save, sender=Taxonomy)
+@receiver(post_save, sender=Expedition)
+def change_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        changes.record_save(instance, created)
+
+@receiver(post_delete, sender=Specimen)
+@receiver(post_delete, sender=Taxonomy)
+@receiver(post_delete, sender=Expedition)
+def change_deleted(sender, instance, using='default', **kwargs):
+    # Taxonomy copies on shards are removed with the original, which already has its tombstone
+    if sender is Taxonomy and using != 'default':
+        return
+    changes.record_delete(instance)
+
+# Evicts saved and deleted taxonomies and expeditions from both reference cache tiers.
+# Fixture loads evict too: the rows they overwrite may be cached.
+@receiver(post_save, sender=Taxonomy)
+@receiver(post_save, sender=Expedition)
+@receiver(post_delete, sender=Taxonomy)
+@receiver(post_delete, sender=Expedition)
+def reference_changed(sender, instance, **kwargs):
+    reference_cache.for_model(sender).invalidate([instance.pk])
+
+# Lets this process's taxon name indexes see its own taxonomy writes straight away;
+# other processes pick them up when they notice the data version has moved
+@receiver(post_save, sender=Taxonomy)
+@receiver(post_delete, sender=Taxonomy)
+def taxon_names_changed(sender, **kwargs):
+    taxon_index.clear()
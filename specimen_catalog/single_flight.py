@@ -0,0 +1,171 @@
+import fcntl
+import hashlib
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from . import versioning
+
+# Seconds between sweeps of old result files in the lock directory
+SWEEP_INTERVAL = 60
+
+# Request methods that are safe to share between clients
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+# One computation in flight; followers wait on done and then read result or error
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Runs at most one computation per key at a time; concurrent callers with the same key
+# wait for it and share its result. With a lock directory, workers in other processes are
+# serialised on a lock file per key and pick up the result the leading worker wrote.
+class SingleFlight:
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_shared(key, fn)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    # Serialises the computation across processes on a lock file, when a lock directory is set
+    def _run_shared(self, key, fn):
+        if not self.lock_dir:
+            return fn()
+
+        directory = Path(self.lock_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        result_path = directory / f'{name}.result'
+
+        waiting_since = time.time()
+        with open(directory / f'{name}.lock', 'a+b') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # A result written after this worker started waiting came from the leader it waited on
+                try:
+                    if result_path.stat().st_mtime >= waiting_since:
+                        with open(result_path, 'rb') as result_file:
+                            return pickle.load(result_file)
+                except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                    pass
+
+                result = fn()
+                staging = directory / f'.{name}.{os.getpid()}.{threading.get_ident()}'
+                with open(staging, 'wb') as result_file:
+                    pickle.dump(result, result_file)
+                os.replace(staging, result_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._sweep(directory)
+        return result
+
+    # Removes lock and result files nobody has used for a while
+    def _sweep(self, directory):
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for path in directory.iterdir():
+            try:
+                if now - path.stat().st_mtime > SWEEP_INTERVAL:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+# The process-wide SingleFlight for the configured lock directory
+def get_flight():
+    lock_dir = getattr(settings, 'SINGLE_FLIGHT_LOCK_DIR', None)
+    with _flights_lock:
+        if lock_dir not in _flights:
+            _flights[lock_dir] = SingleFlight(lock_dir)
+        return _flights[lock_dir]
+
+
+# Identifies identical requests: path, sorted query parameters, negotiated format,
+# user and data version, so a write always starts a new flight
+def request_key(request):
+    params = sorted((name, value) for name in request.GET for value in request.GET.getlist(name))
+    user = getattr(request, 'user', None)
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    return repr((request.path, params, request.META.get('HTTP_ACCEPT', ''), user_id, versioning.current_version()))
+
+
+# Freezes a response into picklable parts so every waiting request can get its own copy
+def freeze_response(response):
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    return response.status_code, list(response.items()), response.content
+
+
+def thaw_response(frozen):
+    status_code, headers, content = frozen
+    response = HttpResponse(content, status=status_code)
+    for header, value in headers:
+        response[header] = value
+    return response
+
+
+# Added to views whose GET responses are expensive and identical for identical requests
+class SingleFlightMixin:
+    def dispatch(self, request, *args, **kwargs):
+        if not getattr(settings, 'SINGLE_FLIGHT', True) or request.method not in SAFE_METHODS:
+            return super().dispatch(request, *args, **kwargs)
+
+        # Requests with pending flash messages render them, so they are never shared
+        session = getattr(request, 'session', None)
+        if session is not None and session.get('_messages'):
+            return super().dispatch(request, *args, **kwargs)
+
+        # The leading request keeps its own response; waiting requests get copies of it
+        own = []
+
+        def compute():
+            own.append(super(SingleFlightMixin, self).dispatch(request, *args, **kwargs))
+            return freeze_response(own[0])
+
+        frozen = get_flight().do(request_key(request), compute)
+        return own[0] if own else thaw_response(frozen)
@@ -0,0 +1,69 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+
+# Dependencies that are only imported on first use; a worker boot should not execute them
+LAZY_MODULES = ['numpy', 'pycountry']
+
+# Boots Django the way a gunicorn worker without preload_app does, then reports phase timings,
+# peak RSS and whether the lazy modules were executed, as JSON on stdout
+BOOT_SCRIPT = '''
+import json, resource, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup_done = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
+application = get_wsgi_application()
+get_resolver().url_patterns
+finished = time.perf_counter()
+from specimen_catalog.lazy_imports import is_loaded
+
+# Peak RSS of this image; ru_maxrss would also count the parent's memory inherited through fork
+def peak_rss_kb():
+    try:
+        with open('/proc/self/status') as status:
+            return next(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+print(json.dumps({
+    'setup_seconds': setup_done - started,
+    'urls_seconds': finished - setup_done,
+    'total_seconds': finished - started,
+    'rss_kb': peak_rss_kb(),
+    'loaded': {name: is_loaded(name) for name in %r},
+}))
+'''
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+# Runs BOOT_SCRIPT in a fresh interpreter under -X importtime and returns its report together
+# with every import as (module, self microseconds, cumulative microseconds, nesting depth)
+def measure_boot():
+    environment = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'natural_history_project.settings'),
+                   'PYTHONPATH': os.pathsep.join(filter(None, [str(settings.BASE_DIR), os.environ.get('PYTHONPATH')]))}
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT % LAZY_MODULES],
+                             cwd=settings.BASE_DIR, env=environment, capture_output=True, text=True, check=True)
+
+    imports = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)), (len(match.group(3)) - 1) // 2))
+    return {**json.loads(process.stdout.splitlines()[-1]), 'imports': imports}
+
+
+# Self import time in microseconds summed per top-level package, most expensive first
+def package_costs(imports):
+    costs = defaultdict(int)
+    for module, self_time, _, _ in imports:
+        costs[module.split('.')[0]] += self_time
+    return sorted(costs.items(), key=lambda item: item[1], reverse=True)
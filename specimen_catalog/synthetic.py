@@ -0,0 +1,223 @@
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from django.db import connections, transaction
+
+from .models import Expedition, Taxonomy, Specimen, SpecimenRecord
+from . import read_model, versioning, expedition_stats, neighbours, jobs
+
+# Kingdoms and the share of taxa in each
+KINGDOMS = {'Animalia': 0.65, 'Plantae': 0.25, 'Fungi': 0.10}
+
+# Countries (pycountry names, so ExpeditionForm accepts them) per continent
+COUNTRIES = {
+    'Africa': ['South Africa', 'Kenya', 'Tanzania, United Republic of', 'Madagascar', 'Nigeria', 'Egypt', 'Morocco'],
+    'Antarctica': ['Antarctica'],
+    'Asia': ['Myanmar', 'Taiwan, Province of China', 'Indonesia', 'Japan', 'India', 'China', 'Viet Nam', 'Malaysia'],
+    'Europe': ['United Kingdom', 'France', 'Spain', 'Greece', 'Norway', 'Italy', 'Germany'],
+    'North America': ['United States', 'Mexico', 'Canada', 'Costa Rica', 'Panama'],
+    'Oceania': ['Australia', 'New Zealand', 'Papua New Guinea', 'Fiji'],
+    'South America': ['Brazil', 'Peru', 'Ecuador', 'Colombia', 'Argentina', 'Chile', 'Venezuela, Bolivarian Republic of'],
+}
+
+# Word parts combined into pseudo-Latin taxon names
+ROOTS = ['acanth', 'brach', 'calam', 'dendr', 'echin', 'gastr', 'hyl', 'lept', 'micr', 'odont', 'pachy', 'rhyn',
+         'saur', 'tetr', 'xen', 'zyg', 'ceph', 'chlor', 'derm', 'phyll', 'ptero', 'scut', 'lim', 'halo', 'myc',
+         'phor', 'cten', 'gnath', 'lyc', 'spor', 'thall', 'cyn']
+
+# Suffix of generated names per rank and kingdom
+SUFFIXES = {
+    'phylum': {'Animalia': 'ozoa', 'Plantae': 'ophyta', 'Fungi': 'omycota'},
+    'highest_biostratigraphic_zone': {'Animalia': 'ata', 'Plantae': 'ophytina', 'Fungi': 'omycotina'},
+    'class_name': {'Animalia': 'ia', 'Plantae': 'opsida', 'Fungi': 'omycetes'},
+    'identification_description': {'Animalia': 'iformes', 'Plantae': 'ales', 'Fungi': 'ales'},
+    'family': {'Animalia': 'idae', 'Plantae': 'aceae', 'Fungi': 'aceae'},
+    'genus': {'Animalia': 'us', 'Plantae': 'a', 'Fungi': 'ella'},
+}
+EPITHETS = ['is', 'ensis', 'ata', 'oides', 'ii', 'ica', 'ina', 'ianus']
+AUTHORS = ['Linnaeus', 'Boulenger', 'Dubois', 'Gray', 'Cuvier', 'Lamarck', 'Fries', 'Darwin', 'Randall & Rocha']
+
+# Ranks below kingdom, top down, and how many nodes of the rank below share one node of the rank
+RANKS = [('phylum', 2), ('highest_biostratigraphic_zone', 2), ('class_name', 3),
+         ('identification_description', 4), ('family', 4), ('genus', 4)]
+
+# Rows per INSERT batch
+BATCH_SIZE = 50000
+
+
+# Zipf probabilities over n items: p(k) is proportional to 1 / k^exponent
+def zipf_weights(n, exponent):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+# Unique pseudo-Latin stem for a number, e.g. 0 -> "Acanth", 33 -> "Brachbrach"
+def latin_stem(number):
+    parts = [ROOTS[number % len(ROOTS)]]
+    number //= len(ROOTS)
+    while number:
+        parts.append(ROOTS[number % len(ROOTS)])
+        number //= len(ROOTS)
+    return ''.join(parts).capitalize()
+
+
+# Picks a parent for each of `size` children with Zipf weights over shuffled parents.
+# The first children take one parent each, so no parent is left without children.
+def assign_parents(size, parents, random, exponent, weights=None):
+    weights = zipf_weights(parents, exponent)[random.permutation(parents)] if weights is None else weights
+    chosen = random.choice(parents, size=size, p=weights)
+    chosen[:min(parents, size)] = np.arange(min(parents, size))
+    return chosen
+
+
+# Builds `count` species rows with full lineages. Each rank is a tree over the rank above
+# and children pick their parent with Zipf weights, so a few families hold most genera.
+def taxonomy_rows(count, random, exponent):
+    kingdoms = list(KINGDOMS)
+
+    # Node counts per rank, from the species count upwards
+    sizes = {}
+    size = count
+    for rank, fanout in reversed(RANKS):
+        size = sizes[rank] = max(size // fanout, len(kingdoms))
+
+    # parent_of[rank][node] is the node's parent in the rank above; kingdom_of tracks each node's kingdom
+    parent_of = {}
+    kingdom_of = assign_parents(sizes['phylum'], len(kingdoms), random, exponent, weights=list(KINGDOMS.values()))
+    parent_of['phylum'] = kingdom_of
+    names = {}
+    for (rank, _), above in zip(RANKS, [None] + [rank for rank, _ in RANKS]):
+        if above is not None:
+            parent_of[rank] = assign_parents(sizes[rank], sizes[above], random, exponent)
+            kingdom_of = kingdom_of[parent_of[rank]]
+        names[rank] = [latin_stem(node) + SUFFIXES[rank][kingdoms[kingdom]] for node, kingdom in enumerate(kingdom_of.tolist())]
+
+    # Species hang off genera; walks each species' lineage up to its kingdom
+    lineage = {'genus': assign_parents(count, sizes['genus'], random, exponent)}
+    for (rank, _), (below, _) in zip(reversed(RANKS[:-1]), reversed(RANKS[1:])):
+        lineage[rank] = parent_of[below][lineage[below]]
+    lineage['kingdom'] = parent_of['phylum'][lineage['phylum']]
+
+    years = random.integers(1758, 2021, size=count).tolist()
+    authors = random.integers(0, len(AUTHORS), size=count).tolist()
+    columns = {rank: [names[rank][node] for node in lineage[rank].tolist()] for rank, _ in RANKS}
+    columns['kingdom'] = [kingdoms[node] for node in lineage['kingdom'].tolist()]
+
+    rows = []
+    for number in range(count):
+        epithet = latin_stem(number).lower() + EPITHETS[number % len(EPITHETS)]
+        rows.append({
+            **{column: values[number] for column, values in columns.items()},
+            'species': f"{columns['genus'][number]} {epithet} {AUTHORS[authors[number]]}, {years[number]}"[:50],
+        })
+    return rows
+
+
+# Builds `count` expeditions spread over continents and countries with Zipf skew
+def expedition_rows(count, random, exponent):
+    places = [(continent, country) for continent, countries in COUNTRIES.items() for country in countries]
+    chosen = random.choice(len(places), size=count, p=zipf_weights(len(places), exponent)[random.permutation(len(places))])
+    years = random.integers(1850, 2021, size=count)
+    return [{'expedition': f'Expedition {latin_stem(number)} {years[number]}', 'continent': places[place][0],
+             'country': places[place][1]} for number, place in enumerate(chosen)]
+
+
+# Catalog numbers in the SpecimenForm format: registration year.month.day.number
+def catalog_numbers(count, random):
+    years = random.integers(1850, 2021, size=count).tolist()
+    months = random.integers(1, 13, size=count).tolist()
+    days = random.integers(1, 29, size=count).tolist()
+    numbers = random.integers(1, 10000, size=count).tolist()
+    return [f'{year}.{month}.{day}.{number}' for year, month, day, number in zip(years, months, days, numbers)]
+
+
+def max_id(model, using):
+    return model.objects.using(using).order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+# Inserts rows with direct SQL executemany in batches
+def insert_rows(cursor, table, columns, rows, batch_size):
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany(sql, rows[start:start + batch_size])
+
+
+# Drops the secondary indexes of the given tables while rows are loaded and recreates them
+# afterwards: building an index once from sorted data is much faster than updating it per row.
+# Only done on SQLite, whose index definitions can be read back from sqlite_master.
+@contextmanager
+def indexes_deferred(cursor, tables, enabled=True):
+    if not enabled or cursor.db.vendor != 'sqlite':
+        yield
+        return
+
+    cursor.execute(
+        f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        f"AND tbl_name IN ({', '.join(['%s'] * len(tables))})", tables)
+    indexes = cursor.fetchall()
+    for name, _ in indexes:
+        cursor.execute(f'DROP INDEX "{name}"')
+    yield
+    for _, sql in indexes:
+        cursor.execute(sql)
+
+
+# Appends a synthetic catalogue of `specimens` specimens over `taxa` species and `expeditions`
+# expeditions. Specimens pick taxa and expeditions with Zipf weights, and the same seed always
+# produces the same data. Rows are written with direct SQL, so the read model is filled with
+# one INSERT ... SELECT, the expedition counters are recomputed and the data version is bumped
+# at the end; the change feed is not written. Rebuilding the neighbour groups takes longer than
+# the load itself, so by default it is queued as a rebuild_related_specimens job (related
+# specimens of groups that do not exist yet are read from the records meanwhile);
+# rebuild_related=True rebuilds them in the same transaction instead.
+def generate(specimens, taxa=None, expeditions=None, seed=0, exponent=1.1, batch_size=BATCH_SIZE, using='default',
+             rebuild_related=False):
+    random = np.random.default_rng(seed)
+    taxa = taxa or max(specimens // 50, 10)
+    expeditions = expeditions or max(specimens // 500, 10)
+    started = time.perf_counter()
+
+    taxonomy_data = taxonomy_rows(taxa, random, exponent)
+    expedition_data = expedition_rows(expeditions, random, exponent)
+    taxon_of = random.choice(taxa, size=specimens, p=zipf_weights(taxa, exponent)[random.permutation(taxa)])
+    expedition_of = random.choice(expeditions, size=specimens, p=zipf_weights(expeditions, exponent)[random.permutation(expeditions)])
+    numbers = catalog_numbers(specimens, random)
+
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        first_taxonomy = max_id(Taxonomy, using) + 1
+        first_expedition = max_id(Expedition, using) + 1
+        first_specimen = max_id(Specimen, using) + 1
+
+        taxonomy_columns = ['taxonomy_id'] + read_model.TAXONOMY_COLUMNS
+        insert_rows(cursor, Taxonomy._meta.db_table, taxonomy_columns,
+                    [(first_taxonomy + number, *(row[column] for column in taxonomy_columns[1:]))
+                     for number, row in enumerate(taxonomy_data)], batch_size)
+        insert_rows(cursor, Expedition._meta.db_table, ['expedition_id', 'expedition', 'continent', 'country'],
+                    [(first_expedition + number, row['expedition'], row['continent'], row['country'])
+                     for number, row in enumerate(expedition_data)], batch_size)
+
+        # Rebuilding the indexes only pays off when the load is large next to the existing rows
+        tables = [Specimen._meta.db_table, SpecimenRecord._meta.db_table]
+        with indexes_deferred(cursor, tables, enabled=specimens >= first_specimen):
+            specimen_ids = range(first_specimen, first_specimen + specimens)
+            insert_rows(cursor, Specimen._meta.db_table, ['specimen_id', 'catalog_number', 'taxonomy_id', 'expedition_id'],
+                        list(zip(specimen_ids, numbers, (taxon_of + first_taxonomy).tolist(),
+                                 (expedition_of + first_expedition).tolist())), batch_size)
+            records = read_model.insert_records_after(first_specimen - 1, using=using)
+
+        # The direct inserts bypass the signals that keep the expedition counters and neighbour groups up to date
+        expedition_stats.reconcile(using)
+        related_job = None
+        if rebuild_related:
+            neighbours.rebuild(using)
+        else:
+            related_job = jobs.enqueue('rebuild_related_specimens').pk
+        versioning.bump_version()
+
+    # Every row written counts towards the throughput: catalogue tables and read model alike
+    elapsed = time.perf_counter() - started
+    rows = specimens + records + taxa + expeditions
+    return {'specimens': specimens, 'taxa': taxa, 'expeditions': expeditions, 'records': records,
+            'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed if elapsed else None,
+            'related_job': related_job}
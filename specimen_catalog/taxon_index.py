@@ -0,0 +1,159 @@
+import multiprocessing
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .models import Taxonomy
+from .read_model import TAXONOMY_COLUMNS
+from .lazy_imports import lazy_import
+from . import versioning
+
+np = lazy_import('numpy')
+
+# Names matched per task by match_many when it runs in parallel
+CHUNK_SIZE = 200
+
+# Per-process indexes by rank, with the data version they were built at
+_indexes = {}
+_lock = threading.Lock()
+
+# Indexes handed to the processes forked by match_many
+_forked_indexes = {}
+
+
+# Collapses runs of whitespace and trims the ends, e.g. " Rana  temporaria" -> "Rana temporaria"
+def normalise(name):
+    return ' '.join(name.split())
+
+
+# Trigrams of a name as in PostgreSQL's pg_trgm: lowercase words padded with two spaces in
+# front and one behind, so "Rana" gives {"  r", " ra", "ran", "ana", "na "}
+def trigrams(name):
+    grams = set()
+    for word in name.casefold().split():
+        padded = f'  {word} '
+        grams.update(padded[start:start + 3] for start in range(len(padded) - 2))
+    return grams
+
+
+# Trigram index over the distinct names of one rank. Similarity is the share of trigrams two
+# names have in common (shared / union), so 1.0 means the same words up to case and spacing.
+class TrigramIndex:
+    def __init__(self, names):
+        self.names = list(names)
+        self.positions = {name: number for number, name in enumerate(self.names)}
+        self.normalised = {normalise(name).casefold(): name for name in self.names}
+
+        postings = defaultdict(list)
+        sizes = []
+        for number, name in enumerate(self.names):
+            grams = trigrams(name)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings[gram].append(number)
+        self.sizes = np.array(sizes, dtype=np.int32)
+        self.postings = {gram: np.array(numbers, dtype=np.int32) for gram, numbers in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    # Up to `limit` (name, score) pairs scoring at least threshold, best first. Counts shared
+    # trigrams for every name at once from the posting lists of the query's trigrams.
+    def search(self, name, limit=5, threshold=None):
+        threshold = settings.TAXON_MATCH_THRESHOLD if threshold is None else threshold
+        grams = trigrams(name)
+        lists = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not lists:
+            return []
+
+        shared = np.bincount(np.concatenate(lists), minlength=len(self.names))
+        scores = shared / (len(grams) + self.sizes - shared)
+        candidates = np.flatnonzero(scores >= threshold)
+        best = candidates[np.argsort(-scores[candidates], kind='stable')][:limit]
+        return [(self.names[number], round(float(scores[number]), 3)) for number in best]
+
+    # How a name relates to the indexed ones: (status, match, score, alternatives). The status is
+    # 'exact' for an existing name, 'variant' when only case or spacing differ, 'fuzzy' for a
+    # close match and 'new' otherwise.
+    def classify(self, name, limit=3, threshold=None):
+        if name in self.positions:
+            return 'exact', name, 1.0, []
+        variant = self.normalised.get(normalise(name).casefold())
+        if variant is not None:
+            return 'variant', variant, 1.0, []
+        matches = self.search(name, limit, threshold)
+        if matches:
+            return 'fuzzy', matches[0][0], matches[0][1], [match for match, _ in matches[1:]]
+        return 'new', None, None, []
+
+
+# The index of a rank's existing names, rebuilt in this process when the data version has
+# moved (checked at most every TAXON_INDEX_CHECK_INTERVAL seconds)
+def index_for(rank):
+    if rank not in TAXONOMY_COLUMNS:
+        raise ValueError(f'Unknown rank {rank!r}. Choose from: {", ".join(TAXONOMY_COLUMNS)}.')
+
+    with _lock:
+        entry = _indexes.get(rank)
+        now = time.monotonic()
+        if entry is not None and now - entry['checked'] < settings.TAXON_INDEX_CHECK_INTERVAL:
+            return entry['index']
+
+        version = versioning.current_version()
+        if entry is None or entry['version'] != version:
+            names = Taxonomy.objects.exclude(**{rank: ''}).order_by(rank).values_list(rank, flat=True).distinct()
+            entry = {'index': TrigramIndex(names), 'version': version}
+        entry['checked'] = now
+        _indexes[rank] = entry
+        return entry['index']
+
+
+# Drops this process's indexes, e.g. after it saved a taxonomy itself
+def clear():
+    with _lock:
+        _indexes.clear()
+
+
+# Closest existing names of a rank as (name, score) pairs, best first
+def matches(rank, name, limit=5, threshold=None):
+    return index_for(rank).search(normalise(name), limit, threshold)
+
+
+# The existing name a new name most likely duplicates, as (name, score), or None when the name
+# already exists or nothing scores at least TAXON_SUGGEST_THRESHOLD
+def near_duplicate(rank, name):
+    status, match, score, _ = index_for(rank).classify(name, limit=1, threshold=settings.TAXON_SUGGEST_THRESHOLD)
+    return (match, score) if status in ('variant', 'fuzzy') else None
+
+
+def _classify_chunk(rank, names, limit, threshold):
+    index = _forked_indexes[rank]
+    return [(name, index.classify(name, limit, threshold)) for name in names]
+
+
+# Classifies many names per rank, {rank: [names]} -> {rank: {name: (status, match, score,
+# alternatives)}}. With workers > 1 the indexes are built first and the chunks are matched in
+# forked processes, which inherit the indexes instead of receiving them.
+def match_many(names_by_rank, limit=3, threshold=None, workers=1):
+    indexes = {rank: index_for(rank) for rank in names_by_rank}
+    chunks = [(rank, names[start:start + CHUNK_SIZE]) for rank, names in names_by_rank.items()
+              for start in range(0, len(names), CHUNK_SIZE)]
+    results = {rank: {} for rank in names_by_rank}
+
+    if workers <= 1 or len(chunks) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for rank, names in chunks:
+            results[rank].update((name, indexes[rank].classify(name, limit, threshold)) for name in names)
+        return results
+
+    _forked_indexes.update(indexes)
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = [(rank, pool.submit(_classify_chunk, rank, names, limit, threshold)) for rank, names in chunks]
+            for rank, future in futures:
+                results[rank].update(future.result())
+    finally:
+        _forked_indexes.clear()
+    return results
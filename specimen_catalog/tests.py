@@ -1,4 +1,5 @@
-from django.test import RequestFactory, TestCase, Client
+from django.test import RequestFactory, TestCase, TransactionTestCase, Client, AsyncClient
+from unittest import skipUnless
 from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.contrib import messages
@@ -12,13 +13,64 @@ from rest_framework.test import APITestCase
 
 from django.contrib.auth.models import User
 
-from specimen_catalog.forms import ExpeditionForm, NewSpecimenForm, TaxonomyForm
-from specimen_catalog.models import Expedition, Specimen, Taxonomy
+from specimen_catalog.forms import ExpeditionForm, NewSpecimenForm, SpecimenForm, TaxonomyForm
+from specimen_catalog.models import Expedition, Specimen, Taxonomy, SpecimenRecord, Change, Job, ProfileCapture
 from specimen_catalog.views import AllSpecimensView, NewSpecimenView, SpecimenDeleteView
 from specimen_catalog.model_factories import ExpeditionFactory, SpecimenFactory, TaxonomyFactory
 from specimen_catalog.serializers import ExpeditionSerializer, SpecimenSerializer, TaxonomySerializer
+from specimen_catalog import analytics, jobs
+from specimen_catalog.database import apply_pragmas, replicate_sqlite
+from specimen_catalog import routers, sharding, metrics
+from specimen_catalog.write_batching import WriteCoalescer, run_write
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from specimen_catalog.single_flight import SingleFlight, request_key
+from specimen_catalog.metrics import MetricsRegistry, url_names, render as render_metrics
+from specimen_catalog.management.commands.benchmark_endpoints import build_dataset, Command as BenchmarkEndpointsCommand
+from specimen_catalog import synthetic, versioning
+from specimen_catalog import startup, warmup
+from specimen_catalog.pagination import CachedCountPaginator
+from specimen_catalog import reference_cache
+from specimen_catalog.reference_cache import ReferenceCache
+from specimen_catalog import expedition_stats
+from specimen_catalog.models import ExpeditionStats, ExpeditionTaxonCount, NeighbourGroup
+from specimen_catalog import neighbours
+from specimen_catalog import taxon_index, importer, validation, reclassify, changes
+from specimen_catalog.taxon_index import TrigramIndex
+from django.core.cache import cache
+from django.db import connection, OperationalError
+from django.test.utils import CaptureQueriesContext
+from specimen_catalog.lazy_imports import lazy_import, is_loaded
+import sys
+from django.db.models import Count
+import numpy as np
+from pathlib import Path
+import json
+import multiprocessing
+import threading
+import time
+from specimen_catalog.middleware import (ReplicaStickinessMiddleware, AdmissionGroup, AdmissionControlMiddleware,
+                                         ServerTimingMiddleware, MetricsMiddleware, ProfilingMiddleware)
+from asgiref.sync import iscoroutinefunction, sync_to_async
 
 from django.contrib.messages import get_messages
+from django.core.management import call_command
+from io import StringIO
+from django.test import override_settings
+import shutil
+import csv
+import tempfile
+import math
+import os
+import sqlite3
+import socket
+from datetime import timedelta
+from django.utils import timezone
+from django.conf import settings
+from contextlib import closing
+from unittest import mock
+from django.http import HttpResponse
+from django.contrib.sessions.models import Session
+from django.contrib.sessions.backends.db import SessionStore
 
 # Tests the Expedition Model
 class ExpeditionModelTestCase(TestCase):
@@ -600,4 +652,1663 @@ class SpecimenDeleteViewTestCase(TestCase):
         # Checks that the success message is present in the response
         messages = list(get_messages(response.wsgi_request))
         self.assertEqual(messages[0].tags, 'success')
-        self.assertEqual(str(messages[0]), 'Specimen deleted successfully.')
\ No newline at end of file
+        self.assertEqual(str(messages[0]), 'Specimen deleted successfully.')
+
+# Testing the SpecimenRecord read model
+class SpecimenRecordTestCase(TestCase):
+    def test_record_follows_specimen_writes(self):
+        # Creates a specimen and checks that its flat record was written
+        specimen = SpecimenFactory(expedition__country='Japan', taxonomy__genus='Leptolalax')
+        record = SpecimenRecord.objects.get(pk=specimen.pk)
+        self.assertEqual(record.country, 'Japan')
+        self.assertEqual(record.genus, 'Leptolalax')
+
+        # Updates the related taxonomy and expedition and checks the record is refreshed
+        specimen.taxonomy.genus = 'Rana'
+        specimen.taxonomy.save()
+        specimen.expedition.country = 'France'
+        specimen.expedition.save()
+        record.refresh_from_db()
+        self.assertEqual(record.genus, 'Rana')
+        self.assertEqual(record.country, 'France')
+
+        # Deleting the expedition cascades to the specimen and its record
+        specimen.expedition.delete()
+        self.assertFalse(SpecimenRecord.objects.filter(pk=specimen.pk).exists())
+
+    def test_rebuild_command(self):
+        # Clears the read table and checks the command restores one record per specimen
+        SpecimenFactory.create_batch(5)
+        SpecimenRecord.objects.all().delete()
+        call_command('rebuild_specimen_records', stdout=StringIO())
+        self.assertEqual(SpecimenRecord.objects.count(), 5)
+
+    def test_api_list_reads_records(self):
+        # The list API serves records in the same nested shape as SpecimenSerializer
+        specimen = SpecimenFactory()
+        response = self.client.get(reverse('specimen-list'))
+        self.assertEqual(response.data[0], SpecimenSerializer(specimen).data)
+
+# Testing the columnar analytics snapshot
+class AnalyticsSnapshotTestCase(TestCase):
+    def setUp(self):
+        # Builds snapshots in a temporary directory
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir, ignore_errors=True)
+        settings_override = override_settings(ANALYTICS_SNAPSHOT_DIR=self.snapshot_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        SpecimenFactory.create_batch(3, expedition__country='Japan', taxonomy__species='Species1')
+        SpecimenFactory.create_batch(2, expedition__country='Japan', taxonomy__species='Species2')
+        SpecimenFactory.create_batch(4, expedition__country='France', taxonomy__species='Species1')
+
+    def test_grouped_and_distinct_counts(self):
+        snapshot = analytics.get_snapshot()
+        counts = {row['country']: row['count'] for row in analytics.grouped_counts(snapshot, ['country'])}
+        self.assertEqual(counts, {'Japan': 5, 'France': 4})
+
+        richness = {row['country']: row['distinct'] for row in analytics.distinct_counts(snapshot, 'species', ['country'])}
+        self.assertEqual(richness, {'Japan': 2, 'France': 1})
+
+        table = analytics.crosstab(snapshot, 'country', 'species', where={'country': 'Japan'})
+        self.assertEqual(table, {'rows': ['Japan'], 'columns': ['Species1', 'Species2'], 'counts': [[3, 2]]})
+
+    def test_snapshot_follows_data_version(self):
+        # A write moves the data version on, so the next read rebuilds the snapshot
+        first = analytics.get_snapshot()
+        SpecimenFactory(expedition__country='Japan', taxonomy__species='Species3')
+        second = analytics.get_snapshot()
+        self.assertGreater(second.version, first.version)
+        self.assertEqual(second.rows, first.rows + 1)
+
+        # Codes of values that were already known are kept between versions
+        self.assertEqual(second.dictionaries['country'][:len(first.dictionaries['country'])], first.dictionaries['country'])
+
+    # Decoded rows of a snapshot, {specimen_id: (values of DIMENSIONS)}
+    def snapshot_rows(self, snapshot):
+        columns = [[snapshot.dictionaries[dimension][code] for code in snapshot.codes[dimension]]
+                   for dimension in analytics.DIMENSIONS]
+        return dict(zip(snapshot.specimen_ids.tolist(), zip(*columns)))
+
+    def test_snapshot_is_updated_from_change_feed(self):
+        first = analytics.get_snapshot()
+        self.assertEqual(first.seq, changes.latest_seq())
+
+        specimens = list(Specimen.objects.order_by('pk'))
+        SpecimenFactory(expedition__country='Peru', taxonomy__species='Species3')
+        specimens[0].delete()
+        specimens[1].catalog_number = 'CHANGED-1'
+        specimens[1].save()
+        taxonomy = specimens[2].taxonomy
+        taxonomy.species = 'Renamed'
+        taxonomy.save()
+
+        # Only the changed rows are read; the table is not dumped again
+        with mock.patch('specimen_catalog.analytics.build_snapshot', side_effect=AssertionError('full rebuild')):
+            updated = analytics.get_snapshot()
+        self.assertEqual(updated.seq, changes.latest_seq())
+        self.assertEqual(updated.rows, first.rows)
+        self.assertEqual(updated.specimen_ids.tolist(), sorted(updated.specimen_ids.tolist()))
+
+        rebuilt = analytics.Snapshot(analytics.build_snapshot())
+        self.assertEqual(self.snapshot_rows(updated), self.snapshot_rows(rebuilt))
+        self.assertIn('Renamed', updated.dictionaries['species'])
+        self.assertEqual(updated.dictionaries['species'][:len(first.dictionaries['species'])], first.dictionaries['species'])
+
+    def test_writes_outside_change_feed_rebuild_snapshot(self):
+        first = analytics.get_snapshot()
+        # The generator writes no change feed entries, so the update finds the rows missing
+        synthetic.generate(20, taxa=5, expeditions=2, seed=1, rebuild_related=True)
+        self.assertIsNone(analytics.update_snapshot(analytics.Snapshot(analytics.current_snapshot_path())))
+
+        snapshot = analytics.get_snapshot()
+        self.assertEqual(snapshot.rows, first.rows + 20)
+        self.assertEqual(snapshot.rows, SpecimenRecord.objects.count())
+
+    def test_snapshots_missing_a_dimension_are_rebuilt(self):
+        path = analytics.build_snapshot()
+        meta = json.loads((path / 'meta.json').read_text())
+        del meta['dictionaries']['expedition_id']
+        (path / 'meta.json').write_text(json.dumps(meta))
+        self.assertFalse(analytics.Snapshot(path).complete)
+
+        snapshot = analytics.get_snapshot()
+        self.assertTrue(snapshot.complete)
+        self.assertEqual(snapshot.rows, 9)
+        self.assertEqual(len(analytics.grouped_counts(snapshot, ['expedition_id'])), Expedition.objects.count())
+
+    def test_large_change_sets_rebuild_snapshot(self):
+        first = analytics.get_snapshot()
+        SpecimenFactory.create_batch(3)
+        with mock.patch('specimen_catalog.analytics.ID_BATCH_SIZE', 1), \
+                mock.patch('specimen_catalog.analytics.UPDATE_MAX_SHARE', 0.1):
+            self.assertIsNone(analytics.update_snapshot(first))
+            self.assertEqual(analytics.get_snapshot().rows, first.rows + 3)
+
+    def test_counts_api(self):
+        response = self.client.get(reverse('analytics-counts') + '?by=country&species=Species1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0], {'country': 'France', 'count': 4})
+
+        # Unknown dimensions are rejected
+        response = self.client.get(reverse('analytics-counts') + '?by=colour')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+# Testing the biodiversity statistics
+class BiodiversityTestCase(TestCase):
+    def setUp(self):
+        # Builds snapshots in a temporary directory
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir, ignore_errors=True)
+        settings_override = override_settings(ANALYTICS_SNAPSHOT_DIR=self.snapshot_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        # Japan holds two equally common species, France a single one
+        SpecimenFactory.create_batch(2, expedition__country='Japan', taxonomy__species='Species1')
+        SpecimenFactory.create_batch(2, expedition__country='Japan', taxonomy__species='Species2')
+        SpecimenFactory.create_batch(3, expedition__country='France', taxonomy__species='Species1')
+
+    def test_grouped_diversity(self):
+        response = self.client.get(reverse('biodiversity', kwargs={'group': 'country'}) + '?rank=species')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = {row['country']: row for row in response.data['results']}
+        self.assertEqual(results['Japan']['richness'], 2)
+        self.assertAlmostEqual(results['Japan']['shannon'], math.log(2), places=5)
+        self.assertAlmostEqual(results['Japan']['simpson'], 0.5)
+        self.assertEqual(results['France']['shannon'], 0.0)
+        self.assertEqual(results['France']['simpson'], 0.0)
+
+    def test_report_is_invalidated_by_data_version(self):
+        report = self.client.get(reverse('biodiversity-report')).data
+        self.assertEqual(report['collection']['richness'], 2)
+
+        # A new species changes the data version, so the cached report is not reused
+        SpecimenFactory(expedition__country='France', taxonomy__species='Species3')
+        report = self.client.get(reverse('biodiversity-report')).data
+        self.assertEqual(report['collection']['richness'], 3)
+
+    def test_expeditions_with_the_same_name_are_kept_apart(self):
+        first = ExpeditionFactory(expedition='Survey', country='Peru')
+        second = ExpeditionFactory(expedition='Survey', country='Chile')
+        SpecimenFactory.create_batch(2, expedition=first, taxonomy__species='Species1')
+        SpecimenFactory(expedition=second, taxonomy__species='Species2')
+
+        response = self.client.get(reverse('biodiversity', kwargs={'group': 'expedition'}) + '?rank=species')
+        results = {row['expedition_id']: row for row in response.data['results']}
+        self.assertEqual(results[first.pk]['expedition'], 'Survey')
+        self.assertEqual((results[first.pk]['specimens'], results[first.pk]['richness']), (2, 1))
+        self.assertEqual(results[second.pk]['expedition'], 'Survey')
+        self.assertEqual((results[second.pk]['specimens'], results[second.pk]['richness']), (1, 1))
+
+    def test_unknown_group(self):
+        response = self.client.get(reverse('biodiversity', kwargs={'group': 'ocean'}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+# Testing the change feed
+class ChangeFeedTestCase(APITestCase):
+    def test_feed_records_writes_and_cascade_tombstones(self):
+        specimen = SpecimenFactory()
+        since = Change.objects.order_by('-seq').first().seq
+
+        # Updates the specimen, then deletes its expedition which cascades to the specimen
+        specimen.catalog_number = '1916.05.30.10'
+        specimen.save()
+        specimen.expedition.delete()
+
+        response = self.client.get(reverse('change-feed') + f'?since={since}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        entries = [(change['model'], change['action']) for change in response.data['changes']]
+        self.assertEqual(entries[0], ('specimen', 'update'))
+        self.assertIn(('specimen', 'delete'), entries)
+        self.assertIn(('expedition', 'delete'), entries)
+        self.assertEqual(response.data['changes'][0]['data']['catalog_number'], '1916.05.30.10')
+
+        # Sequence numbers are strictly increasing
+        seqs = [change['seq'] for change in response.data['changes']]
+        self.assertEqual(seqs, sorted(set(seqs)))
+
+    def test_feed_paging(self):
+        SpecimenFactory.create_batch(3)
+        first = self.client.get(reverse('change-feed') + '?limit=4').data
+        self.assertEqual(len(first['changes']), 4)
+        self.assertIsNotNone(first['next'])
+
+        # Following next pages until the end covers every change exactly once
+        seqs = [change['seq'] for change in first['changes']]
+        page = first
+        while page['next']:
+            page = self.client.get(page['next']).data
+            seqs += [change['seq'] for change in page['changes']]
+        self.assertEqual(seqs, list(Change.objects.values_list('seq', flat=True)))
+
+# Testing the background job runner
+class JobRunnerTestCase(APITestCase):
+    def setUp(self):
+        # Uses temporary import and export directories
+        self.job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.job_dir, ignore_errors=True)
+        settings_override = override_settings(JOB_IMPORT_DIR=self.job_dir, JOB_EXPORT_DIR=self.job_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_export_then_import_round_trip(self):
+        specimens = SpecimenFactory.create_batch(3)
+        export = jobs.enqueue('export_csv', filename='specimens.csv')
+        jobs.run_pending()
+        export.refresh_from_db()
+        self.assertEqual(export.status, Job.DONE)
+        self.assertEqual(export.result['rows'], 3)
+        self.assertEqual(export.processed, 3)
+
+        # Deletes the specimens and restores them from the exported file
+        Specimen.objects.all().delete()
+        restore = jobs.enqueue('import_csv', path='specimens.csv')
+        jobs.run_pending()
+        restore.refresh_from_db()
+        self.assertEqual(restore.status, Job.DONE, restore.error)
+        self.assertEqual(sorted(Specimen.objects.values_list('pk', flat=True)), sorted(s.pk for s in specimens))
+
+    def test_worker_survives_errors_while_polling(self):
+        stop = threading.Event()
+        calls = []
+
+        def flaky_run_pending(worker):
+            calls.append(worker)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            stop.set()
+            return 0
+
+        # The first poll fails; the worker logs it, drops its connection and polls again
+        with mock.patch('specimen_catalog.jobs.run_pending', side_effect=flaky_run_pending), \
+                mock.patch('specimen_catalog.jobs.connection') as worker_connection, \
+                self.assertLogs('specimen_catalog.jobs', 'ERROR') as logs:
+            jobs.work('worker-1', stop, poll_interval=0.01)
+        self.assertEqual(calls, ['worker-1', 'worker-1'])
+        self.assertIn('database is locked', logs.output[0])
+        self.assertGreaterEqual(worker_connection.close.call_count, 2)
+
+    def test_run_jobs_fails_abandoned_jobs(self):
+        host = socket.gethostname()
+        now = timezone.now()
+        dead = Job.objects.create(kind='export_csv', status=Job.RUNNING, worker=f'{host}:999999:MainThread-0', started=now)
+        alive = Job.objects.create(kind='export_csv', status=Job.RUNNING, worker=f'{host}:{os.getpid()}:MainThread-0', started=now)
+        remote = Job.objects.create(kind='export_csv', status=Job.RUNNING, worker='other-host:1:MainThread-0', started=now)
+        stale = Job.objects.create(kind='export_csv', status=Job.RUNNING, worker='other-host:1:MainThread-1',
+                                   started=now - timedelta(days=1))
+
+        with mock.patch('specimen_catalog.jobs.process_alive', side_effect=lambda pid: pid == os.getpid()):
+            call_command('run_jobs', once=True, stdout=StringIO())
+
+        for job in (dead, alive, remote, stale):
+            job.refresh_from_db()
+        self.assertEqual((dead.status, stale.status), (Job.FAILED, Job.FAILED))
+        self.assertIn('exited', dead.error)
+        self.assertIn('JOB_RUNNING_TIMEOUT', stale.error)
+        self.assertEqual((alive.status, remote.status), (Job.RUNNING, Job.RUNNING))
+
+    def test_import_outside_directory_fails(self):
+        job = jobs.enqueue('import_csv', path='../../etc/passwd')
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('outside the import directory', job.error)
+
+    def test_queue_bulk_delete_through_api(self):
+        specimens = SpecimenFactory.create_batch(4)
+        response = self.client.post(reverse('job-list'), {'kind': 'bulk_delete',
+                                    'params': {'specimen_ids': [s.pk for s in specimens[:3]]}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], Job.QUEUED)
+
+        # The web request only queued the job; a worker does the deleting
+        self.assertEqual(Specimen.objects.count(), 4)
+        jobs.run_pending()
+        self.assertEqual(Specimen.objects.count(), 1)
+
+        response = self.client.get(reverse('job-detail', kwargs={'pk': response.data['id']}))
+        self.assertEqual(response.data['result'], {'deleted': 3})
+
+        # Unknown kinds are rejected
+        response = self.client.post(reverse('job-list'), {'kind': 'format_disk'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+# Testing the tuned database profile
+class DatabaseProfileTestCase(TestCase):
+    def test_tuned_pragmas(self):
+        # Applies the tuned profile's pragmas to a fresh SQLite file and reads them back
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        connection = sqlite3.connect(os.path.join(directory, 'tuned.sqlite3'))
+        self.addCleanup(connection.close)
+
+        apply_pragmas(connection.cursor(), settings.DATABASE_PROFILES['tuned']['PRAGMAS'])
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+        self.assertEqual(connection.execute('PRAGMA cache_size').fetchone()[0], -64000)
+
+    def test_standard_profile_is_stock(self):
+        self.assertEqual(settings.DATABASE_PROFILES['standard'], {})
+
+# Testing the primary/replica database router
+@override_settings(DATABASE_REPLICA_ALIASES=['replica1'], REPLICA_MAX_LAG=30, REPLICA_STICKY_SECONDS=30)
+class PrimaryReplicaRouterTestCase(TestCase):
+    def route_read(self, lag, model=Specimen):
+        # Routes a read with the replica reporting the given lag
+        with mock.patch('specimen_catalog.routers.replica_lag', return_value=lag):
+            return routers.PrimaryReplicaRouter().db_for_read(model)
+
+    def test_reads_go_to_fresh_replicas(self):
+        self.assertEqual(self.route_read(lag=5), 'replica1')
+        self.assertEqual(self.route_read(lag=60), 'default')
+        self.assertEqual(self.route_read(lag=None), 'default')
+        self.assertEqual(routers.PrimaryReplicaRouter().db_for_write(Specimen), 'default')
+
+        # Sessions are always read from the primary
+        self.assertEqual(self.route_read(lag=5, model=Session), 'default')
+
+    def test_session_reads_primary_after_write(self):
+        seen = []
+
+        # Records which database each request would read from
+        def get_response(request):
+            seen.append(self.route_read(lag=5))
+            return HttpResponse()
+
+        middleware = ReplicaStickinessMiddleware(get_response)
+        session = SessionStore()
+        for method in ('get', 'post', 'get'):
+            request = getattr(RequestFactory(), method)('/')
+            request.session = session
+            middleware(request)
+
+        self.assertEqual(seen, ['replica1', 'default', 'default'])
+
+    def test_replicate_sqlite(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        source = os.path.join(directory, 'primary.sqlite3')
+        target = os.path.join(directory, 'replicas', 'replica1.sqlite3')
+
+        with closing(sqlite3.connect(source)) as connection:
+            connection.execute('CREATE TABLE specimen (id INTEGER PRIMARY KEY)')
+            connection.executemany('INSERT INTO specimen VALUES (?)', [(1,), (2,)])
+            connection.commit()
+
+        replicate_sqlite(source, target)
+        with closing(sqlite3.connect(target)) as connection:
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM specimen').fetchone()[0], 2)
+
+# Testing the continent sharding helpers
+class ShardingHelpersTestCase(TestCase):
+    @override_settings(DATABASE_SHARD_ALIASES=['shard1', 'shard2', 'shard3'], SHARD_CONTINENTS={'Asia': 'shard2'})
+    def test_shard_for_continent(self):
+        # Pinned continents use their shard, others hash to a stable shard
+        self.assertEqual(sharding.shard_for_continent('asia'), 'shard2')
+        self.assertEqual(sharding.shard_for_continent('Europe'), sharding.shard_for_continent(' europe '))
+        self.assertIn(sharding.shard_for_continent('Oceania'), ['shard1', 'shard2', 'shard3'])
+
+    def test_merge_sorted(self):
+        merged = sharding.merge_sorted([[9, 4, 1], [8, 7, 2], []], key=lambda value: value)
+        self.assertEqual(list(merged), [9, 8, 7, 4, 2, 1])
+
+    @override_settings(DATABASE_SHARD_ALIASES=[])
+    def test_sharded_is_a_no_op_without_shards(self):
+        queryset = Specimen.objects.all()
+        self.assertIs(sharding.sharded(queryset), queryset)
+
+    def test_shards_only_migrate_catalogue_tables(self):
+        router = sharding.ShardRouter()
+        for model_name in ['specimen', 'expedition', 'taxonomy', 'specimenrecord', 'expeditionstats',
+                           'expeditiontaxoncount', 'neighbourgroup']:
+            self.assertTrue(router.allow_migrate('shard1', 'specimen_catalog', model_name))
+        # Operational tables (some with foreign keys to auth_user) stay in default
+        for model_name in ['profilecapture', 'job', 'change', 'dataversion', 'shardsequence']:
+            self.assertFalse(router.allow_migrate('shard1', 'specimen_catalog', model_name))
+            self.assertTrue(router.allow_migrate('default', 'specimen_catalog', model_name))
+        self.assertFalse(router.allow_migrate('shard1', 'auth', 'user'))
+
+# End-to-end test of sharding mode, run with DATABASE_SHARDS=2 (or more)
+@skipUnless(settings.DATABASE_SHARD_ALIASES, 'Sharding is not enabled (set DATABASE_SHARDS).')
+class ShardedCatalogueTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def test_writes_are_partitioned_and_reads_fan_out(self):
+        taxonomy = Taxonomy.objects.create(kingdom='Animalia', genus='Rana')
+        asia = Expedition.objects.create(expedition='Expedition Asia', continent='Asia', country='Japan')
+        europe = Expedition.objects.create(expedition='Expedition Europe', continent='Europe', country='France')
+        specimens = [Specimen.objects.create(catalog_number=f'2024.01.01.{n}', expedition=expedition, taxonomy=taxonomy)
+                     for n, expedition in enumerate([asia, europe, asia, europe, asia])]
+
+        # Each specimen is stored with its expedition, on its continent's shard
+        for specimen in specimens:
+            self.assertEqual(specimen._state.db, sharding.shard_for_continent(specimen.expedition.continent))
+        self.assertEqual(len({specimen.pk for specimen in specimens}), 5)
+
+        # Taxonomy is copied to every shard
+        for alias in settings.DATABASE_SHARD_ALIASES:
+            self.assertTrue(Taxonomy.objects.using(alias).filter(pk=taxonomy.pk).exists())
+
+        # Counts and pages are merged across shards in descending specimen_id order
+        records = sharding.sharded(SpecimenRecord.objects.all())
+        self.assertEqual(records.count(), 5)
+        self.assertEqual([record.pk for record in records[1:4]], sorted((s.pk for s in specimens), reverse=True)[1:4])
+
+        response = self.client.get(reverse('all_specimens') + '?expedition__continent=Asia')
+        self.assertEqual(response.context['specimens'].paginator.count, 3)
+
+        response = self.client.get(reverse('specimen_detail', kwargs={'pk': specimens[1].pk}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_reclassification_reaches_every_shard(self):
+        rana = Taxonomy.objects.create(kingdom='Animalia', family='Ranidae', genus='Rana', species='Rana arvalis')
+        lithobates = Taxonomy.objects.create(kingdom='Animalia', family='Ranidae', genus='Lithobates', species='Lithobates arvalis')
+        expeditions = [Expedition.objects.create(expedition=f'Expedition {continent}', continent=continent, country=country)
+                       for continent, country in [('Asia', 'Japan'), ('Europe', 'France')]]
+        specimens = [Specimen.objects.create(catalog_number=f'2024.01.01.{n}', expedition=expedition, taxonomy=rana)
+                     for n, expedition in enumerate(expeditions)]
+
+        self.assertEqual(reclassify.preview(Taxonomy.objects.filter(pk=rana.pk), {'genus': 'Lithobates'})['specimens'], 2)
+        self.assertEqual(reclassify.apply(Taxonomy.objects.filter(pk=rana.pk), {'genus': 'Lithobates'}),
+                         {'taxonomies': 1, 'specimens': 2, 'merged': 1})
+
+        # The renamed taxonomy is the older one, so it is kept and the other one is merged into it
+        for specimen in specimens:
+            record = SpecimenRecord.objects.using(specimen._state.db).get(pk=specimen.pk)
+            self.assertEqual((record.taxonomy_id, record.genus, record.species), (rana.pk, 'Lithobates', 'Lithobates arvalis'))
+        for alias in settings.DATABASE_SHARD_ALIASES:
+            self.assertEqual(Taxonomy.objects.using(alias).get(pk=rana.pk).genus, 'Lithobates')
+            self.assertFalse(Taxonomy.objects.using(alias).filter(pk=lithobates.pk).exists())
+
+    def test_specimen_moves_to_the_shard_of_its_new_expedition(self):
+        first, second = settings.DATABASE_SHARD_ALIASES[:2]
+        with override_settings(SHARD_CONTINENTS={'Asia': first, 'Europe': second}):
+            taxonomy = Taxonomy.objects.create(kingdom='Animalia', family='Ranidae', genus='Rana')
+            asia = Expedition.objects.create(expedition='Expedition Asia', continent='Asia', country='Japan')
+            europe = Expedition.objects.create(expedition='Expedition Europe', continent='Europe', country='France')
+            specimen = Specimen.objects.create(catalog_number='2024.01.01.1', expedition=asia, taxonomy=taxonomy)
+            self.assertEqual(specimen._state.db, first)
+
+            specimen = Specimen.objects.using(first).get(pk=specimen.pk)
+            specimen.expedition_id = europe.pk
+            specimen.save()
+
+        # The row, its record and its counters leave the old shard and are created on the new one
+        self.assertEqual(specimen._state.db, second)
+        self.assertFalse(Specimen.objects.using(first).filter(pk=specimen.pk).exists())
+        self.assertFalse(SpecimenRecord.objects.using(first).filter(pk=specimen.pk).exists())
+        self.assertEqual(Specimen.objects.using(second).get(pk=specimen.pk).expedition_id, europe.pk)
+        self.assertEqual(SpecimenRecord.objects.using(second).get(pk=specimen.pk).expedition_name, 'Expedition Europe')
+        self.assertEqual(ExpeditionStats.objects.using(first).get(expedition_id=asia.pk).specimen_count, 0)
+        self.assertEqual(ExpeditionStats.objects.using(second).get(expedition_id=europe.pk).specimen_count, 1)
+        self.assertEqual(sharding.sharded(Specimen.objects.all()).count(), 1)
+
+        # The change feed shows the move as a delete followed by a create
+        actions = list(Change.objects.filter(model='specimen', object_id=specimen.pk).values_list('action', flat=True))
+        self.assertEqual(actions[-2:], [Change.DELETE, Change.CREATE])
+
+        # Saves that stay on the shard do not move the row again
+        specimen.catalog_number = '2024.01.01.2'
+        specimen.save()
+        self.assertEqual(Specimen.objects.using(second).get(pk=specimen.pk).catalog_number, '2024.01.01.2')
+
+    def test_update_views_find_rows_on_the_shards(self):
+        taxonomy = Taxonomy.objects.create(kingdom='Animalia', family='Ranidae', genus='Rana', species='Rana arvalis')
+        expedition = Expedition.objects.create(expedition='Expedition Asia', continent='Asia', country='Japan')
+        specimen = Specimen.objects.create(catalog_number='2024.01.01.1', expedition=expedition, taxonomy=taxonomy)
+
+        response = self.client.get(reverse('expedition_update', kwargs={'pk': expedition.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['expedition'], expedition)
+        response = self.client.post(reverse('expedition_update', kwargs={'pk': expedition.pk}),
+                                    {'expedition': 'Expedition Kyushu', 'continent': 'Asia', 'country': 'Japan'})
+        self.assertRedirects(response, reverse('specimen_detail', kwargs={'pk': specimen.pk}))
+        self.assertEqual(Expedition.objects.using(expedition._state.db).get(pk=expedition.pk).expedition, 'Expedition Kyushu')
+
+        response = self.client.get(reverse('taxonomy_update', kwargs={'specimen_pk': specimen.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['specimen'], specimen)
+        response = self.client.post(reverse('taxonomy_update', kwargs={'specimen_pk': specimen.pk}), {
+            'kingdom': 'Animalia', 'phylum': 'Chordata', 'highest_biostratigraphic_zone': 'Holocene',
+            'class_name': 'Amphibia', 'identification_description': 'Adult', 'family': 'Ranidae',
+            'genus': 'Rana', 'species': 'Rana temporaria', 'keep_names': 'on'})
+        self.assertRedirects(response, reverse('specimen_detail', kwargs={'pk': specimen.pk}))
+        self.assertEqual(Taxonomy.objects.get(pk=taxonomy.pk).species, 'Rana temporaria')
+        self.assertEqual(SpecimenRecord.objects.using(specimen._state.db).get(pk=specimen.pk).species, 'Rana temporaria')
+
+    def test_new_specimen_form_offers_expeditions_from_every_shard(self):
+        first, second = settings.DATABASE_SHARD_ALIASES[:2]
+        with override_settings(SHARD_CONTINENTS={'Asia': first, 'Europe': second}):
+            taxonomy = Taxonomy.objects.create(kingdom='Animalia', genus='Rana')
+            asia = Expedition.objects.create(expedition='Expedition Asia', continent='Asia', country='Japan')
+            europe = Expedition.objects.create(expedition='Expedition Europe', continent='Europe', country='France')
+
+            form = NewSpecimenForm()
+            self.assertEqual({expedition.pk for expedition in form.fields['expedition'].queryset}, {asia.pk, europe.pk})
+            self.assertEqual([value for value, _ in form.fields['expedition'].choices][1:], [europe.pk, asia.pk])
+
+            form = NewSpecimenForm({'catalog_number': '2024.01.01.1', 'expedition': europe.pk, 'taxonomy': taxonomy.pk})
+            self.assertTrue(form.is_valid(), form.errors)
+            specimen = form.save()
+        self.assertEqual(specimen._state.db, second)
+        self.assertTrue(Specimen.objects.using(second).filter(pk=specimen.pk).exists())
+
+        # A pk that exists on no shard is rejected
+        form = NewSpecimenForm({'catalog_number': '2024.01.01.2', 'expedition': 999999, 'taxonomy': taxonomy.pk})
+        self.assertFalse(form.is_valid())
+        self.assertIn('expedition', form.errors)
+
+    def test_write_batches_roll_back_on_the_shards(self):
+        coalescer = WriteCoalescer(window=0.01)
+        self.addCleanup(coalescer.stop)
+
+        def create_and_fail():
+            Expedition.objects.create(expedition='Rolled back', continent='Asia', country='Japan')
+            raise ValueError('invalid expedition')
+
+        # A failing write is rolled back on the shard it wrote to, not only on default
+        with self.assertRaises(ValueError):
+            coalescer.run(create_and_fail)
+        kept = coalescer.run(Expedition.objects.create, expedition='Kept', continent='Asia', country='Japan')
+
+        self.assertFalse(sharding.sharded(Expedition.objects.filter(expedition='Rolled back')).exists())
+        self.assertEqual(Expedition.objects.using(kept._state.db).get(pk=kept.pk).expedition, 'Kept')
+
+# Testing the group-commit write coalescer
+class WriteCoalescerTestCase(TransactionTestCase):
+    def test_concurrent_creates_share_batches(self):
+        coalescer = WriteCoalescer(window=0.05, max_batch=50)
+        self.addCleanup(coalescer.stop)
+
+        # Creates one expedition per thread, with one invalid write among them
+        def create(number):
+            if number == 7:
+                raise ValueError('invalid expedition')
+            return Expedition.objects.create(expedition=f'Expedition {number}', continent='Asia', country='Japan')
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            futures = [executor.submit(coalescer.run, create, number) for number in range(20)]
+            outcomes = [future.exception() or future.result() for future in futures]
+
+        # Every caller gets its own result or error back
+        self.assertIsInstance(outcomes[7], ValueError)
+        self.assertEqual(Expedition.objects.count(), 19)
+        self.assertEqual(outcomes[3], Expedition.objects.get(expedition='Expedition 3'))
+
+        # The writes were committed in fewer transactions than there were requests
+        self.assertEqual(coalescer.writes, 20)
+        self.assertLess(coalescer.batches, 20)
+
+    def test_timed_out_writes_that_have_not_started_are_cancelled(self):
+        coalescer = WriteCoalescer(window=0.01)
+        self.addCleanup(coalescer.stop)
+        started, release = threading.Event(), threading.Event()
+
+        def slow_create():
+            started.set()
+            release.wait(5)
+            return Expedition.objects.create(expedition='Expedition 1', continent='Asia', country='Japan')
+
+        # The writer thread is busy, so the second write times out before it starts
+        first = coalescer.submit(slow_create)
+        started.wait(5)
+        with self.assertRaises(FutureTimeoutError):
+            coalescer.run(Expedition.objects.create, expedition='Expedition 2', continent='Asia', country='Japan', timeout=0.05)
+
+        # It is dropped from the queue instead of being written after the caller gave up
+        release.set()
+        first.result(timeout=5)
+        coalescer.stop()
+        self.assertEqual(list(Expedition.objects.values_list('expedition', flat=True)), ['Expedition 1'])
+
+    @override_settings(WRITE_BATCHING=False)
+    def test_run_write_inline_when_disabled(self):
+        self.assertEqual(run_write(lambda value: value * 2, 21), 42)
+
+# Testing the async API views against their DRF counterparts
+class AsyncAPIViewTestCase(TestCase):
+    def setUp(self):
+        self.specimens = [SpecimenFactory() for _ in range(3)]
+        self.specimen = self.specimens[0]
+
+    def test_async_views_match_sync_views(self):
+        # Each async endpoint returns the same JSON as the DRF endpoint it mirrors
+        pairs = [
+            ('specimen-list', {}), ('specimen-detail', {'pk': self.specimen.pk}),
+            ('expedition-list', {}), ('expedition-detail', {'pk': self.specimen.expedition_id}),
+            ('taxonomy-list', {}), ('taxonomy-detail', {'pk': self.specimen.taxonomy_id}),
+        ]
+        for name, kwargs in pairs:
+            with self.subTest(name=name):
+                sync_response = self.client.get(reverse(name, kwargs=kwargs))
+                async_response = self.client.get(reverse(f'async-{name}', kwargs=kwargs))
+                self.assertEqual(async_response.status_code, 200)
+                self.assertEqual(async_response.json(), sync_response.json())
+
+    def test_async_detail_not_found(self):
+        response = self.client.get(reverse('async-specimen-detail', kwargs={'pk': 999999}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_async_specimen_keyset_page(self):
+        newest = max(specimen.pk for specimen in self.specimens)
+        response = self.client.get(reverse('async-specimen-list'), {'after': newest, 'limit': 1})
+        self.assertEqual([row['specimen_id'] for row in response.json()],
+                         [sorted(specimen.pk for specimen in self.specimens)[-2]])
+        self.assertEqual(self.client.get(reverse('async-specimen-list'), {'limit': 'x'}).status_code, 400)
+
+# Testing single-flight coalescing of identical requests
+class SingleFlightTestCase(TestCase):
+    # Starts callers in threads and releases the leader once the others are waiting on it
+    def run_concurrently(self, flights, key):
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        with ThreadPoolExecutor(max_workers=len(flights)) as executor:
+            futures = [executor.submit(flights[0].do, key, compute)]
+            time.sleep(0.1)
+            futures += [executor.submit(flight.do, key, compute) for flight in flights[1:]]
+            time.sleep(0.1)
+            release.set()
+            results = [future.result() for future in futures]
+        return calls, results
+
+    def test_concurrent_callers_share_one_computation(self):
+        flight = SingleFlight()
+        calls, results = self.run_concurrently([flight] * 5, 'key')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual((flight.leaders, flight.followers), (1, 4))
+
+    def test_lock_file_coalesces_across_workers(self):
+        # Two SingleFlight instances stand in for two worker processes sharing a lock directory
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        calls, results = self.run_concurrently([SingleFlight(directory), SingleFlight(directory)], 'key')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result', 'result'])
+
+    def test_request_key_normalises_parameters_and_tracks_version(self):
+        factory = RequestFactory()
+        key = request_key(factory.get('/all_specimens/', {'a': '1', 'b': '2'}))
+        self.assertEqual(key, request_key(factory.get('/all_specimens/?b=2&a=1')))
+        SpecimenFactory()
+        self.assertNotEqual(key, request_key(factory.get('/all_specimens/?b=2&a=1')))
+
+# Testing admission control and load shedding
+class AdmissionControlTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(ADMISSION_FILE=os.path.join(directory, 'admission.mmap'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_group_sheds_over_limit(self):
+        group = AdmissionGroup('expensive', limit=1, queue_timeout=0.05)
+        self.assertTrue(group.acquire())
+        self.assertFalse(group.acquire())
+        group.release()
+        self.assertTrue(group.acquire())
+        self.assertEqual(group.rejected, 1)
+        group.release()
+
+    def test_limits_are_shared_by_worker_processes(self):
+        group = AdmissionGroup('bulk', limit=1)
+        holding, done = multiprocessing.get_context('fork').Event(), multiprocessing.get_context('fork').Event()
+
+        # A forked worker takes the only place and exits without releasing it
+        def worker():
+            group.acquire()
+            holding.set()
+            done.wait(5)
+            os._exit(0)
+
+        process = multiprocessing.get_context('fork').Process(target=worker)
+        process.start()
+        self.assertTrue(holding.wait(5))
+        self.assertFalse(group.acquire())
+
+        # Once that worker is gone, its place is given back
+        done.set()
+        process.join(5)
+        self.assertTrue(group.acquire())
+        group.release()
+
+    def test_queued_request_is_admitted_when_a_place_frees(self):
+        group = AdmissionGroup('expensive', limit=1, queue_timeout=2)
+        self.assertTrue(group.acquire())
+        timer = threading.Timer(0.05, group.release)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertTrue(group.acquire())
+        self.assertEqual(group.waiting, 0)
+        group.release()
+
+    def test_lower_priority_sheds_while_higher_priority_waits(self):
+        group = AdmissionGroup('bulk', limit=0, queue_timeout=5)
+        started = time.monotonic()
+        self.assertFalse(group.acquire(higher_priority_waiting=True))
+        self.assertLess(time.monotonic() - started, 1)
+
+    @override_settings(ADMISSION_CONTROL=True, ADMISSION_GROUPS={
+        'cheap': {'limit': 4, 'queue_timeout': 0.0, 'priority': 1, 'retry_after': 1},
+        'expensive': {'limit': 0, 'queue_timeout': 0.0, 'priority': 0, 'retry_after': 7},
+    })
+    def test_expensive_routes_get_503_while_cheap_routes_are_served(self):
+        specimen = SpecimenFactory()
+        response = self.client.get(reverse('all_specimens'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(self.client.get(reverse('specimen_detail', kwargs={'pk': specimen.pk})).status_code, 200)
+
+# Testing the Server-Timing instrumentation
+@override_settings(SERVER_TIMING=True)
+class ServerTimingTestCase(TestCase):
+    def test_header_reports_queries_and_render_time(self):
+        SpecimenFactory()
+        response = self.client.get(reverse('all_specimens'))
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 'template', 'serialize', 'total'})
+        self.assertNotIn('desc="0 queries"', timing['db'])
+        self.assertNotEqual(timing['template'], 'dur=0.00')
+
+    def test_api_reports_serialization_time(self):
+        SpecimenFactory()
+        response = self.client.get(reverse('specimen-list'))
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+        self.assertNotIn('serialize;dur=0.00', response['Server-Timing'])
+
+    @override_settings(SERVER_TIMING_SLOW_MS=0, SERVER_TIMING_LOGGED_QUERIES=1)
+    def test_slow_requests_are_logged_with_slowest_sql(self):
+        with self.assertLogs('specimen_catalog.slow_requests', level='WARNING') as logs:
+            self.client.get(reverse('all_specimens'))
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(SERVER_TIMING=False)
+    def test_disabled_sends_no_header(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('index')))
+
+# Testing the shared metrics registry and the /metrics endpoint
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'metrics.mmap')
+        settings_override = override_settings(METRICS=True, METRICS_FILE=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_endpoint_reports_histograms_and_statuses(self):
+        self.client.get(reverse('all_specimens'))
+        self.client.get(reverse('all_specimens'))
+        self.client.get(reverse('specimen_detail', kwargs={'pk': 999999}))
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('specimen_catalog_request_duration_seconds_count{url_name="all_specimens"} 2', body)
+        self.assertIn('specimen_catalog_request_duration_seconds_bucket{url_name="all_specimens",le="+Inf"} 2', body)
+        self.assertIn('specimen_catalog_responses_total{url_name="specimen_detail",status="4xx"} 1', body)
+        self.assertRegex(body, r'specimen_catalog_db_queries_total\{url_name="all_specimens"\} [1-9]')
+
+    def test_workers_are_aggregated_through_the_file(self):
+        # A second registry under another live pid stands in for a second gunicorn worker
+        first = MetricsRegistry(self.path, url_names())
+        with mock.patch('os.getpid', return_value=1):
+            second = MetricsRegistry(self.path, url_names())
+        self.assertNotEqual(first.slot, second.slot)
+
+        first.observe('specimen-list', 0.02, 200, queries=3, cache_hits=1)
+        second.observe('specimen-list', 0.2, 503, queries=1, cache_misses=1)
+        totals = first.totals()['specimen-list']
+        self.assertEqual((totals['count'], totals['queries'], totals['status_5xx']), (2, 4, 1))
+        self.assertIn('specimen_catalog_cache_hit_ratio{url_name="specimen-list"} 0.500000', render_metrics(first.totals()))
+
+    def test_endpoint_is_local_only(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(response.status_code, 403)
+
+# Testing the project middleware under ASGI, where it runs in async mode
+@override_settings(SERVER_TIMING=True, METRICS=True, PROFILING=True, PROFILING_RATE_LIMIT=10)
+class AsyncMiddlewareTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(METRICS_FILE=os.path.join(directory, 'metrics.mmap'),
+                                              ADMISSION_FILE=os.path.join(directory, 'admission.mmap'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        SpecimenFactory()
+
+    def test_middleware_follows_the_mode_of_the_chain(self):
+        async def async_response(request):
+            return HttpResponse()
+
+        for middleware_class in (ReplicaStickinessMiddleware, AdmissionControlMiddleware, ServerTimingMiddleware,
+                                 MetricsMiddleware, ProfilingMiddleware):
+            self.assertTrue(middleware_class.sync_capable and middleware_class.async_capable)
+            self.assertTrue(iscoroutinefunction(middleware_class(async_response)), middleware_class)
+            self.assertFalse(iscoroutinefunction(middleware_class(lambda request: HttpResponse())), middleware_class)
+
+    async def test_timings_and_metrics_count_queries_of_async_requests(self):
+        response = await AsyncClient().get(reverse('async-specimen-list'))
+        self.assertEqual(response.status_code, 200)
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertNotIn('desc="0 queries"', timing['db'])
+
+        totals = metrics.get_registry().totals()['async-specimen-list']
+        self.assertEqual(totals['count'], 1)
+        self.assertGreater(totals['queries'], 0)
+
+    async def test_async_requests_are_shed(self):
+        groups = {'cheap': {'limit': 4, 'queue_timeout': 0.0, 'priority': 1, 'retry_after': 1},
+                  'expensive': {'limit': 0, 'queue_timeout': 0.05, 'priority': 0, 'retry_after': 7}}
+        with self.settings(ADMISSION_CONTROL=True, ADMISSION_GROUPS=groups):
+            client = AsyncClient()
+            response = await client.get(reverse('async-specimen-list'))
+            self.assertEqual((response.status_code, response['Retry-After']), (503, '7'))
+            self.assertEqual((await client.get(reverse('index'))).status_code, 200)
+
+    async def test_session_reads_primary_after_write(self):
+        seen = []
+
+        async def get_response(request):
+            seen.append(routers._pinned.get())
+            return HttpResponse()
+
+        middleware = ReplicaStickinessMiddleware(get_response)
+        session = SessionStore()
+        for method in ('get', 'post', 'get'):
+            request = getattr(RequestFactory(), method)('/')
+            request.session = session
+            await middleware(request)
+        self.assertEqual(seen, [False, True, True])
+        # Nothing stays pinned once the request is over
+        self.assertFalse(routers._pinned.get())
+
+    async def test_sync_views_are_profiled_under_asgi(self):
+        staff = await sync_to_async(User.objects.create_user)(username='curator', password='password', is_staff=True)
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(staff)
+        response = await client.get(reverse('all_specimens'), {'_profile': ''})
+        capture = await ProfileCapture.objects.aget(pk=response['X-Profile-Id'])
+        self.assertGreater(capture.query_count, 0)
+        self.assertTrue(any(row['function'] == 'get_context_data' for row in capture.functions))
+
+@override_settings(PROFILING=True, PROFILING_RATE_LIMIT=1)
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user(username='curator', password='password', is_staff=True, is_superuser=True)
+        SpecimenFactory()
+
+    def test_staff_request_is_profiled_with_sql_trace(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('all_specimens'), {'_profile': ''})
+        capture = ProfileCapture.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual(capture.status_code, 200)
+        self.assertGreater(capture.query_count, 0)
+        self.assertTrue(any('specimen_catalog_specimenrecord' in query['sql'] for query in capture.queries))
+        cumulative = [row['cumtime'] for row in capture.functions]
+        self.assertEqual(cumulative, sorted(cumulative, reverse=True))
+
+        # The admin shows the capture as a hot-function table
+        page = self.client.get(reverse('admin:specimen_catalog_profilecapture_change', args=[capture.pk]))
+        self.assertContains(page, 'Hot functions')
+        self.assertContains(page, 'get_context_data')
+
+    def test_anonymous_requests_are_not_profiled(self):
+        response = self.client.get(reverse('all_specimens'), {'_profile': ''})
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(ProfileCapture.objects.count(), 0)
+
+    def test_captures_are_rate_limited(self):
+        self.client.force_login(self.staff)
+        self.client.get(reverse('index'), {'_profile': ''})
+        response = self.client.get(reverse('index'), {'_profile': ''})
+        self.assertEqual(response['X-Profile'], 'rate-limited')
+        self.assertEqual(ProfileCapture.objects.count(), 1)
+
+# Testing the endpoint benchmark helpers
+class BenchmarkEndpointsTestCase(TestCase):
+    def test_build_dataset_fills_read_model(self):
+        build_dataset(120, seed=1)
+        self.assertEqual(Specimen.objects.count(), 120)
+        self.assertEqual(SpecimenRecord.objects.count(), 120)
+        self.assertEqual(Taxonomy.objects.count(), 10)
+
+    def test_compare_flags_slower_cases_and_extra_queries(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'baseline.json')
+        with open(baseline, 'w') as baseline_file:
+            json.dump({'results': [{'scale': 1000, 'case': 'all_specimens', 'p95_ms': 10.0, 'queries': 3},
+                                   {'scale': 1000, 'case': 'specimen_detail', 'p95_ms': 5.0, 'queries': 3}]}, baseline_file)
+
+        regressions = BenchmarkEndpointsCommand().compare([
+            {'scale': 1000, 'case': 'all_specimens', 'p95_ms': 20.0, 'queries': 3},
+            {'scale': 1000, 'case': 'specimen_detail', 'p95_ms': 5.5, 'queries': 4},
+        ], Path(baseline), tolerance=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('p95 10.0 -> 20.0 ms', regressions[0])
+        self.assertIn('3 -> 4 queries', regressions[1])
+
+    def test_saved_baseline_holds_only_the_new_measurements(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'baseline.json')
+        with open(baseline, 'w') as baseline_file:
+            json.dump({'results': [{'scale': 1000, 'case': 'all_specimens', 'p95_ms': 10.0, 'queries': 3}]}, baseline_file)
+
+        measured = [{'scale': 1000, 'case': 'all_specimens', 'p50_ms': 5.0, 'p95_ms': 8.0, 'p99_ms': 9.0, 'queries': 3,
+                     'peak_memory_kb': 100}]
+        with mock.patch.object(BenchmarkEndpointsCommand, 'run_test_client', return_value=measured):
+            call_command('benchmark_endpoints', scales='1000', cases='all_specimens', baseline=baseline,
+                         output=os.path.join(directory, 'latest.json'), save_baseline=True, stdout=StringIO())
+
+        with open(baseline) as baseline_file:
+            saved = json.load(baseline_file)
+        self.assertEqual(saved['results'], [{'scale': 1000, 'case': 'all_specimens', 'p50_ms': 5.0, 'p95_ms': 8.0,
+                                             'p99_ms': 9.0, 'queries': 3, 'peak_memory_kb': 100}])
+        self.assertNotIn('regressions', saved)
+
+
+# Tests the synthetic dataset generator
+class SyntheticDatasetTestCase(TestCase):
+    def test_generate_fills_catalogue_and_read_model(self):
+        version = versioning.current_version()
+        result = synthetic.generate(2000, taxa=100, expeditions=20, seed=3)
+
+        self.assertEqual(Specimen.objects.count(), 2000)
+        self.assertEqual(Taxonomy.objects.count(), 100)
+        self.assertEqual(Expedition.objects.count(), 20)
+        self.assertEqual(SpecimenRecord.objects.count(), 2000)
+        self.assertEqual(result['rows'], 4120)
+        self.assertGreater(versioning.current_version(), version)
+
+        record = SpecimenRecord.objects.get(pk=Specimen.objects.order_by('?').first().pk)
+        specimen = Specimen.objects.select_related('taxonomy', 'expedition').get(pk=record.pk)
+        self.assertEqual(record.family, specimen.taxonomy.family)
+        self.assertEqual(record.continent, specimen.expedition.continent)
+
+    def test_related_groups_are_rebuilt_by_a_job_unless_asked(self):
+        result = synthetic.generate(200, taxa=10, expeditions=10, seed=3)
+        self.assertFalse(NeighbourGroup.objects.exists())
+        job = Job.objects.get(pk=result['related_job'])
+        self.assertEqual(job.kind, 'rebuild_related_specimens')
+        self.assertEqual(jobs.run_job(job).status, Job.DONE)
+        groups = dict(NeighbourGroup.objects.values_list('key', 'specimen_ids'))
+        self.assertTrue(groups)
+
+        NeighbourGroup.objects.all().delete()
+        result = synthetic.generate(0, taxa=10, expeditions=10, seed=4, rebuild_related=True)
+        self.assertIsNone(result['related_job'])
+        self.assertEqual(dict(NeighbourGroup.objects.values_list('key', 'specimen_ids')), groups)
+
+    def test_generate_appends_after_existing_rows(self):
+        existing = SpecimenFactory()
+        synthetic.generate(100, taxa=10, expeditions=10, seed=3)
+        self.assertEqual(Specimen.objects.count(), 101)
+        self.assertEqual(SpecimenRecord.objects.filter(pk__gt=existing.pk).count(), 100)
+
+    def test_same_seed_gives_same_data(self):
+        synthetic.generate(300, taxa=30, expeditions=10, seed=5)
+        first = list(SpecimenRecord.objects.order_by('pk').values_list('catalog_number', 'species', 'country'))
+        for model in (SpecimenRecord, Specimen, Expedition, Taxonomy):
+            model.objects.all().delete()
+
+        synthetic.generate(300, taxa=30, expeditions=10, seed=5)
+        second = list(SpecimenRecord.objects.order_by('pk').values_list('catalog_number', 'species', 'country'))
+        self.assertEqual(first, second)
+
+    def test_generated_values_pass_the_forms(self):
+        random = np.random.default_rng(1)
+        for catalog_number in synthetic.catalog_numbers(50, random):
+            form = SpecimenForm(data={'catalog_number': catalog_number})
+            self.assertTrue(form.is_valid(), form.errors)
+        for row in synthetic.expedition_rows(20, random, 1.1):
+            form = ExpeditionForm(data=row)
+            self.assertTrue(form.is_valid(), form.errors)
+
+    def test_taxa_follow_a_zipf_skew(self):
+        synthetic.generate(5000, taxa=200, expeditions=20, seed=7)
+        counts = sorted(Specimen.objects.values('taxonomy').annotate(n=Count('pk')).values_list('n', flat=True), reverse=True)
+        self.assertGreater(counts[0], 10 * counts[len(counts) // 2])
+
+
+# Tests lazy loading of heavy modules and the worker boot targets
+class StartupTestCase(TestCase):
+    def test_lazy_import_runs_module_on_first_use(self):
+        # Cleanups run last-in first-out: the lazy module is dropped, then any earlier import restored
+        previous = sys.modules.pop('colorsys', None)
+        if previous is not None:
+            self.addCleanup(sys.modules.__setitem__, 'colorsys', previous)
+        self.addCleanup(sys.modules.pop, 'colorsys', None)
+
+        colorsys = lazy_import('colorsys')
+        self.assertFalse(is_loaded('colorsys'))
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertTrue(is_loaded('colorsys'))
+
+        import colorsys as imported
+        self.assertIs(imported, colorsys)
+
+    def test_country_validation_still_uses_pycountry(self):
+        self.assertTrue(ExpeditionForm(data={'expedition': 'Expedition Kenya 1990', 'continent': 'Africa', 'country': 'Kenya'}).is_valid())
+        self.assertFalse(ExpeditionForm(data={'expedition': 'Expedition Atlantis 1990', 'continent': 'Europe', 'country': 'Atlantis'}).is_valid())
+
+    def test_package_costs_sum_self_time_per_package(self):
+        imports = [('django.db', 30, 50, 1), ('django', 20, 80, 0), ('numpy.core', 100, 100, 1)]
+        self.assertEqual(startup.package_costs(imports), [('numpy', 100), ('django', 50)])
+
+    def test_worker_boot_meets_targets(self):
+        report = startup.measure_boot()
+
+        self.assertLessEqual(report['total_seconds'], settings.STARTUP_TARGET_SECONDS)
+        self.assertLessEqual(report['rss_kb'] / 1024, settings.STARTUP_TARGET_RSS_MB)
+        self.assertEqual(report['loaded'], {name: False for name in startup.LAZY_MODULES})
+        self.assertIn('specimen_catalog.views', [module for module, _, _, _ in report['imports']])
+
+
+# Tests the cached page counts and the warm-up stages
+class WarmupTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        for continent in ['Asia', 'Asia', 'Europe']:
+            SpecimenFactory(expedition=ExpeditionFactory(continent=continent))
+
+    def test_paginator_count_is_cached_until_the_next_write(self):
+        self.assertEqual(CachedCountPaginator(SpecimenRecord.objects.order_by('-specimen_id'), 20).count, 3)
+        with self.assertNumQueries(1):
+            # Only the data version is read; the count comes from the cache
+            self.assertEqual(CachedCountPaginator(SpecimenRecord.objects.order_by('-specimen_id'), 20).count, 3)
+
+        SpecimenFactory()
+        self.assertEqual(CachedCountPaginator(SpecimenRecord.objects.order_by('-specimen_id'), 20).count, 4)
+
+    def test_filtered_counts_are_cached_separately(self):
+        self.assertEqual(CachedCountPaginator(SpecimenRecord.objects.filter(continent='Asia'), 20).count, 2)
+        self.assertEqual(CachedCountPaginator(SpecimenRecord.objects.filter(continent='Europe'), 20).count, 1)
+
+    @override_settings(WARMUP_TOP_FILTERS={'expedition__continent': 'continent'}, WARMUP_TOP_VALUES=1)
+    def test_warmup_paths_include_most_common_filter_values(self):
+        paths = warmup.warmup_paths()
+        self.assertIn(reverse('all_specimens'), paths)
+        self.assertIn(reverse('all_specimens') + '?expedition__continent=Asia', paths)
+        self.assertNotIn(reverse('all_specimens') + '?expedition__continent=Europe', paths)
+
+    def test_warm_runs_every_stage(self):
+        results = warmup.warm()
+        self.assertEqual([stage for stage, _, _ in results], warmup.STAGES)
+        self.assertNotIn('failed', dict((stage, detail) for stage, _, detail in results)['requests'])
+
+        # The all-specimens page count was cached by the warm-up request
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('all_specimens')).status_code, 200)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+
+# Tests the two-tier Taxonomy and Expedition reference cache
+class ReferenceCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.taxa = [TaxonomyFactory() for _ in range(3)]
+        self.cache = ReferenceCache(Taxonomy, size=10, check_interval=60)
+
+    def test_get_many_loads_misses_in_one_query_then_serves_locally(self):
+        ids = [taxonomy.pk for taxonomy in self.taxa]
+        with self.assertNumQueries(2):
+            # The data version, then every miss in one IN query
+            records = self.cache.get_many(ids + [999999])
+        self.assertEqual(sorted(records), sorted(ids))
+        self.assertEqual(records[ids[0]].family, self.taxa[0].family)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get(ids[1]).species, self.taxa[1].species)
+        self.assertEqual(self.cache.stats()['local_hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 4)
+
+    def test_shared_tier_serves_other_processes(self):
+        self.cache.get_many([taxonomy.pk for taxonomy in self.taxa])
+
+        # A second instance stands in for another worker with an empty LRU
+        other = ReferenceCache(Taxonomy, size=10, check_interval=60)
+        with self.assertNumQueries(1):
+            other.get_many([taxonomy.pk for taxonomy in self.taxa])
+        self.assertEqual(other.stats()['shared_hits'], 3)
+        self.assertEqual(other.stats()['hit_rate'], 1.0)
+
+    def test_save_evicts_both_tiers(self):
+        taxonomy = self.taxa[0]
+        self.assertEqual(reference_cache.taxa.get(taxonomy.pk).family, taxonomy.family)
+
+        taxonomy.family = 'Felidae'
+        taxonomy.save()
+        self.assertEqual(reference_cache.taxa.get(taxonomy.pk).family, 'Felidae')
+
+    def test_version_bump_hides_stale_shared_entries(self):
+        taxonomy = self.taxa[0]
+        other = ReferenceCache(Taxonomy, size=10, check_interval=0)
+        self.assertEqual(other.get(taxonomy.pk).family, taxonomy.family)
+
+        # A write made by another worker evicts only that worker's tiers, so the row cached
+        # here stays in the shared tier; the version bump must keep it from being served
+        Taxonomy.objects.filter(pk=taxonomy.pk).update(family='Felidae')
+        versioning.bump_version()
+        self.assertEqual(other.get(taxonomy.pk).family, 'Felidae')
+        self.assertEqual(other.stats()['shared_hits'], 0)
+
+    def test_lru_is_bounded(self):
+        small = ReferenceCache(Taxonomy, size=2, check_interval=60)
+        small.get_many([taxonomy.pk for taxonomy in self.taxa])
+        self.assertEqual(small.stats()['size'], 2)
+        self.assertNotIn(self.taxa[0].pk, small.local)
+
+    def test_attach_fills_related_objects(self):
+        specimen = SpecimenFactory()
+        fresh = Specimen.objects.get(pk=specimen.pk)
+        reference_cache.attach([fresh])
+        with self.assertNumQueries(0):
+            self.assertEqual(fresh.taxonomy.species, specimen.taxonomy.species)
+            self.assertEqual(fresh.expedition.country, specimen.expedition.country)
+
+    def test_admin_changelist_and_detail_render_from_cache(self):
+        specimen = SpecimenFactory()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:specimen_catalog_specimen_changelist'))
+        self.assertContains(response, specimen.expedition.expedition)
+
+        response = self.client.get(reverse('specimen_detail', kwargs={'pk': specimen.pk}))
+        self.assertContains(response, specimen.taxonomy.species)
+
+
+# Tests the precomputed expedition counters, their listing page and API
+class ExpeditionStatsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.expedition = ExpeditionFactory()
+        self.other = ExpeditionFactory()
+        self.frogs = TaxonomyFactory(family='Ranidae')
+        self.toads = TaxonomyFactory(family='Bufonidae')
+
+    def stats(self, expedition):
+        return ExpeditionStats.objects.get(expedition=expedition)
+
+    def test_counts_follow_create_move_and_delete(self):
+        specimens = [SpecimenFactory(expedition=self.expedition, taxonomy=self.frogs) for _ in range(2)]
+        SpecimenFactory(expedition=self.expedition, taxonomy=self.toads)
+        self.assertEqual(self.stats(self.expedition).specimen_count, 3)
+        self.assertEqual(self.stats(self.expedition).top_taxa,
+                         [{'family': 'Ranidae', 'specimens': 2}, {'family': 'Bufonidae', 'specimens': 1}])
+
+        specimens[0].expedition = self.other
+        specimens[0].save()
+        specimens[1].delete()
+        self.assertEqual(self.stats(self.expedition).specimen_count, 1)
+        self.assertEqual(self.stats(self.expedition).top_taxa, [{'family': 'Bufonidae', 'specimens': 1}])
+        self.assertEqual(self.stats(self.other).top_taxa, [{'family': 'Ranidae', 'specimens': 1}])
+        self.assertFalse(ExpeditionTaxonCount.objects.filter(expedition=self.expedition, family='Ranidae').exists())
+
+    def test_family_change_moves_counts(self):
+        SpecimenFactory(expedition=self.expedition, taxonomy=self.frogs)
+        self.frogs.family = 'Hylidae'
+        self.frogs.save()
+        self.assertEqual(self.stats(self.expedition).top_taxa, [{'family': 'Hylidae', 'specimens': 1}])
+
+    def test_reconcile_repairs_drift(self):
+        SpecimenFactory(expedition=self.expedition, taxonomy=self.frogs)
+        ExpeditionStats.objects.filter(expedition=self.expedition).update(specimen_count=7, top_taxa=[])
+        self.assertEqual(expedition_stats.reconcile(), {'expeditions': 2, 'drifted': 1})
+        self.assertEqual(self.stats(self.expedition).specimen_count, 1)
+        self.assertEqual(self.stats(self.expedition).top_taxa, [{'family': 'Ranidae', 'specimens': 1}])
+
+        output = StringIO()
+        call_command('reconcile_expedition_stats', stdout=output)
+        self.assertIn('default: 2 expeditions, 0 drifted.', output.getvalue())
+
+    def test_list_page_and_api_sort_by_count(self):
+        for _ in range(2):
+            SpecimenFactory(expedition=self.other, taxonomy=self.toads)
+        SpecimenFactory(expedition=self.expedition, taxonomy=self.frogs)
+
+        response = self.client.get(reverse('expedition_list'))
+        self.assertEqual([stats.expedition_id for stats in response.context['expeditions']],
+                         [self.other.pk, self.expedition.pk])
+        self.assertContains(response, 'Bufonidae (2)')
+
+        response = self.client.get(reverse('expedition-stats-list'), {'sort': 'fewest'})
+        self.assertEqual(response.data['count'], 2)
+        first = response.data['results'][0]
+        self.assertEqual((first['expedition_id'], first['specimen_count'], first['country']),
+                         (self.expedition.pk, 1, self.expedition.country))
+
+    def test_sorting_uses_the_count_index(self):
+        sql, params = expedition_stats.listing().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('expedition_count_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+# Tests the related-specimens panel and its precomputed neighbour groups
+class RelatedSpecimensTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.expedition = ExpeditionFactory()
+        self.elsewhere = ExpeditionFactory()
+        self.frog = TaxonomyFactory(family='Ranidae', genus='Rana', species='Rana temporaria')
+        self.other_frog = TaxonomyFactory(family='Ranidae', genus='Rana', species='Rana arvalis')
+        self.specimen = SpecimenFactory(expedition=self.expedition, taxonomy=self.frog)
+
+    def related(self, specimen, limit=None):
+        return [(record.pk, level) for record, level in neighbours.related(specimen, limit)]
+
+    def assertGroupsMatchRebuild(self):
+        groups = dict(NeighbourGroup.objects.values_list('key', 'specimen_ids'))
+        neighbours.rebuild()
+        self.assertEqual(groups, dict(NeighbourGroup.objects.values_list('key', 'specimen_ids')))
+
+    def test_ranks_by_taxonomy_depth_then_expedition(self):
+        same_genus_here = SpecimenFactory(expedition=self.expedition, taxonomy=self.other_frog)
+        same_species_elsewhere = SpecimenFactory(expedition=self.elsewhere, taxonomy=self.frog)
+        same_species_here = SpecimenFactory(expedition=self.expedition, taxonomy=self.frog)
+        SpecimenFactory(taxonomy=TaxonomyFactory(family='Bufonidae'))
+
+        self.assertEqual(self.related(self.specimen), [
+            (same_species_here.pk, 'species_expedition'),
+            (same_species_elsewhere.pk, 'species'),
+            (same_genus_here.pk, 'genus_expedition'),
+        ])
+        self.assertEqual(self.related(self.specimen, limit=1), [(same_species_here.pk, 'species_expedition')])
+
+    @override_settings(RELATED_SPECIMENS=2)
+    def test_groups_stay_exact_through_moves_and_deletes(self):
+        specimens = [SpecimenFactory(expedition=self.expedition, taxonomy=self.frog) for _ in range(4)]
+        self.assertEqual(len(NeighbourGroup.objects.get(key=f'family:Ranidae').specimen_ids), 3)
+
+        # Leaving a full group moves an older member up; deletes do the same
+        specimens[-1].taxonomy = TaxonomyFactory(family='Bufonidae')
+        specimens[-1].save()
+        specimens[-2].delete()
+        self.assertEqual(NeighbourGroup.objects.get(key='family:Ranidae').specimen_ids,
+                         [specimens[1].pk, specimens[0].pk, self.specimen.pk])
+        self.assertGroupsMatchRebuild()
+
+    def test_saving_updates_all_groups_in_one_query(self):
+        specimen = SpecimenFactory.build(expedition=self.expedition, taxonomy=self.frog, specimen_id=999999)
+        # Record read, one locking read of the six groups and one UPDATE, inside a savepoint
+        with self.assertNumQueries(5):
+            neighbours.specimen_saved(specimen)
+        self.assertEqual(NeighbourGroup.objects.get(key='family:Ranidae').specimen_ids, [999999, self.specimen.pk])
+
+    def test_taxonomy_change_moves_its_specimens(self):
+        SpecimenFactory(expedition=self.elsewhere, taxonomy=self.frog)
+        self.frog.genus = 'Pelophylax'
+        self.frog.species = 'Pelophylax ridibundus'
+        self.frog.save()
+        self.assertFalse(NeighbourGroup.objects.filter(key='genus:Ranidae|Rana').exists())
+        self.assertGroupsMatchRebuild()
+
+    def test_detail_page_and_api_show_related_specimens(self):
+        neighbour = SpecimenFactory(expedition=self.elsewhere, taxonomy=self.frog)
+        response = self.client.get(reverse('specimen_detail', kwargs={'pk': self.specimen.pk}))
+        self.assertContains(response, neighbour.catalog_number)
+        self.assertContains(response, 'Same species')
+
+        response = self.client.get(reverse('specimen-related', kwargs={'pk': self.specimen.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['relation'], 'species')
+        self.assertEqual(response.data[0]['specimen']['specimen_id'], neighbour.pk)
+        self.assertEqual(self.client.get(reverse('specimen-related', kwargs={'pk': 999999})).status_code, 404)
+
+    def test_missing_groups_fall_back_to_the_records(self):
+        neighbour = SpecimenFactory(expedition=self.elsewhere, taxonomy=self.frog)
+        NeighbourGroup.objects.all().delete()
+        self.assertEqual(self.related(self.specimen)[0], (neighbour.pk, 'species'))
+
+        output = StringIO()
+        call_command('rebuild_related_specimens', stdout=output)
+        self.assertIn('default: rebuilt', output.getvalue())
+        self.assertTrue(NeighbourGroup.objects.filter(key='species:Ranidae|Rana|Rana temporaria').exists())
+
+
+# Tests fuzzy taxon name matching, batch reconciliation of import files and form suggestions
+class TaxonIndexTestCase(TestCase):
+    def setUp(self):
+        taxon_index.clear()
+        self.addCleanup(taxon_index.clear)
+        self.taxonomy = TaxonomyFactory(kingdom='Animalia', family='Ammonitidae', genus='Ammonites',
+                                        species='Ammonites bisulcatus Bruguiere, 1789')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write_csv(self, rows):
+        path = os.path.join(self.directory, 'import.csv')
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=importer.CSV_COLUMNS)
+            writer.writeheader()
+            for number, row in enumerate(rows, start=1):
+                writer.writerow({**{column: '' for column in importer.CSV_COLUMNS}, '_id': 9000 + number,
+                                 'catalogNumber': f'2000.1.1.{number}', 'expedition': 'Expedition Dorset',
+                                 'continent': 'Europe', 'country': 'United Kingdom', **row})
+        return path
+
+    def test_scores_and_classification(self):
+        index = TrigramIndex(['Ammonitidae', 'Ammonitina', 'Belemnitidae'])
+        self.assertEqual(index.search('Ammonitida')[0], ('Ammonitidae', 0.769))
+        self.assertEqual(index.search('Ammonitidae', threshold=0.9), [('Ammonitidae', 1.0)])
+        self.assertEqual(index.search('Xyz'), [])
+
+        self.assertEqual(index.classify('Ammonitidae')[0], 'exact')
+        self.assertEqual(index.classify(' ammonitidae ')[:2], ('variant', 'Ammonitidae'))
+        self.assertEqual(index.classify('Ammonitida')[:2], ('fuzzy', 'Ammonitidae'))
+        self.assertEqual(index.classify('Trilobita')[0], 'new')
+
+    def test_index_sees_new_taxonomies(self):
+        self.assertEqual(taxon_index.matches('family', 'Belemnitida'), [])
+        TaxonomyFactory(family='Belemnitidae')
+        self.assertEqual(taxon_index.matches('family', 'Belemnitida')[0][0], 'Belemnitidae')
+        with self.assertRaises(ValueError):
+            taxon_index.matches('colour', 'red')
+
+    def test_form_suggests_existing_names(self):
+        data = {'kingdom': 'Animalia', 'phylum': 'Mollusca', 'highest_biostratigraphic_zone': 'Conchifera',
+                'class_name': 'Cephalopoda', 'identification_description': 'Ammonitida', 'family': 'Ammonitida',
+                'genus': 'Ammonites', 'species': 'Ammonites  bisulcatus  Bruguiere, 1789 '}
+        form = TaxonomyForm(data)
+        self.assertFalse(form.is_valid())
+        # Stray whitespace is removed first, so the species is the existing one
+        self.assertEqual(form.suggestions, {'family': 'Ammonitidae'})
+        self.assertIn('Close to the existing name "Ammonitidae"', form.errors['family'][0])
+
+        form = TaxonomyForm({**data, 'keep_names': 'on'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['species'], 'Ammonites bisulcatus Bruguiere, 1789')
+
+    def test_reconcile_report_and_corrected_import(self):
+        path = self.write_csv([
+            {'higherClassification': 'Animalia', 'family': 'Ammonitida', 'genus': 'Ammonites',
+             'determinationNames': 'Ammonites bisulcatus  Bruguiere, 1789'},
+            {'higherClassification': 'Animalia', 'family': 'Ammonitidae', 'genus': 'Trilobites',
+             'determinationNames': 'Ammonites bisulcatus Bruguiere, 1789'},
+        ])
+        report_file = os.path.join(self.directory, 'report.csv')
+        report = importer.reconcile_csv(path, report_file, workers=2)
+        statuses = {(row['column'], row['value']): (row['status'], row['match']) for row in report}
+        self.assertEqual(statuses[('family', 'Ammonitida')], ('fuzzy', 'Ammonitidae'))
+        self.assertEqual(statuses[('determinationNames', 'Ammonites bisulcatus  Bruguiere, 1789')],
+                         ('variant', 'Ammonites bisulcatus Bruguiere, 1789'))
+        self.assertEqual(statuses[('genus', 'Trilobites')][0], 'new')
+        self.assertEqual(report, importer.reconcile_csv(path, workers=1))
+        with open(report_file) as csv_file:
+            self.assertEqual(len(list(csv.DictReader(csv_file))), len(report))
+
+        # The misspelt family is imported under the existing name
+        importer.import_csv(path, corrections=importer.corrections_from_report(report, 0.75))
+        self.assertEqual(set(Taxonomy.objects.values_list('family', flat=True)), {'Ammonitidae'})
+
+    def test_match_api_and_command(self):
+        response = self.client.get(reverse('taxonomy-match'), {'rank': 'family', 'name': 'Ammonitida'})
+        self.assertEqual(response.data['matches'], [{'name': 'Ammonitidae', 'score': 0.769}])
+        self.assertEqual(self.client.get(reverse('taxonomy-match'), {'rank': 'colour'}).status_code, 400)
+
+        output = StringIO()
+        call_command('reconcile_taxa', self.write_csv([{'family': 'Ammonitida'}]), workers=1, stdout=output)
+        self.assertIn("family: 'Ammonitida' -> 'Ammonitidae'", output.getvalue())
+
+
+class ValidationTestCase(TestCase):
+    VALUES = {
+        'catalog_number': ['2000.1.1.1', ' 2000.12.31.9999 ', '2000.1.1', 'a.b.c.d', '20000.1.1.1', '-1.1.1.1',
+                           '２０００.1.1.1', '', '1' * 51],
+        'expedition': ['Expedition Dorset', 'expedition  kenya', 'The Expedition', 'Trip', ''],
+        'continent': ['Europe', 'north america', 'Atlantis', ''],
+        'country': ['Kenya', 'KE', 'Atlantis', ''],
+        'family': ['Ranidae', 'Ra', ' R  a ', 'R a', '', 'x' * 51],
+    }
+    VALID = {'catalog_number': '2000.1.1.1', 'expedition': 'Expedition Dorset', 'continent': 'Europe',
+             'country': 'United Kingdom', 'kingdom': 'Animalia', 'phylum': 'Chordata',
+             'highest_biostratigraphic_zone': 'Vertebrata', 'class_name': 'Amphibia',
+             'identification_description': 'Anura', 'family': 'Ranidae', 'genus': 'Rana', 'species': 'Rana temporaria'}
+    FORMS = {'catalog_number': SpecimenForm, 'expedition': ExpeditionForm, 'continent': ExpeditionForm,
+             'country': ExpeditionForm, 'family': TaxonomyForm}
+
+    def setUp(self):
+        taxon_index.clear()
+        self.addCleanup(taxon_index.clear)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def csv_row(self, number, **fields):
+        values = {**self.VALID, **fields}
+        row = {column: values[field] for field, column in importer.FIELD_COLUMNS.items()}
+        return {**row, '_id': 9000 + number}
+
+    def write_csv(self, rows):
+        path = os.path.join(self.directory, 'import.csv')
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=importer.CSV_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def test_batch_errors_match_the_forms(self):
+        for field, values in self.VALUES.items():
+            errors = validation.validate_columns({field: values}).by_row()
+            for row, value in enumerate(values):
+                form = self.FORMS[field]({**self.VALID, field: value})
+                form.is_valid()
+                self.assertEqual(errors.get(row, {}).get(field), form.errors.get(field, [None])[0], (field, value))
+
+    def test_error_table(self):
+        table = validation.validate_rows([
+            self.VALID,
+            {**self.VALID, 'catalog_number': '2000.1.1', 'country': 'Atlantis'},
+            {**self.VALID, 'species': None},
+        ])
+        self.assertEqual(table.row_count, 3)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.invalid_rows(), [1, 2])
+        self.assertEqual(set(table.by_row()[1]), {'catalog_number', 'country'})
+        self.assertEqual(table.as_list(1), [{'row': 1, 'field': 'catalog_number', 'message': table.by_row()[1]['catalog_number']}])
+        self.assertEqual(table.summary()[('species', 'Species must be at least 3 characters long.')], 1)
+        self.assertFalse(validation.validate_rows([self.VALID] * 3))
+
+        with self.assertRaises(ValueError):
+            validation.validate_columns({'colour': ['red']})
+        with self.assertRaises(ValueError):
+            validation.validate_columns({'continent': ['Europe'], 'country': []})
+
+    def test_import_validates_before_writing(self):
+        path = self.write_csv([self.csv_row(1), self.csv_row(2, continent='Atlantis')])
+        self.assertEqual(importer.validate_csv(path).by_row(), {1: {'continent': 'Invalid continent entered.'}})
+        with self.assertRaises(validation.BatchValidationError) as raised:
+            importer.import_csv(path, validate=True)
+        self.assertIn('1 of 2 rows are invalid (row 1 continent: Invalid continent entered.)', str(raised.exception))
+        self.assertFalse(Specimen.objects.exists())
+
+        job = Job.objects.create(kind='import_csv', params={'path': path, 'validate': True})
+        with override_settings(JOB_IMPORT_DIR=self.directory):
+            jobs.run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertFalse(Specimen.objects.exists())
+
+        self.assertEqual(importer.import_csv(self.write_csv([self.csv_row(1)]), validate=True), 1)
+        self.assertTrue(Specimen.objects.filter(pk=9001).exists())
+
+    def test_bulk_api(self):
+        url = reverse('specimen-bulk')
+        rows = [self.csv_row(1), self.csv_row(2, expedition='Trip', family='Ra')]
+        response = self.client.post(url, rows, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['invalid_rows'], 1)
+        self.assertEqual({error['field'] for error in response.json()['errors']}, {'expedition', 'family'})
+        self.assertFalse(Specimen.objects.exists())
+
+        rows[1] = self.csv_row(2)
+        response = self.client.post(f'{url}?dry_run=1', rows, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Specimen.objects.exists())
+
+        response = self.client.post(url, rows, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'rows': 2, 'invalid_rows': 0, 'created': 2})
+        self.assertEqual(SpecimenRecord.objects.get(pk=9002).family, 'Ranidae')
+
+    def test_bulk_api_rejects_malformed_batches(self):
+        url = reverse('specimen-bulk')
+        self.assertEqual(self.client.post(url, {'rows': []}, content_type='application/json').status_code, 400)
+        row = self.csv_row(1)
+        del row['country']
+        response = self.client.post(url, [row], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Rows are missing columns: country.')
+        with override_settings(BULK_MAX_ROWS=1):
+            response = self.client.post(url, [self.csv_row(1), self.csv_row(2)], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_api_queues_large_batches(self):
+        url = reverse('specimen-bulk')
+        with override_settings(BULK_SYNC_MAX_ROWS=2, JOB_IMPORT_DIR=self.directory):
+            response = self.client.post(url, [self.csv_row(number) for number in range(1, 4)],
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 202)
+            job = Job.objects.get(pk=response.json()['job'])
+            self.assertEqual(response.json()['status_url'], reverse('job-detail', kwargs={'pk': job.pk}))
+            self.assertFalse(Specimen.objects.exists())
+
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result['created']), (Job.DONE, 3))
+        self.assertEqual(Specimen.objects.count(), 3)
+        # The batch file is removed once imported
+        self.assertEqual(os.listdir(self.directory), [])
+        # Bulk writes share the smallest admission group
+        self.assertEqual(settings.ADMISSION_ROUTES['specimen-bulk'], 'bulk')
+        self.assertEqual(settings.ADMISSION_ROUTES['taxonomy-reclassify'], 'bulk')
+
+    def test_imported_values_are_stripped_like_validated_ones(self):
+        row = self.csv_row(1, expedition=' Expedition Dorset ', continent=' Europe ', country=' Kenya ',
+                           catalog_number=' 2000.1.1.1 ', genus=' Rana ')
+        response = self.client.post(reverse('specimen-bulk'), [row], content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        record = SpecimenRecord.objects.get(pk=9001)
+        self.assertEqual((record.expedition_name, record.continent, record.country, record.catalog_number, record.genus),
+                         ('Expedition Dorset', 'Europe', 'Kenya', '2000.1.1.1', 'Rana'))
+
+
+class ReclassifyTestCase(TestCase):
+    RANKS = {'kingdom': 'Animalia', 'phylum': 'Chordata', 'highest_biostratigraphic_zone': 'Vertebrata',
+             'class_name': 'Amphibia', 'identification_description': 'Anura', 'family': 'Ranidae'}
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        taxon_index.clear()
+        self.addCleanup(taxon_index.clear)
+        self.expedition = ExpeditionFactory()
+        self.common = Taxonomy.objects.create(**self.RANKS, genus='Rana', species='Rana temporaria')
+        self.moor = Taxonomy.objects.create(**self.RANKS, genus='Rana', species='Rana arvalis')
+        self.toad = Taxonomy.objects.create(**{**self.RANKS, 'family': 'Bufonidae'}, genus='Bufo', species='Bufo bufo')
+        self.specimens = [SpecimenFactory(expedition=self.expedition, taxonomy=taxonomy)
+                          for taxonomy in (self.common, self.common, self.moor, self.toad)]
+
+    def test_preview_counts_without_writing(self):
+        Taxonomy.objects.create(**self.RANKS, genus='Lithobates', species='Lithobates arvalis')
+        version = versioning.current_version()
+        with self.assertNumQueries(2):
+            preview = reclassify.preview(Taxonomy.objects.filter(genus='Rana'), {'genus': 'Lithobates'})
+
+        self.assertEqual((preview['taxonomies'], preview['specimens'], preview['merged']), (2, 3, 1))
+        self.assertEqual([(group['new']['species'], group['specimens'], group['merges']) for group in preview['groups']],
+                         [('Lithobates temporaria', 2, False), ('Lithobates arvalis', 1, True)])
+        self.assertEqual(versioning.current_version(), version)
+        self.assertEqual(Taxonomy.objects.filter(genus='Rana').count(), 2)
+
+        with self.assertRaises(ValidationError):
+            reclassify.preview(Taxonomy.objects.all(), {'genus': 'Li'})
+        with self.assertRaises(ValidationError):
+            reclassify.preview(Taxonomy.objects.all(), {'colour': 'Green'})
+
+    def test_rename_genus_updates_records_and_derived_data(self):
+        version = versioning.current_version()
+        seq = changes.latest_seq()
+        self.assertEqual(taxon_index.matches('genus', 'Lithobates'), [])
+
+        result = reclassify.apply(Taxonomy.objects.filter(genus='Rana'), {'genus': 'Lithobates'})
+
+        self.assertEqual(result, {'taxonomies': 2, 'specimens': 3, 'merged': 0})
+        self.common.refresh_from_db()
+        self.assertEqual((self.common.genus, self.common.species), ('Lithobates', 'Lithobates temporaria'))
+        self.assertEqual(SpecimenRecord.objects.get(pk=self.specimens[2].pk).species, 'Lithobates arvalis')
+        self.assertFalse(NeighbourGroup.objects.filter(key__contains='|Rana').exists())
+        self.assertEqual(NeighbourGroup.objects.get(key='genus:Ranidae|Lithobates').specimen_ids,
+                         sorted([specimen.pk for specimen in self.specimens[:3]], reverse=True))
+        groups = dict(NeighbourGroup.objects.values_list('key', 'specimen_ids'))
+        neighbours.rebuild()
+        self.assertEqual(dict(NeighbourGroup.objects.values_list('key', 'specimen_ids')), groups)
+        self.assertGreater(versioning.current_version(), version)
+        self.assertEqual({(change.model, change.object_id, change.action, change.data['genus']) for change in changes.changes_since(seq)},
+                         {('taxonomy', pk, Change.UPDATE, 'Lithobates') for pk in (self.common.pk, self.moor.pk)})
+        self.assertEqual(reference_cache.for_model(Taxonomy).get(self.common.pk).genus, 'Lithobates')
+        self.assertEqual(taxon_index.matches('genus', 'Lithobates')[0][0], 'Lithobates')
+
+    def test_move_genus_moves_expedition_counts(self):
+        reclassify.apply(Taxonomy.objects.filter(genus='Rana'), {'family': 'Bufonidae'})
+
+        self.assertEqual(ExpeditionStats.objects.get(expedition=self.expedition).top_taxa, [{'family': 'Bufonidae', 'specimens': 4}])
+        self.assertFalse(ExpeditionTaxonCount.objects.filter(family='Ranidae').exists())
+        self.assertEqual(set(SpecimenRecord.objects.values_list('family', flat=True)), {'Bufonidae'})
+        self.assertEqual(expedition_stats.reconcile()['drifted'], 0)
+
+    def test_duplicates_are_merged_into_the_oldest_taxonomy(self):
+        seq = changes.latest_seq()
+        result = reclassify.apply(Taxonomy.objects.filter(pk=self.moor.pk), {'species': 'Rana temporaria'})
+
+        self.assertEqual(result['merged'], 1)
+        self.assertFalse(Taxonomy.objects.filter(pk=self.moor.pk).exists())
+        self.assertEqual(Specimen.objects.get(pk=self.specimens[2].pk).taxonomy_id, self.common.pk)
+        self.assertEqual(SpecimenRecord.objects.get(pk=self.specimens[2].pk).taxonomy_id, self.common.pk)
+        self.assertEqual(Specimen.objects.count(), 4)
+        feed = {(change.model, change.object_id, change.action) for change in changes.changes_since(seq)}
+        self.assertEqual(feed, {('specimen', self.specimens[2].pk, Change.UPDATE), ('taxonomy', self.moor.pk, Change.DELETE)})
+
+    def test_api_previews_and_applies(self):
+        url = reverse('taxonomy-reclassify')
+        body = {'match': {'genus': 'Rana'}, 'set': {'genus': 'Lithobates'}}
+        response = self.client.post(f'{url}?dry_run=1', body, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['specimens']), (200, 3))
+        self.assertTrue(Taxonomy.objects.filter(genus='Rana').exists())
+
+        response = self.client.post(url, body, content_type='application/json')
+        self.assertEqual(response.json()['result'], {'taxonomies': 2, 'specimens': 3, 'merged': 0})
+        self.assertFalse(Taxonomy.objects.filter(genus='Rana').exists())
+
+        for bad in ({'match': {}, 'set': {'genus': 'Rana'}}, {'match': {'genus': 'Bufo'}, 'set': {'genus': 'B'}}, []):
+            self.assertEqual(self.client.post(url, bad, content_type='application/json').status_code, 400)
+
+    def test_admin_action(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'adminpass')
+        self.client.login(username='admin', password='adminpass')
+        url = reverse('admin:specimen_catalog_taxonomy_changelist')
+        selection = {'action': 'reclassify_taxonomies', '_selected_action': [self.common.pk, self.moor.pk]}
+
+        self.assertContains(self.client.post(url, selection), 'New genus')
+        response = self.client.post(url, {**selection, 'reclassify': 'preview', 'genus': 'Lithobates'})
+        self.assertContains(response, 'Preview: 2 taxonomies, 3 specimens, 0 duplicates merged')
+        self.assertTrue(Taxonomy.objects.filter(genus='Rana').exists())
+
+        response = self.client.post(url, {**selection, 'reclassify': 'apply', 'genus': 'Lithobates'})
+        self.assertRedirects(response, url)
+        self.assertEqual(Taxonomy.objects.filter(genus='Lithobates').count(), 2)
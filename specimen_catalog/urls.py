@@ -2,7 +2,7 @@
 from django.urls import path, include
 from . import views
 from .views import (IndexView, AllSpecimensView, SpecimenDetailView, ExpeditionUpdateView, TaxonomyUpdateView, 
-                    SpecimenDeleteView, NewSpecimenView, NewTaxonomyView, NewExpeditionView,
+                    SpecimenDeleteView, NewSpecimenView, NewTaxonomyView, NewExpeditionView, ExpeditionListView,
                     )
 
 # URL patterns defines routes for specimen_catalog app
@@ -11,6 +11,8 @@ urlpatterns = [
     path('', IndexView.as_view(), name='index'), 
     # Displays all specimens listed in a table                                                                 
     path('all_specimens/', AllSpecimensView.as_view(), name='all_specimens'),  
+    # Lists expeditions by specimen count
+    path('expeditions/', ExpeditionListView.as_view(), name='expedition_list'),
     # View details of a specific specimen                            
     path('specimen/detail/<int:pk>/', SpecimenDetailView.as_view(), name='specimen_detail'),  
     # Updates a specific specimen record
@@ -32,10 +34,37 @@ urlpatterns = [
     # SPECIMENS
     path('api/specimens/', views.SpecimenListAPIView.as_view(), name='specimen-list'),
     path('api/specimens/<int:pk>/', views.SpecimenDetailAPIView.as_view(), name='specimen-detail'),
+    path('api/specimens/<int:pk>/related/', views.SpecimenRelatedAPIView.as_view(), name='specimen-related'),
+    path('api/specimens/bulk/', views.SpecimenBulkAPIView.as_view(), name='specimen-bulk'),
     # EXPEDITION
     path('api/expeditions/', views.ExpeditionListAPIView.as_view(), name='expedition-list'),
     path('api/expeditions/<int:pk>/', views.ExpeditionDetailAPIView.as_view(), name='expedition-detail'),
+    path('api/expeditions/stats/', views.ExpeditionStatsListAPIView.as_view(), name='expedition-stats-list'),
     # TAXONOMIES
     path('api/taxonomies/', views.TaxonomyListAPIView.as_view(), name='taxonomy-list'),
     path('api/taxonomies/<int:pk>/', views.TaxonomyDetailAPIView.as_view(), name='taxonomy-detail'),
-]
+    path('api/taxonomies/match/', views.TaxonomyMatchAPIView.as_view(), name='taxonomy-match'),
+    path('api/taxonomies/reclassify/', views.TaxonomyReclassifyAPIView.as_view(), name='taxonomy-reclassify'),
+    # ASYNC (same responses as above, through the async ORM; deploy with the ASGI entry point)
+    path('api/async/specimens/', views.AsyncSpecimenListAPIView.as_view(), name='async-specimen-list'),
+    path('api/async/specimens/<int:pk>/', views.AsyncSpecimenDetailAPIView.as_view(), name='async-specimen-detail'),
+    path('api/async/expeditions/', views.AsyncExpeditionListAPIView.as_view(), name='async-expedition-list'),
+    path('api/async/expeditions/<int:pk>/', views.AsyncExpeditionDetailAPIView.as_view(), name='async-expedition-detail'),
+    path('api/async/taxonomies/', views.AsyncTaxonomyListAPIView.as_view(), name='async-taxonomy-list'),
+    path('api/async/taxonomies/<int:pk>/', views.AsyncTaxonomyDetailAPIView.as_view(), name='async-taxonomy-detail'),
+    # ANALYTICS
+    path('api/analytics/counts/', views.AnalyticsAPIView.as_view(operation='counts'), name='analytics-counts'),
+    path('api/analytics/distinct/', views.AnalyticsAPIView.as_view(operation='distinct'), name='analytics-distinct'),
+    path('api/analytics/crosstab/', views.AnalyticsAPIView.as_view(operation='crosstab'), name='analytics-crosstab'),
+    # BIODIVERSITY
+    path('api/biodiversity/report/', views.BiodiversityReportAPIView.as_view(), name='biodiversity-report'),
+    path('api/biodiversity/<str:group>/', views.BiodiversityAPIView.as_view(), name='biodiversity'),
+    # CHANGE FEED
+    path('api/changes/', views.ChangeFeedAPIView.as_view(), name='change-feed'),
+    # JOBS
+    path('api/jobs/', views.JobListAPIView.as_view(), name='job-list'),
+    path('api/jobs/<int:pk>/', views.JobDetailAPIView.as_view(), name='job-detail'),
+
+    # METRICS (Prometheus text format)
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
+]
\ No newline at end of file
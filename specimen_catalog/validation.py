@@ -0,0 +1,207 @@
+import re
+from collections import Counter
+from functools import lru_cache
+
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxLengthValidator
+
+from .models import Specimen, Expedition, Taxonomy
+from .read_model import TAXONOMY_COLUMNS
+from .lazy_imports import lazy_import
+from . import taxon_index
+
+np = lazy_import('numpy')
+
+# For country validation; loaded on the first lookup, not by every worker that imports the forms
+pycountry = lazy_import('pycountry')
+
+ALLOWED_CONTINENTS = ['Africa', 'Antarctica', 'Asia', 'Europe', 'North America', 'Oceania', 'South America']
+
+# Maximum length of each dot-separated part of a catalog number (registration year.month.day.number)
+CATALOG_NUMBER_MAX_LENGTHS = [4, 2, 2, 4]
+
+# Catalog numbers this matches pass check_catalog_number; the others are checked one by one
+CATALOG_NUMBER_PATTERN = re.compile(r'\d{1,4}\.\d{1,2}\.\d{1,2}\.\d{1,4}', re.ASCII)
+
+# Labels of the taxonomy fields, also used by TaxonomyForm
+TAXONOMY_LABELS = {
+    'kingdom': 'Kingdom',
+    'phylum': 'Phylum',
+    'highest_biostratigraphic_zone': 'Sub-phylum',
+    'class_name': 'Class',
+    'identification_description': 'Order',
+    'family': 'Family',
+    'genus': 'Genus',
+    'species': 'Species',
+}
+TAXON_MIN_LENGTH = 3
+
+
+# Field rules shared by the forms and the batch validator. Each one returns the cleaned value
+# or raises a ValidationError with the message the form shows.
+
+def check_catalog_number(catalog_number):
+    # Validates catalog number format (four parts separated by dots)
+    parts = catalog_number.split('.')
+    if len(parts) != 4:
+        raise ValidationError('Invalid catalog number format. Should have 4 parts separated by dots.')
+
+    for part, max_length in zip(parts, CATALOG_NUMBER_MAX_LENGTHS):
+        try:
+            # Checks if each part is a non-negative integer and within the specified maximum length
+            value = int(part)
+            if value < 0 or len(part) > max_length:
+                raise ValueError
+        except ValueError:
+            raise ValidationError(f'Invalid catalog number. Parts must be non-negative integers with a maximum length of {max_length}.')
+
+    return catalog_number
+
+
+def check_expedition(expedition):
+    expedition = expedition.strip()
+
+    # Empty names need no further validation
+    if not expedition:
+        return expedition
+
+    if 'expedition' not in expedition.lower():
+        raise ValidationError('Invalid expedition format. Should contain "Expedition".')
+    if not expedition.lower().startswith('expedition '):
+        raise ValidationError('Invalid expedition format. Should start with "Expedition" followed by a space and another word.')
+
+    return expedition
+
+
+def check_continent(continent):
+    # Continents are compared case-insensitively
+    if continent.title() not in ALLOWED_CONTINENTS:
+        raise ValidationError('Invalid continent entered.')
+    return continent
+
+
+def check_country(country):
+    # Accepts a country code or name known to pycountry
+    if not is_country(country):
+        raise ValidationError('Invalid country entered.')
+    return country
+
+
+# Lookups are cached: pycountry scans every country for names it does not know
+@lru_cache(maxsize=4096)
+def is_country(country):
+    try:
+        pycountry.countries.lookup(country)
+    except LookupError:
+        return False
+    return True
+
+
+def check_taxon_name(name, label, min_length=TAXON_MIN_LENGTH):
+    # Stray whitespace is removed before the length is checked
+    name = taxon_index.normalise(name)
+    if len(name) < min_length:
+        raise ValidationError(f'{label} must be at least {min_length} characters long.')
+    return name
+
+
+# Per field: the model it belongs to and its rule
+RULES = {
+    'catalog_number': (Specimen, check_catalog_number),
+    'expedition': (Expedition, check_expedition),
+    'continent': (Expedition, check_continent),
+    'country': (Expedition, check_country),
+    **{rank: (Taxonomy, lambda name, label=TAXONOMY_LABELS[rank]: check_taxon_name(name, label))
+       for rank in TAXONOMY_COLUMNS},
+}
+
+
+# Rule errors of a column as (row, message) pairs. Each distinct value is checked once, and
+# values matching `passes` (a compiled pattern) skip the rule.
+def rule_errors(values, rule, rows, passes=None):
+    messages = {}
+    for value in dict.fromkeys(values[row] for row in rows):
+        if passes is not None and passes.fullmatch(value):
+            continue
+        try:
+            rule(value)
+        except ValidationError as error:
+            messages[value] = error.messages[0]
+    if not messages:
+        return []
+    return [(row, messages[values[row]]) for row in rows if values[row] in messages]
+
+
+# Errors of a batch: one (row, field, message) per invalid field, ordered by row
+class ErrorTable:
+    def __init__(self, row_count, errors):
+        self.row_count = row_count
+        self.errors = sorted(errors, key=lambda error: error[0])
+
+    def __len__(self):
+        return len(self.errors)
+
+    def invalid_rows(self):
+        return sorted({row for row, _, _ in self.errors})
+
+    def by_row(self):
+        rows = {}
+        for row, field, message in self.errors:
+            rows.setdefault(row, {})[field] = message
+        return rows
+
+    def as_list(self, limit=None):
+        return [{'row': row, 'field': field, 'message': message} for row, field, message in self.errors[:limit]]
+
+    # Number of rows per (field, message)
+    def summary(self):
+        return Counter((field, message) for _, field, message in self.errors)
+
+
+# A submitted value as the forms read it: a string without surrounding whitespace
+def clean_value(value):
+    return ('' if value is None else str(value)).strip()
+
+
+# Raised when a batch is refused because some of its rows are invalid
+class BatchValidationError(ValueError):
+    def __init__(self, table):
+        self.table = table
+        first = '; '.join(f"row {error['row']} {error['field']}: {error['message']}" for error in table.as_list(3))
+        super().__init__(f'{len(table.invalid_rows())} of {table.row_count} rows are invalid ({first}).')
+
+
+# Validates a batch given as columns of equal length, {field: [values]}, with the same rules
+# as the forms, and returns an ErrorTable. Fields left out are not checked.
+# Like the form fields, values are read as stripped strings and a value over its field's max_length gets
+# only that error. Lengths are compared for the whole column at once, rules run once per
+# distinct value, and catalog numbers matching CATALOG_NUMBER_PATTERN skip theirs.
+def validate_columns(columns):
+    row_count = len(next(iter(columns.values()), []))
+    errors = []
+    for field, values in columns.items():
+        if field not in RULES:
+            raise ValueError(f'Unknown field {field!r}. Choose from: {", ".join(RULES)}.')
+        if len(values) != row_count:
+            raise ValueError('All columns must have the same length.')
+        model, rule = RULES[field]
+
+        values = [clean_value(value) for value in values]
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=row_count)
+        max_length = model._meta.get_field(field).max_length
+        too_long = lengths > max_length
+        length_rule = MaxLengthValidator(max_length)
+        errors.extend((row, field, message) for row, message
+                      in rule_errors(values, length_rule, np.flatnonzero(too_long).tolist()))
+
+        passes = CATALOG_NUMBER_PATTERN if field == 'catalog_number' else None
+        errors.extend((row, field, message) for row, message
+                      in rule_errors(values, rule, np.flatnonzero(~too_long).tolist(), passes))
+
+    return ErrorTable(row_count, errors)
+
+
+# Validates rows given as dicts keyed by field name
+def validate_rows(rows, fields=None):
+    fields = fields or list(RULES)
+    return validate_columns({field: [row.get(field) for row in rows] for field in fields})
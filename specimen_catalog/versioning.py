@@ -0,0 +1,17 @@
+from django.db.models import F
+from .models import DataVersion
+
+# The counter lives in a single row with a fixed primary key
+DATA_VERSION_PK = 1
+
+
+# Returns the current data version (0 before the first write)
+def current_version():
+    version = DataVersion.objects.filter(pk=DATA_VERSION_PK).values_list('version', flat=True).first()
+    return version or 0
+
+
+# Increments the data version inside the caller's transaction
+def bump_version():
+    if not DataVersion.objects.filter(pk=DATA_VERSION_PK).update(version=F('version') + 1):
+        DataVersion.objects.get_or_create(pk=DATA_VERSION_PK, defaults={'version': 1})
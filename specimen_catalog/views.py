@@ -1,23 +1,70 @@
 # Django-related imports
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views import View
+from django.conf import settings
 from django.views.generic import ListView, DetailView, DeleteView, UpdateView
 from django.contrib import messages  # Handling messages
 from django.urls import reverse_lazy, reverse  # URL Handling
-from django.core.paginator import Paginator, EmptyPage  # Paginator
+from django.core.paginator import EmptyPage  # Paginator
 from django.core.exceptions import ValidationError
-from django.http import Http404, HttpResponseServerError, HttpResponseRedirect, JsonResponse, HttpResponseNotFound
+from django.http import (Http404, HttpResponse, HttpResponseForbidden, HttpResponseServerError, HttpResponseRedirect,
+                         JsonResponse, HttpResponseNotFound)
 
 # Model and Form imports
-from .models import Specimen, Expedition, Taxonomy  # Models
+from .models import Specimen, Expedition, Taxonomy, SpecimenRecord, Job  # Models
 from .forms import SpecimenForm, ExpeditionForm, TaxonomyForm, NewSpecimenForm  # Forms
 
 # Filter import
-from .filters import SpecimenFilter  # Filters
+from .filters import SpecimenRecordFilter  # Filters
 
 # REST framework imports
-from .serializers import SpecimenSerializer, ExpeditionSerializer, TaxonomySerializer
-from rest_framework import generics
+from .serializers import (SpecimenSerializer, SpecimenRecordSerializer, ExpeditionSerializer, TaxonomySerializer, JobSerializer,
+                          ExpeditionStatsSerializer)
+from rest_framework import generics, status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+# Analytics imports
+from . import analytics, biodiversity
+
+# Change feed import
+from . import changes
+
+# Sharding import
+from . import sharding
+
+# Write batching import
+from . import write_batching
+
+# Async views import
+from asgiref.sync import sync_to_async
+
+# Request coalescing import
+from .single_flight import SingleFlightMixin
+
+# Metrics import
+from . import metrics
+
+# Cached page counts import
+from .pagination import CachedCountPaginator, ExpeditionStatsPagination
+
+# Reference data cache import
+from . import reference_cache
+
+# Expedition listing from precomputed counters
+from . import expedition_stats
+
+# Related specimens from precomputed neighbour groups
+from . import neighbours
+
+# Fuzzy taxon name matching
+from . import taxon_index
+
+# Validated bulk imports; large batches are queued as import jobs
+from . import importer, jobs
+
+# Bulk taxonomy reclassification
+from . import reclassify
 
 # Template-related import
 from django.views.generic import TemplateView
@@ -28,12 +75,14 @@ class IndexView(TemplateView):
     template_name = 'specimen_catalog/index.html'
 
 # Django ListView for displaying all specimens
-class AllSpecimensView(ListView):
-    model = Specimen
+# Reads from the flat SpecimenRecord table so listing and filtering never join.
+# Identical concurrent requests share one render (see single_flight.py).
+class AllSpecimensView(SingleFlightMixin, ListView):
+    model = SpecimenRecord
     template_name = 'specimen_catalog/all_specimens.html'
     context_object_name = 'specimens'
-    queryset = Specimen.objects.all()
-    filterset_class = SpecimenFilter  # Specifies filter class for queryset filtering
+    queryset = SpecimenRecord.objects.all()
+    filterset_class = SpecimenRecordFilter  # Specifies filter class for queryset filtering
 
     def get_context_data(self, **kwargs):
         # Overrides to include additional context data
@@ -42,13 +91,14 @@ class AllSpecimensView(ListView):
         # Tries to apply filters to the queryset
         filter = None
         try:
-            filter = SpecimenFilter(self.request.GET, queryset=self.get_queryset())
+            filter = SpecimenRecordFilter(self.request.GET, queryset=self.get_queryset())
         except ValidationError as e:
             messages.error(self.request, f"Invalid filter parameters: {e}")
-            filter = SpecimenFilter(queryset=Specimen.objects.none())
+            filter = SpecimenRecordFilter(queryset=SpecimenRecord.objects.none())
 
-        # Sets up pagination for the specimens
-        paginator = Paginator(filter.qs, 20)
+        # Sets up pagination for the specimens (merged across shards when sharding is enabled);
+        # the total count is cached per data version
+        paginator = CachedCountPaginator(sharding.sharded(filter.qs), 20)
         page = self.request.GET.get('page', 1)
 
         try:
@@ -69,24 +119,45 @@ class AllSpecimensView(ListView):
         
         # Defines filter parameters based on expedition continent and country
         filter_params = {
-            'expedition__continent__icontains': self.request.GET.get('expedition__continent', ''),
-            'expedition__country__icontains': self.request.GET.get('expedition__country', ''),
+            'continent__icontains': self.request.GET.get('expedition__continent', ''),
+            'country__icontains': self.request.GET.get('expedition__country', ''),
         }
 
         # Applys filters and order by specimen_id in descending order
         return queryset.filter(**filter_params).order_by('-specimen_id')
 
+# Lists expeditions with their specimen counts and most common families, by most specimens
+# or with ?sort=fewest. Counts come from ExpeditionStats instead of counting specimens.
+class ExpeditionListView(ListView):
+    template_name = 'specimen_catalog/expedition_list.html'
+    context_object_name = 'expeditions'
+    paginate_by = 20
+    paginator_class = CachedCountPaginator
+
+    def get_queryset(self):
+        return expedition_stats.listing(self.request.GET.get('sort'))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['sort'] = 'fewest' if self.request.GET.get('sort') == 'fewest' else 'most'
+        return context
+
 # Displays a single speciment with its details, taxonomy and expedtion
 class SpecimenDetailView(DetailView):
     model = Specimen
     template_name = 'specimen_catalog/specimen_detail.html'
     context_object_name = 'specimen'
 
+    def get_queryset(self):
+        # Looks the specimen up on every shard when sharding is enabled
+        return sharding.sharded(super().get_queryset())
+
     def get_object(self, queryset=None):
         # Error Handling
         try:
-            # Attempts to get the object based on the provided queryset
-            return super().get_object(queryset=queryset)
+            # Attempts to get the object based on the provided queryset; its taxonomy and
+            # expedition come from the reference cache instead of a query each
+            return reference_cache.attach([super().get_object(queryset=queryset)])[0]
         except Http404 as e:
             # Handles the case where the object is not found
             raise e from None
@@ -96,6 +167,9 @@ class SpecimenDetailView(DetailView):
         try:
             # Calls the superclass method to get the default context data
             context = super().get_context_data(**kwargs)
+            # Adds the related specimens panel as (record, label) pairs
+            context['related_specimens'] = [(record, neighbours.LABELS[level])
+                                             for record, level in neighbours.related(self.object)]
             return context
         except Exception as e:
             # Handles other exceptions that may occur during context data retrieval
@@ -108,6 +182,9 @@ class SpecimenUpdateView(UpdateView):
     template_name = 'specimen_catalog/specimen_update.html'
     form_class = SpecimenForm  # Replace with your actual form
 
+    def get_queryset(self):
+        return sharding.sharded(super().get_queryset())
+
     def get_object(self, queryset=None):
         try:
             # Attempts to get the object based on the provided queryset
@@ -146,7 +223,7 @@ class ExpeditionUpdateView(View):
     def get(self, request, pk):
         # Handles GET request for updating expedition information
         try:
-            expedition = get_object_or_404(Expedition, pk=pk)
+            expedition = get_object_or_404(sharding.sharded(Expedition.objects.all()), pk=pk)
             form = ExpeditionForm(instance=expedition)
             return render(request, self.template_name, {'form': form, 'expedition': expedition})
         except Http404:
@@ -156,7 +233,7 @@ class ExpeditionUpdateView(View):
 
     def post(self, request, pk):
         # Handles POST request for updating expedition information
-        expedition = get_object_or_404(Expedition, pk=pk)
+        expedition = get_object_or_404(sharding.sharded(Expedition.objects.all()), pk=pk)
         form = ExpeditionForm(request.POST, instance=expedition)
         
         if form.is_valid():
@@ -186,7 +263,7 @@ class TaxonomyUpdateView(View):
 
     def get(self, request, specimen_pk):
         try:
-            specimen = get_object_or_404(Specimen, pk=specimen_pk)
+            specimen = get_object_or_404(sharding.sharded(Specimen.objects.all()), pk=specimen_pk)
             taxonomy = specimen.taxonomy
             form = TaxonomyForm(instance=taxonomy)
             return render(request, self.template_name, {'form': form, 'specimen': specimen})
@@ -196,7 +273,7 @@ class TaxonomyUpdateView(View):
             return redirect('specimen_detail', pk=specimen_pk)  # Redirects to specimen_detail with the same ID
 
     def post(self, request, specimen_pk):
-        specimen = get_object_or_404(Specimen, pk=specimen_pk)
+        specimen = get_object_or_404(sharding.sharded(Specimen.objects.all()), pk=specimen_pk)
         taxonomy = specimen.taxonomy
         form = TaxonomyForm(request.POST, instance=taxonomy)
 
@@ -217,6 +294,9 @@ class SpecimenDeleteView(DeleteView):
     template_name = 'specimen_catalog/specimen_delete_confirm.html'
     success_url = reverse_lazy('all_specimens')
 
+    def get_queryset(self):
+        return sharding.sharded(super().get_queryset())
+
     def get(self, request, *args, **kwargs):
         # Handles GET request for specimen deletion confirmation
         try:
@@ -257,7 +337,8 @@ class NewSpecimenView(View):
             # Checks if the form is not empty
             if request.POST:
                 if form.is_valid():
-                    new_specimen = form.save()
+                    # Saves through the write coalescer so bursts of creates share a transaction
+                    new_specimen = write_batching.run_write(form.save)
 
                     # Adds a success message
                     messages.success(request, f'New specimen (Specimen {new_specimen.specimen_id}) created successfully.')
@@ -346,22 +427,124 @@ class NewExpeditionView(View):
         return render(request, self.template_name, {'expedition_form': expedition_form})
     
 # Serializers API views
-class SpecimenListAPIView(generics.ListCreateAPIView):
+# Lists are served from the SpecimenRecord read table, creates still go through Specimen.
+# Identical concurrent list requests share one query and serialisation.
+class SpecimenListAPIView(SingleFlightMixin, generics.ListCreateAPIView):
     queryset = Specimen.objects.all()
     serializer_class = SpecimenSerializer
 
+    def get_queryset(self):
+        if self.request.method == 'GET':
+            return sharding.sharded(SpecimenRecord.objects.all())
+        return super().get_queryset()
+
+    def list(self, request, *args, **kwargs):
+        # ?after=<specimen_id>&limit=<n> returns a keyset page in descending specimen_id order
+        if 'after' not in request.query_params and 'limit' not in request.query_params:
+            return super().list(request, *args, **kwargs)
+
+        try:
+            after = int(request.query_params['after']) if 'after' in request.query_params else None
+            limit = min(int(request.query_params.get('limit', 100)), 1000)
+        except ValueError:
+            return Response({'error': 'after and limit must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.get_queryset()
+        if isinstance(queryset, sharding.ShardedQuerySet):
+            page = queryset.page_after(after, limit)
+        else:
+            page = queryset.order_by('-specimen_id')
+            page = page.filter(specimen_id__lt=after)[:limit] if after is not None else page[:limit]
+
+        return Response(self.get_serializer(page, many=True).data)
+
+    def perform_create(self, serializer):
+        # Saves through the write coalescer so bursts of creates share a transaction
+        write_batching.run_write(serializer.save)
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return SpecimenRecordSerializer
+        return super().get_serializer_class()
+
 class SpecimenDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Specimen.objects.all()
     serializer_class = SpecimenSerializer
 
+    def get_queryset(self):
+        return sharding.sharded(super().get_queryset())
+
+    def get_object(self):
+        # Reads serialise the nested taxonomy and expedition from the reference cache
+        specimen = super().get_object()
+        return reference_cache.attach([specimen])[0] if self.request.method == 'GET' else specimen
+
+# Specimens related to one, closest taxonomic level first: GET /api/specimens/<pk>/related/?limit=<n>
+class SpecimenRelatedAPIView(APIView):
+    def get(self, request, pk):
+        specimen = reference_cache.attach([get_object_or_404(sharding.sharded(Specimen.objects.all()), pk=pk)])[0]
+        try:
+            limit = int(request.query_params.get('limit', settings.RELATED_SPECIMENS))
+        except ValueError:
+            return Response({'error': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response([
+            {'relation': level, 'label': neighbours.LABELS[level], 'specimen': SpecimenRecordSerializer(record).data}
+            for record, level in neighbours.related(specimen, max(limit, 1))
+        ])
+
+# Bulk import: POST a JSON list of rows with the columns of the import CSV (importer.CSV_COLUMNS).
+# All rows are checked against the form rules first, and if any fails nothing is written and the
+# errors are returned. With ?dry_run=1 the rows are only checked.
+class SpecimenBulkAPIView(APIView):
+    def post(self, request):
+        rows = request.data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return Response({'error': 'Expected a list of rows.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > settings.BULK_MAX_ROWS:
+            return Response({'error': f'At most {settings.BULK_MAX_ROWS} rows can be sent at once.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        missing = [column for column in importer.CSV_COLUMNS if not all(column in row for row in rows)]
+        if missing:
+            return Response({'error': f'Rows are missing columns: {", ".join(missing)}.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        table = importer.validate_rows(rows)
+        result = {'rows': len(rows), 'invalid_rows': len(table.invalid_rows())}
+        if table:
+            return Response({**result, 'errors': table.as_list(settings.BULK_MAX_ERRORS)}, status=status.HTTP_400_BAD_REQUEST)
+        if request.query_params.get('dry_run') in ('1', 'true'):
+            return Response({**result, 'errors': []})
+
+        # Larger batches are imported by a background job instead of holding the request
+        if len(rows) > settings.BULK_SYNC_MAX_ROWS:
+            job = jobs.enqueue('import_csv', path=jobs.write_import_file(rows), remove=True)
+            return Response({**result, 'job': job.pk, 'status_url': reverse('job-detail', kwargs={'pk': job.pk})},
+                            status=status.HTTP_202_ACCEPTED)
+
+        return Response({**result, 'created': importer.import_rows(rows)}, status=status.HTTP_201_CREATED)
+
 class ExpeditionListAPIView(generics.ListCreateAPIView):
     queryset = Expedition.objects.all()
     serializer_class = ExpeditionSerializer
 
+    def get_queryset(self):
+        return sharding.sharded(super().get_queryset())
+
+# Paginated expedition specimen counts and top families, ordered like ExpeditionListView
+class ExpeditionStatsListAPIView(generics.ListAPIView):
+    serializer_class = ExpeditionStatsSerializer
+    pagination_class = ExpeditionStatsPagination
+
+    def get_queryset(self):
+        return expedition_stats.listing(self.request.query_params.get('sort'))
+
 class ExpeditionDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Expedition.objects.all()
     serializer_class = ExpeditionSerializer
 
+    def get_queryset(self):
+        return sharding.sharded(super().get_queryset())
+
 class TaxonomyListAPIView(generics.ListCreateAPIView):
     queryset = Taxonomy.objects.all()
     serializer_class = TaxonomySerializer
@@ -370,4 +553,246 @@ class TaxonomyDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Taxonomy.objects.all()
     serializer_class = TaxonomySerializer
 
+# Closest existing names of a rank: GET /api/taxonomies/match/?rank=family&name=Ammonitida&limit=5
+class TaxonomyMatchAPIView(APIView):
+    def get(self, request):
+        name = request.query_params.get('name', '')
+        try:
+            limit = min(int(request.query_params.get('limit', 5)), 50)
+            matches = taxon_index.matches(request.query_params.get('rank', ''), name, limit=limit)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'rank': request.query_params['rank'], 'name': name,
+                         'matches': [{'name': match, 'score': score} for match, score in matches]})
+
+# Bulk reclassification: POST {"match": {"genus": "Rana"}, "set": {"genus": "Lithobates"}} renames
+# a genus, {"match": {"genus": "Rana"}, "set": {"family": "Ranidae"}} moves it to another family.
+# Responds with the preview of affected taxonomies and specimens, and with ?dry_run=1 stops there.
+class TaxonomyReclassifyAPIView(APIView):
+    def post(self, request):
+        data = request.data if isinstance(request.data, dict) else {}
+        match, new_values = data.get('match'), data.get('set')
+        # Matching nothing would reclassify every taxonomy
+        valid_match = isinstance(match, dict) and match and not set(match) - set(reclassify.TAXONOMY_COLUMNS)
+        if not valid_match or not isinstance(new_values, dict):
+            return Response({'error': f'Expected {{"match": {{rank: name}}, "set": {{rank: name}}}} with ranks from: '
+                                      f'{", ".join(reclassify.TAXONOMY_COLUMNS)}.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        taxonomies = Taxonomy.objects.filter(**match)
+        try:
+            preview = reclassify.preview(taxonomies, new_values)
+            if request.query_params.get('dry_run') in ('1', 'true'):
+                return Response(preview)
+            return Response({**preview, 'result': reclassify.apply(taxonomies, new_values)})
+        except ValidationError as e:
+            return Response({'error': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+# Async API views
+# Read-only variants of the list and detail endpoints that use the async ORM, so under the
+# ASGI entry point (natural_history_project.asgi) a slow client waits on the event loop
+# instead of holding a whole worker. They return the same JSON as the DRF views above.
+
+# Loads a queryset without blocking the event loop; sharded querysets fan out on a thread
+async def async_list(queryset):
+    if isinstance(queryset, sharding.ShardedQuerySet):
+        return await sync_to_async(list)(queryset)
+    return [obj async for obj in queryset]
+
+
+# Fetches one object or returns None when it does not exist
+async def async_get(queryset, **lookup):
+    try:
+        if isinstance(queryset, sharding.ShardedQuerySet):
+            return await sync_to_async(queryset.get)(**lookup)
+        return await queryset.aget(**lookup)
+    except queryset.model.DoesNotExist:
+        return None
+
+
+class AsyncListAPIView(View):
+    http_method_names = ['get']
+    serializer_class = None
+
+    def get_queryset(self):
+        return sharding.sharded(self.queryset.all())
+
+    async def get(self, request):
+        objects = await async_list(self.get_queryset())
+        return JsonResponse(self.serializer_class(objects, many=True).data, safe=False)
+
+
+class AsyncDetailAPIView(View):
+    http_method_names = ['get']
+    serializer_class = None
+
+    def get_queryset(self):
+        return sharding.sharded(self.queryset.all())
+
+    async def get(self, request, pk):
+        obj = await async_get(self.get_queryset(), pk=pk)
+        if obj is None:
+            return JsonResponse({'detail': 'Not found.'}, status=404)
+        return JsonResponse(self.serializer_class(obj).data)
+
+
+# Served from the SpecimenRecord read table, with the same ?after=&limit= keyset paging
+class AsyncSpecimenListAPIView(AsyncListAPIView):
+    queryset = SpecimenRecord.objects.all()
+    serializer_class = SpecimenRecordSerializer
+
+    async def get(self, request):
+        if 'after' not in request.GET and 'limit' not in request.GET:
+            return await super().get(request)
+
+        try:
+            after = int(request.GET['after']) if 'after' in request.GET else None
+            limit = min(int(request.GET.get('limit', 100)), 1000)
+        except ValueError:
+            return JsonResponse({'error': 'after and limit must be integers.'}, status=400)
+
+        queryset = self.get_queryset()
+        if isinstance(queryset, sharding.ShardedQuerySet):
+            page = await sync_to_async(queryset.page_after)(after, limit)
+        else:
+            page = queryset.order_by('-specimen_id')
+            page = await async_list(page.filter(specimen_id__lt=after)[:limit] if after is not None else page[:limit])
+
+        return JsonResponse(self.serializer_class(page, many=True).data, safe=False)
+
+
+class AsyncSpecimenDetailAPIView(AsyncDetailAPIView):
+    # Loads the nested expedition and taxonomy in the same query
+    queryset = Specimen.objects.select_related('expedition', 'taxonomy')
+    serializer_class = SpecimenSerializer
+
+
+class AsyncExpeditionListAPIView(AsyncListAPIView):
+    queryset = Expedition.objects.all()
+    serializer_class = ExpeditionSerializer
+
+
+class AsyncExpeditionDetailAPIView(AsyncDetailAPIView):
+    queryset = Expedition.objects.all()
+    serializer_class = ExpeditionSerializer
+
+
+class AsyncTaxonomyListAPIView(AsyncListAPIView):
+    queryset = Taxonomy.objects.all()
+    serializer_class = TaxonomySerializer
+
+    # Taxonomy is not sharded
+    def get_queryset(self):
+        return self.queryset.all()
+
+
+class AsyncTaxonomyDetailAPIView(AsyncDetailAPIView):
+    queryset = Taxonomy.objects.all()
+    serializer_class = TaxonomySerializer
+
+    def get_queryset(self):
+        return self.queryset.all()
+
+# Grouped counts, distinct counts and cross-tabs computed over the columnar analytics snapshot.
+# Any query parameter named after a dimension (e.g. ?kingdom=Animalia) restricts the rows counted.
+class AnalyticsAPIView(APIView):
+    operation = 'counts'
+
+    def get(self, request):
+        params = request.query_params
+        by = [dimension for dimension in params.get('by', '').split(',') if dimension]
+        where = {dimension: params[dimension] for dimension in analytics.DIMENSIONS if dimension in params}
+
+        # Checks that every requested dimension exists before touching the snapshot
+        requested = by + [params.get(name) for name in ('value', 'rows', 'columns') if params.get(name)]
+        unknown = [dimension for dimension in requested if dimension not in analytics.DIMENSIONS]
+        if unknown:
+            return Response({'error': f"Unknown dimension(s): {', '.join(unknown)}",
+                             'dimensions': analytics.DIMENSIONS}, status=status.HTTP_400_BAD_REQUEST)
+
+        snapshot = analytics.get_snapshot()
+        if self.operation == 'counts':
+            results = analytics.grouped_counts(snapshot, by, where)
+        elif self.operation == 'distinct':
+            if not params.get('value'):
+                return Response({'error': 'The value parameter is required.'}, status=status.HTTP_400_BAD_REQUEST)
+            results = analytics.distinct_counts(snapshot, params['value'], by, where)
+        else:
+            if not (params.get('rows') and params.get('columns')):
+                return Response({'error': 'The rows and columns parameters are required.'}, status=status.HTTP_400_BAD_REQUEST)
+            results = analytics.crosstab(snapshot, params['rows'], params['columns'], where)
+
+        return Response({'version': snapshot.version, 'results': results})
+
+# Richness, Shannon and Simpson diversity of a taxonomy rank, grouped by an expedition attribute
+class BiodiversityAPIView(APIView):
+    def get(self, request, group):
+        rank = request.query_params.get('rank', 'species')
+        if group not in biodiversity.GROUPS or rank not in biodiversity.RANKS:
+            return Response({'error': 'Unknown group or rank.', 'groups': list(biodiversity.GROUPS),
+                             'ranks': biodiversity.RANKS}, status=status.HTTP_400_BAD_REQUEST)
+
+        version, results = biodiversity.cached_grouped_diversity(group, rank)
+        return Response({'version': version, 'group': group, 'rank': rank, 'results': results})
+
+# Diversity of the whole collection and of every expedition, continent and country in one response
+class BiodiversityReportAPIView(APIView):
+    def get(self, request):
+        rank = request.query_params.get('rank', 'species')
+        if rank not in biodiversity.RANKS:
+            return Response({'error': 'Unknown rank.', 'ranks': biodiversity.RANKS}, status=status.HTTP_400_BAD_REQUEST)
 
+        version, report = biodiversity.cached_report(rank)
+        return Response({'version': version, **report})
+
+# Change feed for mirrors: GET /api/changes/?since=<seq>&limit=<n> returns the changes after seq in order.
+# Mirrors keep the last_seq of each page and pass it as since on the next request until next is null.
+class ChangeFeedAPIView(APIView):
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', changes.PAGE_SIZE))
+        except ValueError:
+            return Response({'error': 'since and limit must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, changes.MAX_PAGE_SIZE))
+
+        page = changes.changes_since(since, limit)
+        last_seq = page[-1].seq if page else since
+
+        next_url = None
+        if len(page) == limit:
+            next_url = request.build_absolute_uri(f"{reverse('change-feed')}?since={last_seq}&limit={limit}")
+
+        return Response({
+            'since': since,
+            'last_seq': last_seq,
+            'latest_seq': changes.latest_seq(),
+            'next': next_url,
+            'changes': [
+                {'seq': change.seq, 'model': change.model, 'id': change.object_id,
+                 'action': change.action, 'data': change.data, 'created': change.created}
+                for change in page
+            ],
+        })
+
+# Background jobs: GET lists jobs with their progress, POST {"kind": ..., "params": {...}} queues one.
+# The web process only writes the queue row; run_jobs workers do the heavy work.
+class JobListAPIView(generics.ListCreateAPIView):
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+
+class JobDetailAPIView(generics.RetrieveAPIView):
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+
+
+# Request metrics of all workers in the Prometheus text format, for a local scraper
+class MetricsView(View):
+    http_method_names = ['get']
+
+    def get(self, request):
+        if not settings.METRICS:
+            raise Http404('Metrics are disabled.')
+        if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+            return HttpResponseForbidden('Metrics are only served to local scrapers.')
+        return HttpResponse(metrics.render(metrics.get_registry().totals()), content_type='text/plain; version=0.0.4')
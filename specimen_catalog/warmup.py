@@ -0,0 +1,90 @@
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+from django.urls import reverse
+
+from .models import Expedition, Taxonomy, SpecimenRecord
+from . import analytics
+
+# Warm-up stages in the order they run
+STAGES = ['templates', 'gazetteer', 'tables', 'snapshot', 'requests']
+
+
+# Compiles every HTML template once; the cached template loader keeps them for the process
+def warm_templates():
+    compiled = 0
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            for path in Path(directory).rglob('*.html'):
+                try:
+                    engine.get_template(path.relative_to(directory).as_posix())
+                    compiled += 1
+                except (TemplateDoesNotExist, TemplateSyntaxError):
+                    pass
+    return f'{compiled} templates'
+
+
+# Loads the pycountry country database that ExpeditionForm validates against
+def warm_gazetteer():
+    from .validation import pycountry
+    return f'{len(pycountry.countries)} countries'
+
+
+# Reads the lookup tables behind the taxonomy and expedition dropdowns and walks the
+# read model's primary key index, pulling their pages into the database page cache
+def warm_tables():
+    taxa = len(list(Taxonomy.objects.values_list('taxonomy_id', 'species')))
+    expeditions = len(list(Expedition.objects.values_list('expedition_id', 'expedition')))
+    records = SpecimenRecord.objects.count()
+    return f'{taxa} taxa, {expeditions} expeditions, {records} records'
+
+
+# Maps the current analytics snapshot without building one
+def warm_snapshot():
+    snapshot = analytics.get_snapshot(rebuild=False)
+    return 'no snapshot' if snapshot is None else f'{snapshot.rows} rows'
+
+
+# Paths of WARMUP_REQUESTS plus the all-specimens page filtered by the most common values of
+# each WARMUP_TOP_FILTERS parameter, which are the parameter sets most requests use
+def warmup_paths():
+    requests = list(settings.WARMUP_REQUESTS)
+    for parameter, field in settings.WARMUP_TOP_FILTERS.items():
+        values = (SpecimenRecord.objects.exclude(**{field: ''}).values(field).annotate(specimens=Count('pk'))
+                  .order_by('-specimens').values_list(field, flat=True)[:settings.WARMUP_TOP_VALUES])
+        requests += [('all_specimens', {parameter: value}) for value in values]
+    return [reverse(url_name) + (f'?{urlencode(params)}' if params else '') for url_name, params in requests]
+
+
+# Requests every warm-up path with fetch(path), which returns the status code. By default
+# they go through the test client, which fills this process's count and report caches.
+def warm_requests(fetch=None):
+    if fetch is None:
+        from django.test import Client
+        host = next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
+        client = Client(HTTP_HOST=host, raise_request_exception=False)
+        fetch = lambda path: client.get(path).status_code
+    statuses = [fetch(path) for path in warmup_paths()]
+    failed = sum(status >= 400 for status in statuses)
+    return f'{len(statuses)} requests' + (f', {failed} failed' if failed else '')
+
+
+# Runs the given stages (default: all) and returns (stage, seconds, detail) for each. Database
+# connections are closed afterwards: a process about to fork must not hand them to its workers.
+def warm(stages=None, fetch=None):
+    handlers = {'templates': warm_templates, 'gazetteer': warm_gazetteer, 'tables': warm_tables,
+                'snapshot': warm_snapshot, 'requests': lambda: warm_requests(fetch)}
+    results = []
+    try:
+        for stage in stages or STAGES:
+            started = time.perf_counter()
+            detail = handlers[stage]()
+            results.append((stage, time.perf_counter() - started, detail))
+    finally:
+        connections.close_all()
+    return results
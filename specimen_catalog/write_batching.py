@@ -0,0 +1,162 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from . import sharding
+
+# Put on the queue to stop the writer thread
+_STOP = object()
+
+
+# One atomic block on each of the given databases. They commit one after another, in reverse
+# order, so a failing commit can still leave the databases committed before it.
+@contextmanager
+def atomic_on(aliases):
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+# Group-commits concurrent writes: requests hand their write to a single writer thread,
+# which gathers everything submitted within a short window into one transaction.
+# Each write runs in its own savepoint, so one failing write does not affect the others,
+# and every caller gets back its own result or exception once the batch has committed.
+# With sharding enabled the transaction and the savepoints span every shard as well, as
+# specimens and expeditions are written to the shard of their continent.
+class WriteCoalescer:
+    def __init__(self, window=0.005, max_batch=100, using='default'):
+        self.window = window
+        self.max_batch = max_batch
+        self.using = using
+        self.batches = 0
+        self.writes = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Starts the writer thread on first use, and again in a process forked after that
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name='write-coalescer', daemon=True)
+                self._thread.start()
+
+    # Queues fn(*args, **kwargs) for the next batch and returns a Future for its result
+    def submit(self, fn, *args, **kwargs):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    # Runs fn in the next batch and waits for its result (or re-raises its exception).
+    # On timeout a write that has not started yet is cancelled and skipped by its batch;
+    # one that is already running is left to finish.
+    def run(self, fn, *args, timeout=None, **kwargs):
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    # Databases a batch may write to
+    def aliases(self):
+        if not sharding.enabled():
+            return [self.using]
+        return [self.using] + [alias for alias in sharding.shard_aliases() if alias != self.using]
+
+    # Stops the writer thread after the writes already queued
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _loop(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+
+                # Collects more writes until the window closes or the batch is full
+                batch = [item]
+                deadline = time.monotonic() + self.window
+                stopping = False
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                self._commit(batch)
+                if stopping:
+                    return
+        finally:
+            for alias in self.aliases():
+                connections[alias].close()
+
+    def _commit(self, batch):
+        outcomes = []
+        aliases = self.aliases()
+        try:
+            with atomic_on(aliases):
+                for future, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        outcomes.append(None)
+                        continue
+                    try:
+                        with atomic_on(aliases):
+                            outcomes.append((True, fn(*args, **kwargs)))
+                    except Exception as error:
+                        outcomes.append((False, error))
+        except Exception as error:
+            # The commit itself failed, so none of the writes in the batch happened
+            for future, fn, args, kwargs in batch:
+                if future.running():
+                    future.set_exception(error)
+            return
+        finally:
+            for alias in aliases:
+                connections[alias].close_if_unusable_or_obsolete()
+
+        self.batches += 1
+        self.writes += len(batch)
+        for (future, fn, args, kwargs), outcome in zip(batch, outcomes):
+            if outcome is None:
+                continue
+            succeeded, value = outcome
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+coalescer = WriteCoalescer()
+
+
+# Runs a create through the shared coalescer when WRITE_BATCHING is enabled, otherwise inline
+def run_write(fn, *args, **kwargs):
+    if not getattr(settings, 'WRITE_BATCHING', False):
+        return fn(*args, **kwargs)
+    coalescer.window = settings.WRITE_BATCH_WINDOW
+    coalescer.max_batch = settings.WRITE_BATCH_MAX
+    return coalescer.run(fn, *args, timeout=settings.WRITE_BATCH_TIMEOUT, **kwargs)